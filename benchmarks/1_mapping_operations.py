@@ -0,0 +1,69 @@
+import pytest
+
+from benchmarks.conftest import MiB, populate
+from cloudmappings.cloudstorage import CloudStorage
+
+
+@pytest.fixture(scope="function")
+def value(provider_name: str, value_size: int) -> bytes:
+    if provider_name == "azurite_table" and value_size >= MiB:
+        pytest.skip("Azure Table Storage has a 1MB limit per entity")
+    return b"0" * value_size
+
+
+class MappingOperationBenchmarkTests:
+    def test_get(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, value: bytes):
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=None, key_prefix=benchmark_prefix)
+        cm["key"] = value
+
+        assert benchmark(cm.__getitem__, "key") == value
+
+    def test_get_read_blindly(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, value: bytes):
+        cm = cloud_storage.create_mapping(
+            sync_initially=False, read_blindly=True, serialisation=None, key_prefix=benchmark_prefix
+        )
+        cm["key"] = value
+
+        assert benchmark(cm.__getitem__, "key") == value
+
+    def test_set(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, value: bytes):
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=None, key_prefix=benchmark_prefix)
+
+        benchmark(cm.__setitem__, "key", value)
+
+    def test_delete(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, value: bytes):
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=None, key_prefix=benchmark_prefix)
+
+        def setup():
+            cm["key"] = value
+
+        benchmark.pedantic(cm.__delitem__, args=("key",), setup=setup, rounds=20)
+
+    def test_contains_read_blindly(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str):
+        cm = cloud_storage.create_mapping(
+            sync_initially=False, read_blindly=True, serialisation=None, key_prefix=benchmark_prefix
+        )
+        cm["key"] = b"0"
+
+        assert benchmark(cm.__contains__, "key")
+
+
+class MappingKeyCountBenchmarkTests:
+    def test_sync_with_cloud(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, key_count: int):
+        populate(cloud_storage.storage_provider, [f"{benchmark_prefix}{i}" for i in range(key_count)], b"0")
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=None, key_prefix=benchmark_prefix)
+
+        benchmark.pedantic(cm.sync_with_cloud, rounds=3)
+        assert len(cm) == key_count
+
+    def test_iterate_keys(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, key_count: int):
+        populate(cloud_storage.storage_provider, [f"{benchmark_prefix}{i}" for i in range(key_count)], b"0")
+        cm = cloud_storage.create_mapping(serialisation=None, key_prefix=benchmark_prefix)
+
+        assert len(benchmark(list, cm)) == key_count
+
+    def test_iterate_items(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, key_count: int):
+        populate(cloud_storage.storage_provider, [f"{benchmark_prefix}{i}" for i in range(key_count)], b"0")
+        cm = cloud_storage.create_mapping(serialisation=None, key_prefix=benchmark_prefix)
+
+        assert len(benchmark.pedantic(list, args=(cm.items(),), rounds=1)) == key_count
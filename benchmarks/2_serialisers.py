@@ -0,0 +1,76 @@
+import pytest
+
+import cloudmappings.serialisers.core as core_serialisers
+from cloudmappings.cloudstorage import CloudStorage
+from cloudmappings.serialisers import CloudMappingSerialisation
+
+
+def _pandas_csv() -> CloudMappingSerialisation:
+    pytest.importorskip("pandas")
+    from cloudmappings.serialisers.pandas import csv
+
+    return csv()
+
+
+serialisers = {
+    "none": core_serialisers.none,
+    "pickle": core_serialisers.pickle,
+    "raw_string": core_serialisers.raw_string,
+    "json": core_serialisers.json,
+    "json_zlib": core_serialisers.json_zlib,
+    "pandas_csv": _pandas_csv,
+}
+
+
+@pytest.fixture(scope="function", params=list(serialisers))
+def serialiser_name(request) -> str:
+    return request.param
+
+
+@pytest.fixture(scope="function")
+def serialisation(serialiser_name: str) -> CloudMappingSerialisation:
+    return serialisers[serialiser_name]()
+
+
+@pytest.fixture(scope="function")
+def value(serialiser_name: str, value_size: int):
+    # A value of each serialiser's type that serialises to roughly value_size bytes
+    if serialiser_name == "none":
+        return b"0" * value_size
+    if serialiser_name == "raw_string":
+        return "0" * value_size
+    if serialiser_name == "pandas_csv":
+        from pandas import DataFrame
+
+        return DataFrame({"a": range(value_size // 8), "b": range(value_size // 8)})
+    return {str(i): i for i in range(value_size // 16)}
+
+
+class SerialiserBenchmarkTests:
+    def test_dumps(self, benchmark, serialisation: CloudMappingSerialisation, value):
+        if not serialisation:
+            pytest.skip("No serialisation to benchmark")
+        benchmark(serialisation.dumps, value)
+
+    def test_loads(self, benchmark, serialisation: CloudMappingSerialisation, value):
+        if not serialisation:
+            pytest.skip("No serialisation to benchmark")
+        benchmark(serialisation.loads, serialisation.dumps(value))
+
+    def test_mapping_round_trip(
+        self,
+        benchmark,
+        cloud_storage: CloudStorage,
+        benchmark_prefix: str,
+        serialisation: CloudMappingSerialisation,
+        value,
+    ):
+        cm = cloud_storage.create_mapping(
+            sync_initially=False, serialisation=serialisation, key_prefix=benchmark_prefix
+        )
+
+        def round_trip():
+            cm["key"] = value
+            return cm["key"]
+
+        benchmark(round_trip)
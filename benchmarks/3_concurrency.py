@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.conftest import populate
+from cloudmappings.cloudstorage import CloudStorage
+from cloudmappings.errors import KeySyncError
+
+# Each round makes this many requests, so ops per second multiplied by this is requests per second
+requests_per_round = 256
+# Each round of contended writes makes this many increments of a single key
+increments_per_round = 64
+
+
+class ConcurrencyBenchmarkTests:
+    def test_concurrent_gets(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, thread_count: int):
+        keys = [f"{i}" for i in range(requests_per_round)]
+        populate(cloud_storage.storage_provider, [f"{benchmark_prefix}{k}" for k in keys], b"0" * 1024)
+        cm = cloud_storage.create_mapping(serialisation=None, key_prefix=benchmark_prefix)
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            benchmark.extra_info["requests_per_round"] = requests_per_round
+            benchmark.pedantic(lambda: list(executor.map(cm.__getitem__, keys)), rounds=5)
+
+    def test_concurrent_sets(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, thread_count: int):
+        keys = [f"{i}" for i in range(requests_per_round)]
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=None, key_prefix=benchmark_prefix)
+
+        def set_key(key: str) -> None:
+            cm[key] = b"0" * 1024
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            benchmark.extra_info["requests_per_round"] = requests_per_round
+            benchmark.pedantic(lambda: list(executor.map(set_key, keys)), rounds=5)
+
+    def test_partitioned_sync(self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, thread_count: int):
+        # Keys spread across directories, as the key space is partitioned by delimiter listings. Each
+        # directory holds a page of keys, so the speedup is from listing pages concurrently.
+        keys = [f"{benchmark_prefix}{i % 64}/{i}" for i in range(64 * 1000)]
+        populate(cloud_storage.storage_provider, keys, b"0")
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=None, key_prefix=benchmark_prefix)
+
+        benchmark.extra_info["key_count"] = len(keys)
+        benchmark.pedantic(cm.sync_with_cloud, kwargs=dict(max_workers=thread_count, partition=True), rounds=3)
+        assert len(cm) == len(keys)
+
+    def test_contended_transform(
+        self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, thread_count: int
+    ):
+        # Writers contending to increment one counter, each with its own mapping as if in its own process
+        mappings = [
+            cloud_storage.create_mapping(sync_initially=False, key_prefix=benchmark_prefix) for _ in range(thread_count)
+        ]
+        mappings[0]["counter"] = 0
+
+        def increment(i: int) -> None:
+            mappings[i % thread_count].transform("counter", lambda n: n + 1, max_retries=1000)
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            benchmark.extra_info["increments_per_round"] = increments_per_round
+            benchmark.pedantic(lambda: list(executor.map(increment, range(increments_per_round))), rounds=3)
+        assert mappings[0].get_fresh("counter") == increments_per_round * 3
+
+    def test_contended_sync_and_retry(
+        self, benchmark, cloud_storage: CloudStorage, benchmark_prefix: str, thread_count: int
+    ):
+        # The same increments, made by syncing and retrying by hand on each KeySyncError, for comparison
+        populate(cloud_storage.storage_provider, [f"{benchmark_prefix}{i}" for i in range(1000)], b"0")
+        mappings = [
+            cloud_storage.create_mapping(sync_initially=False, key_prefix=benchmark_prefix) for _ in range(thread_count)
+        ]
+        mappings[0]["counter"] = 0
+
+        def increment(i: int) -> None:
+            cm = mappings[i % thread_count]
+            while True:
+                try:
+                    cm["counter"] = cm["counter"] + 1
+                    return
+                except (KeySyncError, KeyError):
+                    cm.sync_with_cloud()
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            benchmark.extra_info["increments_per_round"] = increments_per_round
+            benchmark.pedantic(lambda: list(executor.map(increment, range(increments_per_round))), rounds=3)
+        # Threads sharing a mapping can overwrite each other's increments, which transform avoids
+        assert mappings[0].get_fresh("counter") <= increments_per_round * 3
@@ -0,0 +1,160 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from uuid import uuid4
+
+import pytest
+
+from cloudmappings.cloudstorage import CloudStorage
+from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.transport import SharedTransport
+
+# Benchmarks run against the simulated provider by default. Emulated cloud providers are included
+# with --providers, using these environment variables to locate each emulator:
+#   moto: MOTO_ENDPOINT_URL (eg http://localhost:5000), and any AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY
+#   azurite_blob, azurite_table: AZURITE_CONNECTION_STRING
+#   fake_gcs: FAKE_GCS_ENDPOINT_URL (eg http://localhost:4443)
+all_providers = ["simulated", "local_file_system", "moto", "azurite_blob", "azurite_table", "fake_gcs"]
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+# Scales trade off coverage for run time, "full" covers values up to 1GB and up to 1M keys
+value_sizes = {
+    "quick": [KiB, MiB],
+    "full": [KiB, MiB, 100 * MiB, GiB],
+}
+key_counts = {
+    "quick": [1_000],
+    "full": [1_000, 100_000, 1_000_000],
+}
+thread_counts = {
+    "quick": [1, 8, 32],
+    "full": [1, 4, 16, 64, 128],
+}
+
+# Emulated providers share connections, sized for the most threads benchmarked
+transport = SharedTransport(max_pool_connections=max(thread_counts["full"]))
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--providers",
+        action="store",
+        default="simulated",
+        help=f"Comma separated storage providers to benchmark, any of: {','.join(all_providers)}",
+    )
+    parser.addoption(
+        "--scale",
+        action="store",
+        default="quick",
+        choices=list(value_sizes),
+        help="The range of value sizes and key counts to benchmark",
+    )
+    parser.addoption(
+        "--simulated-latency",
+        action="store",
+        type=float,
+        default=0.0,
+        help="Latency in seconds of each request to the simulated provider",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    scale = metafunc.config.getoption("scale")
+    if "provider_name" in metafunc.fixturenames:
+        metafunc.parametrize("provider_name", metafunc.config.getoption("providers").split(","), scope="session")
+    if "value_size" in metafunc.fixturenames:
+        metafunc.parametrize("value_size", value_sizes[scale])
+    if "key_count" in metafunc.fixturenames:
+        metafunc.parametrize("key_count", key_counts[scale])
+    if "thread_count" in metafunc.fixturenames:
+        metafunc.parametrize("thread_count", thread_counts[scale])
+
+
+def _create_storage_provider(provider_name: str, container_name: str, config) -> StorageProvider:
+    if provider_name == "simulated":
+        from cloudmappings._storageproviders.simulatedstorage import (
+            SimulatedStorageProvider,
+        )
+
+        return SimulatedStorageProvider(name=container_name, latency=config.getoption("simulated_latency"))
+    elif provider_name == "local_file_system":
+        from cloudmappings._storageproviders.localfilesystemstorage import (
+            LocalFileSystemStorageProvider,
+        )
+
+        return LocalFileSystemStorageProvider(
+            directory=os.path.join(str(config.cache.mkdir("benchmarks")), container_name)
+        )
+    elif provider_name == "moto":
+        from cloudmappings._storageproviders.awss3storage import AWSS3StorageProvider
+
+        return AWSS3StorageProvider(
+            bucket_name=container_name,
+            silence_warning=True,
+            endpoint_url=os.environ["MOTO_ENDPOINT_URL"],
+            transport=transport,
+        )
+    elif provider_name == "azurite_blob":
+        from cloudmappings._storageproviders.azureblobstorage import (
+            AzureBlobStorageProvider,
+        )
+
+        return AzureBlobStorageProvider(
+            container_name=container_name,
+            connection_string=os.environ["AZURITE_CONNECTION_STRING"],
+            transport=transport,
+        )
+    elif provider_name == "azurite_table":
+        from cloudmappings._storageproviders.azuretablestorage import (
+            AzureTableStorageProvider,
+        )
+
+        return AzureTableStorageProvider(
+            table_name=container_name,
+            connection_string=os.environ["AZURITE_CONNECTION_STRING"],
+            transport=transport,
+        )
+    elif provider_name == "fake_gcs":
+        from google.auth.credentials import AnonymousCredentials
+
+        from cloudmappings._storageproviders.googlecloudstorage import (
+            GoogleCloudStorageProvider,
+        )
+
+        return GoogleCloudStorageProvider(
+            bucket_name=container_name,
+            project="benchmarks",
+            credentials=AnonymousCredentials(),
+            client_options={"api_endpoint": os.environ["FAKE_GCS_ENDPOINT_URL"]},
+            transport=transport,
+        )
+    raise ValueError(f"Benchmark requested unknown storage provider '{provider_name}'")
+
+
+@pytest.fixture(scope="session")
+def storage_provider(provider_name: str, pytestconfig) -> StorageProvider:
+    provider = _create_storage_provider(provider_name, f"benchmark{uuid4().hex[:16]}", pytestconfig)
+    provider.create_if_not_exists()
+    return provider
+
+
+@pytest.fixture(scope="session")
+def cloud_storage(storage_provider: StorageProvider) -> CloudStorage:
+    return CloudStorage(storage_provider=storage_provider)
+
+
+@pytest.fixture(scope="function")
+def benchmark_prefix() -> str:
+    return f"{uuid4().hex[:16]}/"
+
+
+def populate(storage_provider: StorageProvider, keys: List[str], value: bytes) -> Dict[str, str]:
+    """Uploads value to each key directly through the storage provider, concurrently so that
+    large key counts can be set up in reasonable time"""
+    encoded_keys = [storage_provider.encode_key(k) for k in keys]
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        etags = executor.map(lambda k: storage_provider.upload_data(k, None, value), encoded_keys)
+        return dict(zip(keys, etags))
@@ -3,7 +3,12 @@ from cloudmappings.cloudstorage import (
     AWSS3Storage,
     AzureBlobStorage,
     AzureTableStorage,
+    CachedStorage,
     GoogleCloudStorage,
+    LocalFileSystemStorage,
+    PackedStorage,
+    ReplicatedStorage,
+    SimulatedStorage,
 )
 
 __all__ = [
@@ -11,6 +16,11 @@ __all__ = [
     "AWSS3Storage",
     "AzureBlobStorage",
     "AzureTableStorage",
+    "CachedStorage",
     "GoogleCloudStorage",
+    "LocalFileSystemStorage",
+    "PackedStorage",
+    "ReplicatedStorage",
+    "SimulatedStorage",
 ]
 __version__ = "2.1.0"
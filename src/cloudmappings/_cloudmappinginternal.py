@@ -1,10 +1,127 @@
-from typing import Dict, Iterator, Optional, TypeVar
+import io
+import itertools
+import os
+import pickle
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import ItemsView, Mapping, ValuesView
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, MutableMapping, Optional, Set, Tuple, TypeVar
 
-from cloudmappings.cloudmapping import CloudMapping
+from cloudmappings.cloudmapping import CloudMapping, MappedValue
+from cloudmappings.errors import KeySyncError
+from cloudmappings.instrumentation import Instrumentation
+from cloudmappings.keycodecs import KeyCodec
+from cloudmappings.reader import RangeReader
 from cloudmappings.serialisers import CloudMappingSerialisation
-from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.storageprovider import KeyStat, StorageProvider, _concurrent_errors
 
 T = TypeVar("T")
+R = TypeVar("R")
+
+_missing = object()
+_upload_batch_size = 1000
+# The number of values get_fresh keeps to revalidate, evicting the least recently used
+_fresh_values_max_size = 1024
+
+
+class _StripedLocks:
+    """A fixed set of locks that keys are hashed across, so that operations on the same key are
+    serialised, while operations on different keys rarely contend."""
+
+    def __init__(self, stripes: int = 256) -> None:
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key: str) -> threading.RLock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    @contextmanager
+    def many(self, keys: Iterable[str]) -> Iterator[None]:
+        # Stripes are locked in ascending order, so threads locking many keys at once can't deadlock
+        locks = [self._locks[stripe] for stripe in sorted({hash(key) % len(self._locks) for key in keys})]
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+
+class _ConcurrentValuesView(ValuesView):
+    def __iter__(self) -> Iterator:
+        for _, value in self._mapping._items_of(list(self._mapping)):
+            yield value
+
+
+class _ConcurrentItemsView(ItemsView):
+    def __iter__(self) -> Iterator:
+        return self._mapping._items_of(list(self._mapping))
+
+
+def _map_value(mapping: CloudMapping, fn: Callable[[Any], Any], out: Optional[MutableMapping], key: str) -> MappedValue:
+    try:
+        value = fn(mapping[key])
+        if out is not None:
+            out[key] = value
+            value = None
+    except Exception as e:
+        return MappedValue(key, None, e)
+    return MappedValue(key, value, None)
+
+
+def _picklable_error(error: BaseException) -> BaseException:
+    # Errors are pickled to return them from worker processes, so those that can't be are described instead
+    try:
+        pickle.dumps(error)
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+    return error
+
+
+# The mapping, output mapping, function and threads of a worker process of `map_values`, created once per worker
+_map_values_worker = None
+
+
+def _init_map_values_worker(state: bytes, threads: int) -> None:
+    global _map_values_worker
+    recreate, recreate_out, fn = pickle.loads(state)
+    out = None if recreate_out is None else recreate_out()
+    _map_values_worker = (recreate(), out, fn, ThreadPoolExecutor(max_workers=threads))
+
+
+def _map_values_chunk(
+    keys_and_etags: List[Tuple[str, Optional[str], Optional[str]]],
+) -> List[Tuple[MappedValue, Optional[str], Optional[int]]]:
+    mapping, out, fn, executor = _map_values_worker
+    # Values are read and written conditionally on the etags known to the calling process, as if by it
+    for key, etag, out_etag in keys_and_etags:
+        if etag is not None:
+            mapping._set_etag(key, etag)
+        if out_etag is not None:
+            out._set_etag(key, out_etag)
+    results = []
+    for result in executor.map(lambda k: _map_value(mapping, fn, out, k), [k for k, _, _ in keys_and_etags]):
+        out_etag, out_size = None, None
+        if result.error is not None:
+            result = result._replace(error=_picklable_error(result.error))
+        elif out is not None:
+            # Returned so that the calling process's output mapping can be updated
+            out_etag = out._etags.get(result.key)
+            out_size = out._stats.get(result.key, (None, None))[0]
+        results.append((result, out_etag, out_size))
+    for key, _, _ in keys_and_etags:
+        mapping._set_etag(key, None)
+        if out is not None:
+            out._set_etag(key, None)
+    return results
 
 
 class CloudMappingInternal(CloudMapping[T]):
@@ -12,24 +129,214 @@ class CloudMappingInternal(CloudMapping[T]):
     _etags: Dict[str, str]
     _serialisation: CloudMappingSerialisation[T]
     _key_prefix: Optional[str]
+    _key_codec: KeyCodec
+    _instrumentation: Optional[Instrumentation]
+    _max_workers: int
+
+    def __init__(self) -> None:
+        # Each etag is read, used in a request, and updated while holding its key's lock
+        self._key_lock = _StripedLocks()
+        # Guards updating etags, and the keys modified during each sync in progress. Keys modified
+        # while a sync is listing are not overwritten by the (possibly stale) listing. Change
+        # subscribers also track the keys modified since they last applied changes.
+        self._etags_lock = threading.Lock()
+        self._modified_during_syncs: List[Set[str]] = []
+        # The last value and etag returned by get_fresh for recently used keys, to revalidate on the next call
+        self._fresh_values: "OrderedDict[str, Tuple[str, T]]" = OrderedDict()
+        self._fresh_values_lock = threading.Lock()
+        # The size and modification time (as a POSIX timestamp) of the value of each key with a known etag,
+        # as listed when syncing or as written by this mapping. Keys of values of unknown size are omitted.
+        self._stats: Dict[str, Tuple[Optional[int], Optional[float]]] = {}
+        # Set once the initial sync has listed every key. Until then, keys not yet listed are looked up individually.
+        self._synced = threading.Event()
+        self._synced.set()
+        self._initial_sync_finished = threading.Event()
+        self._initial_sync_finished.set()
+        self._initial_sync_error: Optional[BaseException] = None
+        # Keys are encoded for every request, so cache the encodings of those recently used
+        self._encode_key_cached = lru_cache(maxsize=65536)(self._encode_key_uncached)
+
+    def _set_etag(self, key: str, etag: Optional[str], size: Optional[int] = None) -> None:
+        # The size of the value is given when it was just written, its stats are otherwise unknown unless unchanged
+        with self._etags_lock:
+            if etag is None:
+                self._etags.pop(key, None)
+                self._stats.pop(key, None)
+            else:
+                if size is not None:
+                    self._stats[key] = (size, time.time())
+                elif self._etags.get(key) != etag:
+                    self._stats.pop(key, None)
+                self._etags[key] = etag
+            for modified in self._modified_during_syncs:
+                modified.add(key)
+
+    def _sync_in_background(self, sync: Callable[[], None]) -> None:
+        self._synced.clear()
+        self._initial_sync_finished.clear()
+
+        def run() -> None:
+            try:
+                sync()
+            except Exception as e:
+                # Keys are still looked up individually, and the error is raised by methods needing every key
+                self._initial_sync_error = e
+            else:
+                self._synced.set()
+            finally:
+                self._initial_sync_finished.set()
+
+        threading.Thread(target=run, name="cloudmappings-initial-sync", daemon=True).start()
+
+    def wait_for_sync(self, timeout: Optional[float] = None) -> bool:
+        if not self._initial_sync_finished.wait(timeout):
+            return False
+        if self._initial_sync_error is not None:
+            raise self._initial_sync_error
+        return True
+
+    def _etag_of(self, key: str) -> Optional[str]:
+        # The etag of a key, looked up in the cloud if it has not yet been listed by the initial sync
+        etag = self._etags.get(key)
+        if etag is None and not self._synced.is_set():
+            etag = self._storage_provider.get_etag(self._encode_key(key))
+            if etag is not None:
+                self._set_etag(key, etag)
+        return etag
+
+    def _etags_of(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        etags = {k: self._etags.get(k) for k in keys}
+        if not self._synced.is_set():
+            unknown = [k for k, etag in etags.items() if etag is None]
+            etags.update(self._map_concurrently(self._etag_of, unknown))
+        return etags
+
+    def _with_prefix(self, mapping_key: str) -> str:
+        return self._key_prefix + mapping_key if self._key_prefix else mapping_key
+
+    def _encode_key_uncached(self, mapping_key: str) -> str:
+        return self._storage_provider.encode_key(unsafe_key=self._key_codec.encode(self._with_prefix(mapping_key)))
 
     def _encode_key(self, mapping_key: str) -> str:
         if not isinstance(mapping_key, str):
             raise TypeError(f"Key must be of type 'str'. Got key of type: {type(mapping_key)}")
-        with_prefix = self._key_prefix + mapping_key if self._key_prefix else mapping_key
-        return self._storage_provider.encode_key(unsafe_key=with_prefix)
+        return self._encode_key_cached(mapping_key)
 
-    def _decode_key(self, key_from_provider: str) -> str:
-        decoded = self._storage_provider.decode_key(key_from_provider)
-        if self._key_prefix and decoded.startswith(self._key_prefix):
+    def _decode_key(self, key_from_provider: str) -> Optional[str]:
+        decoded = self._key_codec.decode(self._storage_provider.decode_key(key_from_provider))
+        if decoded is None:
+            return None
+        if self._key_prefix:
+            # Keys outside of the prefix are not keys of this mapping
+            if not decoded.startswith(self._key_prefix):
+                return None
             decoded = decoded[len(self._key_prefix) :]
         return decoded
 
-    def sync_with_cloud(self, key_prefix: str = "") -> None:
-        key_prefix = self._encode_key(key_prefix)
-        self._etags.update(
-            {self._decode_key(k): i for k, i in self._storage_provider.list_keys_and_etags(key_prefix).items()}
+    def _loads(self, key: str, value: bytes) -> T:
+        if self._instrumentation is None:
+            return self._serialisation.loads(value)
+        with self._instrumentation.measure(self._storage_provider.logical_name(), "loads", key) as record:
+            record.bytes_in = len(value)
+            return self._serialisation.loads(value)
+
+    def _dumps(self, key: str, value: T) -> bytes:
+        if self._instrumentation is None:
+            return self._serialisation.dumps(value)
+        with self._instrumentation.measure(self._storage_provider.logical_name(), "dumps", key) as record:
+            value = self._serialisation.dumps(value)
+            record.bytes_out = len(value)
+            return value
+
+    def _map_concurrently(
+        self, request: Callable[[str], R], keys: List[str], max_workers: Optional[int] = None
+    ) -> Iterator[Tuple[str, R]]:
+        # Yields the result of a request for each key in order. Only a window of requests is in flight at
+        # once, so results are not all held in memory, and stopping iteration early cancels the rest.
+        if not keys:
+            return
+        max_workers = self._max_workers if max_workers is None else max_workers
+        keys_iter = iter(keys)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+            window = deque((k, executor.submit(request, k)) for k in itertools.islice(keys_iter, 2 * max_workers))
+            try:
+                while window:
+                    key, future = window.popleft()
+                    next_key = next(keys_iter, _missing)
+                    if next_key is not _missing:
+                        window.append((next_key, executor.submit(request, next_key)))
+                    yield key, future.result()
+            finally:
+                for _, future in window:
+                    future.cancel()
+
+    def _download_items(self, keys: List[str]) -> List[Tuple[str, T]]:
+        keys_and_etags = {}
+        for key in keys:
+            etag = None if self.read_blindly else self._etags.get(key)
+            if etag is None and not self.read_blindly:
+                continue  # Deleted by another thread since listing the keys
+            keys_and_etags[key] = etag
+        downloaded = self._storage_provider.download_many(
+            {self._encode_key(k): etag for k, etag in keys_and_etags.items()}, max_workers=self._max_workers
         )
+        items = []
+        for key in keys_and_etags:
+            value = downloaded[self._encode_key(key)]
+            if value is None:
+                if not self.read_blindly_error:
+                    items.append((key, self.read_blindly_default))
+            else:
+                items.append((key, self._loads(key, value) if self._serialisation else value))
+        return items
+
+    def _items_of(self, keys: List[str]) -> Iterator[Tuple[str, T]]:
+        # Values are downloaded in chunks, with the next chunk downloaded while the last is iterated, so
+        # values are not all held in memory. Each chunk is downloaded with one call to the storage provider,
+        # so providers that store many values in each object may read them together.
+        size = 2 * self._max_workers
+        chunks = [keys[i : i + size] for i in range(0, len(keys), size)]
+        if not chunks:
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self._download_items, chunks[0])
+            for next_chunk in chunks[1:] + [None]:
+                items = future.result()
+                if next_chunk is not None:
+                    future = executor.submit(self._download_items, next_chunk)
+                yield from items
+
+    def sync_with_cloud(self, key_prefix: str = "", max_workers: int = 16, partition: bool = False) -> None:
+        if not isinstance(key_prefix, str):
+            raise TypeError(f"Key must be of type 'str'. Got key of type: {type(key_prefix)}")
+        key_prefixes = [
+            self._storage_provider.encode_key(unsafe_key=p)
+            for p in self._key_codec.listing_prefixes(self._with_prefix(key_prefix))
+        ]
+        modified = set()
+        with self._etags_lock:
+            self._modified_during_syncs.append(modified)
+        try:
+            listed = {}
+            for k, stat in self._storage_provider.list_keys_and_stats_many(
+                key_prefixes, max_workers=max_workers, partition=partition
+            ).items():
+                key = self._decode_key(k)
+                if key is not None:
+                    listed[key] = stat
+        finally:
+            with self._etags_lock:
+                # Removed by identity, as the sets of concurrent syncs may be equal
+                self._modified_during_syncs = [m for m in self._modified_during_syncs if m is not modified]
+                for key in modified:
+                    listed.pop(key, None)
+                self._etags.update({key: stat.etag for key, stat in listed.items()})
+                for key, stat in listed.items():
+                    if stat.size is None:
+                        self._stats.pop(key, None)
+                    else:
+                        last_modified = None if stat.last_modified is None else stat.last_modified.timestamp()
+                        self._stats[key] = (stat.size, last_modified)
 
     @property
     def storage_provider(self) -> StorageProvider:
@@ -48,46 +355,450 @@ class CloudMappingInternal(CloudMapping[T]):
         return self._key_prefix
 
     def __getitem__(self, key: str) -> T:
-        if not self.read_blindly and key not in self._etags:
-            raise KeyError(key)
-        value = self._storage_provider.download_data(
-            key=self._encode_key(key), etag=None if self.read_blindly else self._etags[key]
-        )
+        if self.read_blindly:
+            value = self._storage_provider.download_data(key=self._encode_key(key), etag=None)
+        else:
+            with self._key_lock(key):
+                etag = self._etags.get(key)
+                if etag is not None:
+                    value = self._storage_provider.download_data(key=self._encode_key(key), etag=etag)
+                elif self._synced.is_set():
+                    raise KeyError(key)
+                else:
+                    # Not yet listed by the initial sync, so read the latest value and its etag in one request
+                    value, etag = self._storage_provider.download_data_if_changed(key=self._encode_key(key), etag=None)
+                    if etag is None:
+                        raise KeyError(key)
+                    self._set_etag(key, etag, size=len(value))
         if self.read_blindly and value is None:
             if self.read_blindly_error:
                 raise KeyError(key)
             return self.read_blindly_default
         if self._serialisation:
-            value = self._serialisation.loads(value)
+            value = self._loads(key, value)
         return value
 
+    def get(self, key: str, default: T = None) -> T:
+        if not self.read_blindly:
+            if key not in self._etags and self._synced.is_set():
+                return default
+            try:
+                return self[key]
+            except KeyError:
+                return default
+        # A single request, which returns nothing if the key has no value in the cloud
+        value = self._storage_provider.download_data(key=self._encode_key(key), etag=None)
+        if value is None:
+            return default
+        return self._loads(key, value) if self._serialisation else value
+
+    def transform(
+        self, key: str, fn: Callable[[T], T], max_retries: int = 16, backoff: float = 0.01, default: T = _missing
+    ) -> T:
+        encoded_key = self._encode_key(key)
+        # Threads of this mapping take turns, so only writers in other processes or mappings contend
+        with self._key_lock(key):
+            for attempt in itertools.count():
+                # The latest value and its etag are read in a single request, without syncing any other key
+                data, etag = self._storage_provider.download_data_if_changed(key=encoded_key, etag=None)
+                if etag is None:
+                    if default is _missing:
+                        self._set_etag(key, None)
+                        raise KeyError(key)
+                    value = default
+                else:
+                    value = self._loads(key, data) if self._serialisation else data
+                value = fn(value)
+                data = self._dumps(key, value) if self._serialisation else value
+                try:
+                    # Conditional on the etag read, so fails if another writer wrote since
+                    new_etag = self._storage_provider.upload_data(key=encoded_key, etag=etag, data=data)
+                except KeySyncError:
+                    if attempt >= max_retries:
+                        raise
+                    # Full jitter, so writers that collided do not all retry together
+                    time.sleep(random.uniform(0, backoff * 2 ** min(attempt, 10)))
+                    continue
+                self._set_etag(key, new_etag, size=len(data))
+                return value
+
+    def map_values(
+        self,
+        fn: Callable[[T], Any],
+        keys: Optional[Iterable[str]] = None,
+        prefix: Optional[str] = None,
+        out: Optional[MutableMapping[str, Any]] = None,
+        processes: Optional[int] = None,
+        threads_per_process: int = 16,
+    ) -> Iterator[MappedValue]:
+        keys = list(self.keys() if keys is None else keys)
+        if prefix is not None:
+            keys = [k for k in keys if k.startswith(prefix)]
+        if processes == 0:
+            return (
+                result
+                for _, result in self._map_concurrently(
+                    lambda k: _map_value(self, fn, out, k), keys, max_workers=threads_per_process
+                )
+            )
+        self.wait_for_sync()
+        # Workers write to cloud mappings directly, and results for other mappings are written by this process
+        out_mapping = out if isinstance(out, CloudMappingInternal) else None
+        # Pickled now, so that mappings or functions that can't be pickled raise before any keys are processed
+        try:
+            state = pickle.dumps((self._recreate, None if out_mapping is None else out_mapping._recreate, fn))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise TypeError(
+                "map_values with worker processes pickles the function and the arguments each storage provider was"
+                f" constructed with, which failed: {e}. Use processes=0 to apply the function with threads only"
+            ) from e
+        return self._map_values_in_processes(state, keys, out, out_mapping, processes, threads_per_process)
+
+    def _map_values_in_processes(
+        self,
+        state: bytes,
+        keys: List[str],
+        out: Optional[MutableMapping[str, Any]],
+        out_mapping: Optional["CloudMappingInternal"],
+        processes: Optional[int],
+        threads_per_process: int,
+    ) -> Iterator[MappedValue]:
+        chunk_size = 4 * threads_per_process
+        chunks = [keys[i : i + chunk_size] for i in range(0, len(keys), chunk_size)]
+        if not chunks:
+            return
+        processes = min((os.cpu_count() or 1) if processes is None else processes, len(chunks))
+
+        def submit(executor: ProcessPoolExecutor, chunk: List[str]):
+            # The etags are those known when the chunk is sent, so include any written since the call
+            keys_and_etags = [
+                (
+                    k,
+                    None if self.read_blindly else self._etags.get(k),
+                    None if out_mapping is None else out_mapping._etags.get(k),
+                )
+                for k in chunk
+            ]
+            return executor.submit(_map_values_chunk, keys_and_etags)
+
+        chunks_iter = iter(chunks)
+        with ProcessPoolExecutor(
+            max_workers=processes, initializer=_init_map_values_worker, initargs=(state, threads_per_process)
+        ) as executor:
+            window = deque(submit(executor, c) for c in itertools.islice(chunks_iter, 2 * processes))
+            try:
+                while window:
+                    future = window.popleft()
+                    next_chunk = next(chunks_iter, None)
+                    if next_chunk is not None:
+                        window.append(submit(executor, next_chunk))
+                    for result, out_etag, out_size in future.result():
+                        if out_etag is not None:
+                            out_mapping._set_etag(result.key, out_etag, size=out_size)
+                        elif out is not None and out_mapping is None and result.error is None:
+                            try:
+                                out[result.key] = result.value
+                            except Exception as e:
+                                result = MappedValue(result.key, None, e)
+                            else:
+                                result = result._replace(value=None)
+                        yield result
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def get_fresh(self, key: str) -> T:
+        with self._key_lock(key):
+            with self._fresh_values_lock:
+                etag, value = self._fresh_values.get(key, (None, None))
+            data, latest_etag = self._storage_provider.download_data_if_changed(key=self._encode_key(key), etag=etag)
+            self._set_etag(key, latest_etag, size=None if data is None else len(data))
+            if latest_etag is None:
+                self._forget_fresh_value(key)
+                raise KeyError(key)
+            if data is not None:
+                value = self._loads(key, data) if self._serialisation else data
+            with self._fresh_values_lock:
+                self._fresh_values[key] = (latest_etag, value)
+                self._fresh_values.move_to_end(key)
+                if len(self._fresh_values) > _fresh_values_max_size:
+                    self._fresh_values.popitem(last=False)
+            return value
+
+    def _forget_fresh_value(self, key: str) -> None:
+        # Called when the key is written or deleted, so the value isn't held until it's evicted
+        with self._fresh_values_lock:
+            self._fresh_values.pop(key, None)
+
+    def _etag_to_read(self, key: str) -> Optional[str]:
+        if self.read_blindly:
+            return None
+        etag = self._etag_of(key)
+        if etag is None:
+            raise KeyError(key)
+        return etag
+
+    def read_range(self, key: str, start: int, end: Optional[int] = None) -> bytes:
+        downloaded = self._storage_provider.download_range(
+            key=self._encode_key(key), etag=self._etag_to_read(key), start=start, end=end
+        )
+        if downloaded is None:
+            raise KeyError(key)
+        return downloaded.data
+
+    def get_buffer(self, key: str) -> memoryview:
+        buffer = self._storage_provider.download_buffer(key=self._encode_key(key), etag=self._etag_to_read(key))
+        if buffer is None:
+            raise KeyError(key)
+        return buffer
+
+    def open(self, key: str, buffer_size: int = 64 * 1024) -> io.BufferedReader:
+        reader = RangeReader(self._storage_provider, key=self._encode_key(key), etag=self._etag_to_read(key))
+        return io.BufferedReader(reader, buffer_size=buffer_size)
+
+    def append(self, key: str, data: bytes) -> None:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        with self._key_lock(key):
+            etag = self._etag_of(key)
+            size = 0 if etag is None else self._stats.get(key, (None, None))[0]
+            new_etag = self._storage_provider.append_data(key=self._encode_key(key), etag=etag, data=data)
+            self._set_etag(key, new_etag, size=None if size is None else size + len(data))
+
     def __setitem__(self, key: str, value: T) -> None:
         if self._serialisation:
-            value = self._serialisation.dumps(value)
-        self._etags[key] = self._storage_provider.upload_data(
-            key=self._encode_key(key),
-            etag=self._etags.get(key, None),
-            data=value,
-        )
+            value = self._dumps(key, value)
+        with self._key_lock(key):
+            etag = self._storage_provider.upload_data(
+                key=self._encode_key(key),
+                etag=self._etag_of(key),
+                data=value,
+            )
+            self._set_etag(key, etag, size=len(value))
+            self._forget_fresh_value(key)
 
     def __delitem__(self, key: str) -> None:
-        if key not in self._etags:
-            raise KeyError(key)
-        self._storage_provider.delete_data(key=self._encode_key(key), etag=self._etags[key])
-        del self._etags[key]
+        with self._key_lock(key):
+            etag = self._etag_of(key)
+            if etag is None:
+                raise KeyError(key)
+            self._storage_provider.delete_data(key=self._encode_key(key), etag=etag)
+            self._set_etag(key, None)
+            self._forget_fresh_value(key)
+
+    def pop(self, key: str, default=_missing) -> T:
+        # The value is read and deleted while holding the key's lock, and both requests are conditional on
+        # the same etag (even when reading blindly), so the value returned is always the value deleted
+        with self._key_lock(key):
+            etag = self._etag_of(key)
+            if etag is None:
+                if default is _missing:
+                    raise KeyError(key)
+                return default
+            encoded_key = self._encode_key(key)
+            value = self._storage_provider.download_data(key=encoded_key, etag=etag)
+            self._storage_provider.delete_data(key=encoded_key, etag=etag)
+            self._set_etag(key, None)
+            self._forget_fresh_value(key)
+        return self._loads(key, value) if self._serialisation else value
+
+    def popitem(self) -> Tuple[str, T]:
+        for key in self.keys():
+            try:
+                return key, self.pop(key)
+            except KeyError:
+                pass  # Deleted by another thread since listing the keys
+        raise KeyError("popitem(): mapping is empty")
+
+    def clear(self) -> None:
+        self.wait_for_sync()
+        etags = dict(self._etags)
+        keys = {self._encode_key(k): k for k in etags}
+        errors = self._storage_provider.delete_many(
+            {encoded_key: etags[k] for encoded_key, k in keys.items()}, max_workers=self._max_workers
+        )
+        for encoded_key, key in keys.items():
+            if encoded_key not in errors:
+                with self._key_lock(key):
+                    # Unless written by another thread while deleting
+                    if self._etags.get(key) == etags[key]:
+                        self._set_etag(key, None)
+                    self._forget_fresh_value(key)
+        if errors:
+            raise next(iter(errors.values()))
+
+    def _copy(
+        self, source_key: str, source_etag: Optional[str], key: str, destination: Optional["CloudMappingInternal[T]"]
+    ) -> None:
+        destination = self if destination is None else destination
+        if destination._serialisation != self._serialisation:
+            raise ValueError("Values can only be copied to a mapping with the same serialisation")
+        encoded_source_key = self._encode_key(source_key)
+        with destination._key_lock(key):
+            if destination._storage_provider.logical_name() == self._storage_provider.logical_name():
+                etag = destination._storage_provider.copy_data(
+                    source_key=encoded_source_key,
+                    source_etag=source_etag,
+                    key=destination._encode_key(key),
+                    etag=destination._etag_of(key),
+                )
+                # The copy has the size of the source, if the source is known to be unchanged since listed
+                size = (
+                    self._stats.get(source_key, (None, None))[0] if self._etags.get(source_key) == source_etag else None
+                )
+            else:
+                data = self._storage_provider.download_data(key=encoded_source_key, etag=source_etag)
+                if data is None:
+                    raise KeyError(source_key)
+                etag = destination._storage_provider.upload_data(
+                    key=destination._encode_key(key), etag=destination._etag_of(key), data=data
+                )
+                size = len(data)
+            destination._set_etag(key, etag, size=size)
+
+    def copy(self, source_key: str, key: str, destination: Optional[CloudMapping[T]] = None) -> None:
+        self._copy(source_key, self._etag_to_read(source_key), key, destination)
+
+    def move(self, source_key: str, key: str, destination: Optional[CloudMapping[T]] = None) -> None:
+        if (destination is None or destination is self) and key == source_key:
+            return
+        # The source is only deleted if unchanged since it was copied, so its etag is needed. The source's
+        # lock is not held while copying, as two moves between the same keys would then deadlock.
+        source_etag = self._etag_of(source_key)
+        if source_etag is None and self.read_blindly:
+            source_etag = self._storage_provider.get_etag(self._encode_key(source_key))
+        if source_etag is None:
+            raise KeyError(source_key)
+        self._copy(source_key, source_etag, key, destination)
+        with self._key_lock(source_key):
+            self._storage_provider.delete_data(key=self._encode_key(source_key), etag=source_etag)
+            if self._etags.get(source_key) == source_etag:
+                self._set_etag(source_key, None)
+
+    def copy_prefix(self, source_prefix: str, prefix: str, destination: Optional[CloudMapping[T]] = None) -> None:
+        keys = [k for k in self.keys() if k.startswith(source_prefix)]
+        errors = _concurrent_errors(
+            lambda k: self.copy(k, prefix + k[len(source_prefix) :], destination), keys, self._max_workers
+        )
+        if errors:
+            raise next(iter(errors.values()))
+
+    def setdefault(self, key: str, default: T = None) -> T:
+        with self._key_lock(key):
+            if key in self._etags:
+                return self[key]
+            data = self._dumps(key, default) if self._serialisation else default
+            try:
+                # Uploading without an etag only succeeds if the key has no value in the cloud, so the key is
+                # set in a single request, without first reading it, and never overwrites another writer
+                etag = self._storage_provider.upload_data(key=self._encode_key(key), etag=None, data=data)
+            except KeySyncError:
+                # Unless reading blindly, a value can only be read if it has not been listed yet
+                if not self.read_blindly and self._synced.is_set():
+                    raise
+                return self[key]
+            self._set_etag(key, etag, size=len(data))
+            return default
+
+    def update(self, other: Iterable = (), **kwargs: T) -> None:
+        if isinstance(other, Mapping):
+            items = other.items()
+        elif hasattr(other, "keys"):
+            items = ((k, other[k]) for k in other.keys())
+        else:
+            items = other
+        values = dict(items)
+        values.update(kwargs)
+        keys = list(values)
+        errors = {}
+        # Keys are uploaded in batches with one call to the storage provider, which uploads them concurrently,
+        # or together for providers that store many values in each object. Then the error for one of the
+        # keys not uploaded is raised.
+        for i in range(0, len(keys), _upload_batch_size):
+            batch = keys[i : i + _upload_batch_size]
+            data = {k: self._dumps(k, values[k]) if self._serialisation else values[k] for k in batch}
+            encoded_keys = {self._encode_key(k): k for k in batch}
+            with self._key_lock.many(batch):
+                known_etags = self._etags_of(batch)
+                etags, batch_errors = self._storage_provider.upload_many(
+                    {encoded_key: (known_etags[k], data[k]) for encoded_key, k in encoded_keys.items()},
+                    max_workers=self._max_workers,
+                )
+                for encoded_key, etag in etags.items():
+                    self._set_etag(encoded_keys[encoded_key], etag, size=len(data[encoded_keys[encoded_key]]))
+            errors.update(batch_errors)
+        if errors:
+            raise next(iter(errors.values()))
+
+    def values(self) -> ValuesView:
+        return _ConcurrentValuesView(self)
+
+    def items(self) -> ItemsView:
+        return _ConcurrentItemsView(self)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        self.wait_for_sync()
+        etags = dict(self._etags)
+        if set(etags) != set(other):
+            return False
+        keys = list(etags)
+        if (
+            isinstance(other, CloudMappingInternal)
+            and other._storage_provider.logical_name() == self._storage_provider.logical_name()
+            and other._serialisation == self._serialisation
+        ):
+            # Values stored in the same place with the same etag are equal, without downloading them
+            keys = [k for k in keys if other._etags.get(k) != etags[k] or other._encode_key(k) != self._encode_key(k)]
+        # Compare the remaining values concurrently, stopping at the first that differs
+        return all(equal for _, equal in self._map_concurrently(lambda k: self[k] == other[k], keys))
 
     def __contains__(self, key: str) -> bool:
         if not self.read_blindly:
-            return key in self._etags
-        encoded_key = self._encode_key(key)
-        return encoded_key in self._storage_provider.list_keys_and_etags(encoded_key)
+            return key in self._etags or (not self._synced.is_set() and self._etag_of(key) is not None)
+        return self._storage_provider.exists(self._encode_key(key))
+
+    def stat(self, key: str) -> KeyStat:
+        with self._etags_lock:
+            etag = self._etags.get(key)
+            size, last_modified = self._stats.get(key, (None, None))
+        if etag is None:
+            raise KeyError(key)
+        if last_modified is not None:
+            last_modified = datetime.fromtimestamp(last_modified, tz=timezone.utc)
+        return KeyStat(etag, size, last_modified)
+
+    def total_size(self, key_prefix: str = "") -> int:
+        self.wait_for_sync()
+        with self._etags_lock:
+            sizes = {k: self._stats.get(k, (None, None))[0] for k in self._etags if k.startswith(key_prefix)}
+        missing = [k for k, size in sizes.items() if size is None]
+        for key, size in self._map_concurrently(self._fetch_size, missing):
+            sizes[key] = size
+        return sum(sizes.values())
+
+    def _fetch_size(self, key: str) -> int:
+        # An empty range of the value, conditional on its etag, which gets its size without transferring it
+        with self._key_lock(key):
+            etag = self._etag_of(key)
+            if etag is None:
+                return 0  # Deleted by another thread since listing the keys
+            downloaded = self._storage_provider.download_range(key=self._encode_key(key), etag=etag, start=0, end=0)
+            with self._etags_lock:
+                if self._etags.get(key) == etag:
+                    self._stats[key] = (downloaded.size, None)
+            return downloaded.size
 
     def keys(self) -> Iterator[str]:
-        return iter(self._etags.keys())
+        self.wait_for_sync()
+        # Iterate a copy, so other threads may modify the mapping during iteration
+        return iter(list(self._etags))
 
     __iter__ = keys
 
     def __len__(self) -> int:
+        self.wait_for_sync()
         return len(self._etags)
 
     def __repr__(self) -> str:
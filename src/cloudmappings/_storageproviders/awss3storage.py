@@ -1,15 +1,37 @@
 import logging
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4
 
 import boto3
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
 
 from cloudmappings.errors import KeySyncError
-from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.instrumentation import phase
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider, _concurrent_errors, resolve_range
+from cloudmappings.transport import SharedTransport
 
 logger = logging.getLogger(__name__)
 
 _metadata_etag_key = "cloud-mappings-etag"
+_retryable_error_codes = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "RequestTimeout",
+    "InternalError",
+    "ServiceUnavailable",
+    "503",
+}
+# CopyObject copies objects of up to 5GiB, larger objects are copied in parts with UploadPartCopy
+_max_copy_object_size = 5 * 1024**3
+_copy_part_size = 512 * 1024**2
+# Every part of a multipart upload but the last must be at least 5MiB
+_min_part_size = 5 * 1024**2
+# The number of objects listed whose etags are read from their metadata concurrently
+_listing_head_workers = 16
 
 
 class AWSS3StorageProvider(StorageProvider):
@@ -17,8 +39,15 @@ class AWSS3StorageProvider(StorageProvider):
         self,
         bucket_name: str,
         silence_warning: bool = False,
+        endpoint_url: str = None,
+        transport: SharedTransport = None,
     ) -> None:
-        self._client = boto3.client("s3")
+        if transport is not None:
+            self._client = transport.boto3_client(endpoint_url=endpoint_url)
+            self._resource = transport.boto3_resource(endpoint_url=endpoint_url)
+        else:
+            self._client = boto3.client("s3", endpoint_url=endpoint_url)
+            self._resource = boto3.resource("s3", endpoint_url=endpoint_url)
         self._bucket_name = bucket_name
         if not silence_warning:
             logger.warning(
@@ -34,7 +63,7 @@ class AWSS3StorageProvider(StorageProvider):
 
     def create_if_not_exists(self):
         already_exists = False
-        bucket = boto3.resource("s3").Bucket(self._bucket_name)
+        bucket = self._resource.Bucket(self._bucket_name)
 
         # Note: There is a race condition here:
         # If bucket is created after the creation_date is fetched but before the create call succeeds.
@@ -55,12 +84,18 @@ class AWSS3StorageProvider(StorageProvider):
             )
         return already_exists
 
+    def is_retryable_error(self, error: BaseException) -> bool:
+        if isinstance(error, ClientError):
+            return error.response.get("Error", {}).get("Code") in _retryable_error_codes
+        return isinstance(error, (BotocoreConnectionError, HTTPClientError)) or super().is_retryable_error(error)
+
     def _get_body_etag_version_id_if_exists(self, key: str) -> Dict:
         try:
-            response = self._client.get_object(
-                Bucket=self._bucket_name,
-                Key=key,
-            )
+            with phase("precondition"):
+                response = self._client.get_object(
+                    Bucket=self._bucket_name,
+                    Key=key,
+                )
             return (
                 response["Body"],
                 response["Metadata"][_metadata_etag_key],
@@ -75,7 +110,69 @@ class AWSS3StorageProvider(StorageProvider):
             raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
         if body is None:
             return None
-        return body.read()
+        with phase("transfer"):
+            return body.read()
+
+    def _head_if_exists(self, key: str) -> Optional[Dict]:
+        try:
+            return self._client.head_object(
+                Bucket=self._bucket_name,
+                Key=key,
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return None
+            raise
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        with phase("precondition"):
+            head = self._head_if_exists(key)
+        if head is None:
+            if etag is None:
+                return None
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        existing_etag = head["Metadata"][_metadata_etag_key]
+        if etag is not None and etag != existing_etag:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        size = head["ContentLength"]
+        offset, stop = resolve_range(start, end, size)
+        if offset == stop:
+            return DownloadedRange(data=b"", size=size, etag=existing_etag)
+        # Get the same version as the HEAD request, so the range can't be from a newer version
+        args = dict(VersionId=head["VersionId"]) if head.get("VersionId") else dict(IfMatch=head["ETag"])
+        with phase("transfer"):
+            response = self._client.get_object(
+                Bucket=self._bucket_name,
+                Key=key,
+                Range=f"bytes={offset}-{stop - 1}",
+                **args,
+            )
+            return DownloadedRange(data=response["Body"].read(), size=size, etag=existing_etag)
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        # Etags are stored in metadata rather than being S3's own ETag, which If-None-Match compares
+        # against, so check the metadata with a HEAD request before downloading
+        if etag is not None:
+            with phase("precondition"):
+                response = self._head_if_exists(key)
+            if response is None:
+                return None, None
+            if response["Metadata"][_metadata_etag_key] == etag:
+                return None, etag
+        body, existing_etag, _ = self._get_body_etag_version_id_if_exists(key)
+        if body is None:
+            return None, None
+        with phase("transfer"):
+            return body.read(), existing_etag
+
+    def exists(self, key: str) -> bool:
+        return self._head_if_exists(key) is not None
+
+    def get_etag(self, key: str) -> Optional[str]:
+        response = self._head_if_exists(key)
+        if response is None:
+            return None
+        return response["Metadata"][_metadata_etag_key]
 
     def upload_data(self, key: str, etag: str, data: bytes) -> str:
         if not isinstance(data, bytes):
@@ -89,16 +186,113 @@ class AWSS3StorageProvider(StorageProvider):
         # conflict checking.
         # TODO: Monitor S3 API to see if a parameter to support atomic requests is added.
         new_etag = str(uuid4())
-        self._client.put_object(
-            Bucket=self._bucket_name,
-            Key=key,
-            Body=data,
-            Metadata={
-                _metadata_etag_key: new_etag,
-            },
-        )
+        with phase("transfer"):
+            self._client.put_object(
+                Bucket=self._bucket_name,
+                Key=key,
+                Body=data,
+                Metadata={
+                    _metadata_etag_key: new_etag,
+                },
+            )
         return new_etag
 
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        with phase("precondition"):
+            source = self._head_if_exists(source_key)
+            existing = self._head_if_exists(key)
+        if source is None or (source_etag is not None and source_etag != source["Metadata"][_metadata_etag_key]):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag)
+        if etag != (None if existing is None else existing["Metadata"][_metadata_etag_key]):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        # Copy the version that was checked, so a newer version of the source can't be copied instead.
+        # Note: As with uploads, there is a race condition if the destination changes before the copy.
+        copy_source = dict(Bucket=self._bucket_name, Key=source_key, VersionId=source["VersionId"])
+        new_etag = str(uuid4())
+        metadata = {_metadata_etag_key: new_etag}
+        with phase("transfer"):
+            if source["ContentLength"] <= _max_copy_object_size:
+                self._client.copy_object(
+                    Bucket=self._bucket_name,
+                    Key=key,
+                    CopySource=copy_source,
+                    MetadataDirective="REPLACE",
+                    Metadata=metadata,
+                )
+            else:
+                self._copy_in_parts(copy_source, source["ContentLength"], key, metadata)
+        return new_etag
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        with phase("precondition"):
+            existing = self._head_if_exists(key)
+        if etag != (None if existing is None else existing["Metadata"][_metadata_etag_key]):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        if existing is None or existing["ContentLength"] < _min_part_size:
+            # Parts copied from the existing object must be at least 5MiB, so small values are rewritten
+            return super().append_data(key=key, etag=etag, data=data)
+        # Concatenate the version that was checked with the data in a multipart upload, so only the data
+        # is uploaded. Note: As with uploads, there is a race condition if the key changes before completing.
+        copy_source = dict(Bucket=self._bucket_name, Key=key, VersionId=existing["VersionId"])
+        new_etag = str(uuid4())
+        with phase("transfer"):
+            self._copy_in_parts(copy_source, existing["ContentLength"], key, {_metadata_etag_key: new_etag}, data)
+        return new_etag
+
+    def _copy_in_parts(
+        self, copy_source: Dict, size: int, key: str, metadata: Dict[str, str], appended: bytes = b""
+    ) -> None:
+        upload_id = self._client.create_multipart_upload(Bucket=self._bucket_name, Key=key, Metadata=metadata)[
+            "UploadId"
+        ]
+        try:
+            # Split the copy evenly, so that no copied part is smaller than the minimum part size when
+            # followed by appended parts
+            copied_parts = (size + _copy_part_size - 1) // _copy_part_size
+            appended_parts = (len(appended) + _copy_part_size - 1) // _copy_part_size
+
+            def copy_part(part_number: int) -> Dict:
+                start = (part_number - 1) * size // copied_parts
+                stop = part_number * size // copied_parts
+                response = self._client.upload_part_copy(
+                    Bucket=self._bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    CopySource=copy_source,
+                    CopySourceRange=f"bytes={start}-{stop - 1}",
+                )
+                return dict(PartNumber=part_number, ETag=response["CopyPartResult"]["ETag"])
+
+            def upload_part(part_number: int) -> Dict:
+                start = (part_number - copied_parts - 1) * _copy_part_size
+                response = self._client.upload_part(
+                    Bucket=self._bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=appended[start : start + _copy_part_size],
+                )
+                return dict(PartNumber=part_number, ETag=response["ETag"])
+
+            def make_part(part_number: int) -> Dict:
+                return copy_part(part_number) if part_number <= copied_parts else upload_part(part_number)
+
+            part_numbers = range(1, copied_parts + appended_parts + 1)
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                parts = list(executor.map(make_part, part_numbers))
+            self._client.complete_multipart_upload(
+                Bucket=self._bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload=dict(Parts=parts),
+            )
+        except BaseException:
+            self._client.abort_multipart_upload(Bucket=self._bucket_name, Key=key, UploadId=upload_id)
+            raise
+
     def delete_data(self, key: str, etag: str) -> None:
         body, existing_etag, version_id = self._get_body_etag_version_id_if_exists(key)
         if body is None or etag != existing_etag:
@@ -114,9 +308,86 @@ class AWSS3StorageProvider(StorageProvider):
             VersionId=version_id,
         )
 
-    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
-        bucket = boto3.resource("s3").Bucket(self._bucket_name)
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        keys = list(keys_and_etags)
+        if not keys:
+            return {}
+
+        # As for delete_data, the etags are checked first, and then the versions checked are deleted
+        heads = {}
+        with phase("precondition"):
+            errors = _concurrent_errors(lambda k: heads.__setitem__(k, self._head_if_exists(k)), keys, max_workers)
+        to_delete = []
+        for key in keys:
+            if key in errors:
+                continue
+            response = heads[key]
+            if response is None or response["Metadata"].get(_metadata_etag_key) != keys_and_etags[key]:
+                errors[key] = KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=keys_and_etags[key])
+            elif response.get("VersionId") is not None:
+                to_delete.append(dict(Key=key, VersionId=response["VersionId"]))
+            else:
+                to_delete.append(dict(Key=key))
+
+        # DeleteObjects deletes up to 1000 keys in each request
+        batches = [to_delete[i : i + 1000] for i in range(0, len(to_delete), 1000)]
+
+        def delete_batch(batch: List[Dict]) -> List[Dict]:
+            try:
+                response = self._client.delete_objects(
+                    Bucket=self._bucket_name,
+                    Delete=dict(Objects=batch, Quiet=True),
+                )
+            except Exception as e:
+                return [dict(Key=o["Key"], Exception=e) for o in batch]
+            return response.get("Errors", [])
+
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+                for batch_errors in executor.map(delete_batch, batches):
+                    for error in batch_errors:
+                        # Errors of keys within a batch are returned as the code S3 would have raised
+                        errors[error["Key"]] = error.get("Exception") or ClientError({"Error": error}, "DeleteObjects")
+        return errors
+
+    def _stats_of_listed(self, objects: List[Dict]) -> Dict[str, KeyStat]:
+        # Listings include the size and modification time of each object, but etags are held in each object's
+        # metadata, so listing costs a HEAD request per object as well. They are made concurrently, and objects
+        # deleted since being listed are left out.
+        def stat(o: Dict) -> Optional[KeyStat]:
+            head = self._head_if_exists(o["Key"])
+            etag = None if head is None else head["Metadata"].get(_metadata_etag_key)
+            return None if etag is None else KeyStat(etag, o["Size"], o["LastModified"])
+
+        if not objects:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(_listing_head_workers, len(objects))) as executor:
+            stats = dict(zip((o["Key"] for o in objects), executor.map(stat, objects)))
+        return {k: stat for k, stat in stats.items() if stat is not None}
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        objects, prefixes = [], []
+        for page in self._client.get_paginator("list_objects_v2").paginate(
+            Bucket=self._bucket_name, Prefix=key_prefix, Delimiter=delimiter
+        ):
+            objects.extend(page.get("Contents", []))
+            prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+        return self._stats_of_listed(objects), prefixes
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        keys_and_stats, prefixes = self.list_keys_and_stats_delimited(key_prefix, delimiter)
+        return {k: stat.etag for k, stat in keys_and_stats.items()}, prefixes
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
         kwargs = {}
         if key_prefix:
             kwargs["Prefix"] = key_prefix
-        return {o.key: o.Object().metadata[_metadata_etag_key] for o in bucket.objects.filter(**kwargs)}
+        objects = []
+        for page in self._client.get_paginator("list_objects_v2").paginate(Bucket=self._bucket_name, **kwargs):
+            objects.extend(page.get("Contents", []))
+        return self._stats_of_listed(objects)
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return {k: stat.etag for k, stat in self.list_keys_and_stats(key_prefix).items()}
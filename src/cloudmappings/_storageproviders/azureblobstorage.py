@@ -1,16 +1,28 @@
 import json
-from typing import Any, Dict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
 from azure.core import MatchConditions
 from azure.core.exceptions import (
+    HttpResponseError,
     ResourceExistsError,
     ResourceModifiedError,
     ResourceNotFoundError,
+    ResourceNotModifiedError,
+    ServiceRequestError,
+    ServiceResponseError,
 )
-from azure.storage.blob import ContainerClient
+from azure.storage.blob import BlobPrefix, BlobType, ContainerClient
 
 from cloudmappings.errors import KeySyncError
-from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider, resolve_range
+from cloudmappings.transport import SharedTransport
+
+# Request timeout, throttling (429 and 503 ServerBusy) and server errors
+_retryable_status_codes = {408, 429, 500, 502, 503, 504}
+# The maximum size of each block appended to an append blob
+_max_append_block_size = 4 * 1024**2
 
 
 class AzureBlobStorageProvider(StorageProvider):
@@ -21,16 +33,21 @@ class AzureBlobStorageProvider(StorageProvider):
         account_url: str = None,
         connection_string: str = None,
         create_container_metadata=None,
+        transport: SharedTransport = None,
     ) -> None:
+        client_args = {}
+        if transport is not None:
+            client_args["transport"] = transport.azure_transport()
         if connection_string:
             self._container_client = ContainerClient.from_connection_string(
-                conn_str=connection_string, container_name=container_name
+                conn_str=connection_string, container_name=container_name, **client_args
             )
         else:
             self._container_client = ContainerClient(
                 account_url=account_url,
                 container_name=container_name,
                 credential=credential,
+                **client_args,
             )
         self._create_container_metadata = create_container_metadata
 
@@ -48,6 +65,11 @@ class AzureBlobStorageProvider(StorageProvider):
             return True
         return False
 
+    def is_retryable_error(self, error: BaseException) -> bool:
+        if isinstance(error, HttpResponseError) and error.status_code in _retryable_status_codes:
+            return True
+        return isinstance(error, (ServiceRequestError, ServiceResponseError)) or super().is_retryable_error(error)
+
     def download_data(self, key: str, etag: str) -> bytes:
         args = dict(blob=key)
         if etag is not None:
@@ -66,6 +88,83 @@ class AzureBlobStorageProvider(StorageProvider):
                 return None
             raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
 
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        args = dict()
+        if etag is not None:
+            args.update(
+                dict(
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            )
+        try:
+            if start < 0 or (end is not None and end <= start):
+                # Blob storage doesn't support suffix ranges, so ranges relative to the end (and empty
+                # ranges) first get the size of the blob, and then the version with that size
+                properties = self._container_client.get_blob_client(blob=key).get_blob_properties(**args)
+                offset, stop = resolve_range(start, end, properties.size)
+                if offset == stop:
+                    return DownloadedRange(data=b"", size=properties.size, etag=properties.etag.strip('"'))
+                args = dict(etag=properties.etag, match_condition=MatchConditions.IfNotModified)
+            else:
+                offset, stop = start, end
+            downloader = self._container_client.download_blob(
+                blob=key,
+                offset=offset,
+                length=None if stop is None else stop - offset,
+                **args,
+            )
+        except ResourceModifiedError as e:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+        except ResourceNotFoundError as e:
+            if etag is None:
+                return None
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+        except HttpResponseError as e:
+            if e.status_code != 416:
+                raise
+            # The range starts after the end of the blob, preconditions are checked before ranges
+            properties = self._container_client.get_blob_client(blob=key).get_blob_properties(**args)
+            return DownloadedRange(data=b"", size=properties.size, etag=properties.etag.strip('"'))
+        properties = downloader.properties
+        return DownloadedRange(data=downloader.readall(), size=properties.size, etag=properties.etag.strip('"'))
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        args = dict(blob=key)
+        if etag is not None:
+            args.update(
+                dict(
+                    etag=etag,
+                    match_condition=MatchConditions.IfModified,
+                )
+            )
+        try:
+            downloader = self._container_client.download_blob(**args)
+        except ResourceNotModifiedError:
+            return None, etag
+        except ResourceNotFoundError:
+            return None, None
+        return downloader.readall(), downloader.properties.etag.strip('"')
+
+    def exists(self, key: str) -> bool:
+        try:
+            properties = self._container_client.get_blob_client(blob=key).get_blob_properties()
+        except ResourceNotFoundError:
+            return False
+        # As when listing, directories in containers with hierarchical namespaces are not keys
+        return (
+            properties.content_settings.content_type is not None or properties.content_settings.content_md5 is not None
+        )
+
+    def get_etag(self, key: str) -> Optional[str]:
+        try:
+            properties = self._container_client.get_blob_client(blob=key).get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+        if properties.content_settings.content_type is None and properties.content_settings.content_md5 is None:
+            return None
+        return properties.etag.strip('"')
+
     def upload_data(self, key: str, etag: str, data: bytes) -> str:
         if not isinstance(data, bytes):
             raise ValueError(f"Data must be bytes like, got {type(data)}")
@@ -88,6 +187,71 @@ class AzureBlobStorageProvider(StorageProvider):
             raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
         return json.loads(response["etag"])
 
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        bc = self._container_client.get_blob_client(blob=key)
+        try:
+            if etag is None:
+                etag = json.loads(bc.create_append_blob(match_condition=MatchConditions.IfMissing)["etag"])
+            elif not data:
+                bc.get_blob_properties(etag=etag, match_condition=MatchConditions.IfNotModified)
+            # Each block is appended conditionally on the etag following the previous block
+            for start in range(0, len(data), _max_append_block_size):
+                try:
+                    response = bc.append_block(
+                        data[start : start + _max_append_block_size],
+                        etag=etag,
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                except HttpResponseError as e:
+                    if e.error_code != "InvalidBlobType":
+                        raise
+                    # Values uploaded as block blobs are rewritten once as append blobs
+                    existing = bc.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified).readall()
+                    response = bc.upload_blob(
+                        data=existing + data,
+                        blob_type=BlobType.APPENDBLOB,
+                        overwrite=True,
+                        etag=etag,
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                    return json.loads(response["etag"])
+                etag = json.loads(response["etag"])
+        except (ResourceExistsError, ResourceModifiedError, ResourceNotFoundError) as e:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+        return etag
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        source_url = self._container_client.get_blob_client(blob=source_key).url
+        if source_etag is not None:
+            args = dict(source_etag=source_etag, source_match_condition=MatchConditions.IfNotModified)
+        else:
+            args = dict(source_match_condition=MatchConditions.IfPresent)
+        if etag is not None:
+            args.update(dict(etag=etag, match_condition=MatchConditions.IfNotModified))
+        else:
+            args.update(dict(match_condition=MatchConditions.IfMissing))
+        bc = self._container_client.get_blob_client(blob=key)
+        try:
+            response = bc.start_copy_from_url(source_url, **args)
+        except ResourceNotFoundError as e:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag) from e
+        except (ResourceExistsError, ResourceModifiedError) as e:
+            if e.error_code == "SourceConditionNotMet":
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag) from e
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+        # Copies within a storage account usually complete before responding, otherwise wait for the copy
+        delay = 0.05
+        while response["copy_status"] == "pending":
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+            properties = bc.get_blob_properties()
+            response = dict(copy_status=properties.copy.status, etag=properties.etag)
+        if response["copy_status"] != "success":
+            raise HttpResponseError(message=f"Copy of {source_key!r} to {key!r} {response['copy_status']}")
+        return response["etag"].strip('"')
+
     def delete_data(self, key: str, etag: str) -> None:
         try:
             self._container_client.delete_blob(
@@ -98,14 +262,68 @@ class AzureBlobStorageProvider(StorageProvider):
         except ResourceModifiedError as e:
             raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
 
-    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        keys = list(keys_and_etags)
+        # Blob batches delete up to 256 blobs in each request, each only if its etag matches
+        batches = [keys[i : i + 256] for i in range(0, len(keys), 256)]
+
+        def delete_batch(batch: List[str]) -> Dict[str, BaseException]:
+            try:
+                responses = list(
+                    self._container_client.delete_blobs(
+                        *[
+                            dict(name=k, etag=keys_and_etags[k], match_condition=MatchConditions.IfNotModified)
+                            for k in batch
+                        ],
+                        raise_on_any_failure=False,
+                    )
+                )
+            except Exception as e:
+                return {k: e for k in batch}
+            errors = {}
+            for key, response in zip(batch, responses):
+                if response.status_code in (404, 412):
+                    errors[key] = KeySyncError(
+                        storage_provider_name=self.logical_name(), key=key, etag=keys_and_etags[key]
+                    )
+                elif response.status_code >= 300:
+                    errors[key] = HttpResponseError(response=response)
+            return errors
+
+        errors = {}
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+                for batch_errors in executor.map(delete_batch, batches):
+                    errors.update(batch_errors)
+        return errors
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        keys_and_stats, prefixes = {}, []
+        for b in self._container_client.walk_blobs(name_starts_with=key_prefix, delimiter=delimiter):
+            if isinstance(b, BlobPrefix):
+                prefixes.append(b.name)
+            elif b.content_settings.content_type is not None or b.content_settings.content_md5 is not None:
+                # As when listing, directories in containers with hierarchical namespaces are skipped
+                keys_and_stats[b.name] = KeyStat(b.etag, b.size, b.last_modified)
+        return keys_and_stats, prefixes
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        keys_and_stats, prefixes = self.list_keys_and_stats_delimited(key_prefix, delimiter)
+        return {k: stat.etag for k, stat in keys_and_stats.items()}, prefixes
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
         # If the container has hierarchical namespaces enabled, this call
         # will return files as well as subdirectories.
         # Unforunately there is no serverside api to filter, so we
         # rely on checking the content_type & content_md5 hash
         # If both are None, we assume the listing is a dir skip it
         return {
-            b.name: b.etag
+            b.name: KeyStat(b.etag, b.size, b.last_modified)
             for b in self._container_client.list_blobs(name_starts_with=key_prefix)
             if b.content_settings.content_type is not None or b.content_settings.content_md5 is not None
         }
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return {k: stat.etag for k, stat in self.list_keys_and_stats(key_prefix).items()}
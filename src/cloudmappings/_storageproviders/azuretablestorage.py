@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 from urllib.parse import quote, unquote
 
 from azure.core import MatchConditions
@@ -6,11 +6,17 @@ from azure.core.exceptions import (
     HttpResponseError,
     ResourceExistsError,
     ResourceNotFoundError,
+    ServiceRequestError,
+    ServiceResponseError,
 )
 from azure.data.tables import TableClient, UpdateMode
 
 from cloudmappings.errors import KeySyncError, ValueSizeError
 from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.transport import SharedTransport
+
+# Request timeout, throttling (429 and 503 ServerBusy) and server errors
+_retryable_status_codes = {408, 429, 500, 502, 503, 504}
 
 
 def _chunk_bytes(data: bytes) -> Dict[str, bytes]:
@@ -30,14 +36,21 @@ class AzureTableStorageProvider(StorageProvider):
         credential: Any = None,
         endpoint: str = None,
         connection_string: str = None,
+        transport: SharedTransport = None,
     ) -> None:
+        client_args = {}
+        if transport is not None:
+            client_args["transport"] = transport.azure_transport()
         if connection_string is not None:
-            self._table_client = TableClient.from_connection_string(conn_str=connection_string, table_name=table_name)
+            self._table_client = TableClient.from_connection_string(
+                conn_str=connection_string, table_name=table_name, **client_args
+            )
         else:
             self._table_client = TableClient(
                 endpoint=endpoint,
                 table_name=table_name,
                 credential=credential,
+                **client_args,
             )
 
     def encode_key(self, unsafe_key) -> str:
@@ -60,6 +73,11 @@ class AzureTableStorageProvider(StorageProvider):
             return True
         return False
 
+    def is_retryable_error(self, error: BaseException) -> bool:
+        if isinstance(error, HttpResponseError) and error.status_code in _retryable_status_codes:
+            return True
+        return isinstance(error, (ServiceRequestError, ServiceResponseError)) or super().is_retryable_error(error)
+
     def download_data(self, key: str, etag: str) -> bytes:
         try:
             entity = self._table_client.get_entity(
@@ -75,6 +93,47 @@ class AzureTableStorageProvider(StorageProvider):
                 raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
             return _dechunk_entity(entity)
 
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        try:
+            if etag is not None:
+                # Tables does not support conditional reads, so first get only the etag of the entity
+                entity = self._table_client.get_entity(
+                    partition_key=key,
+                    row_key="cm",
+                    select=["PartitionKey"],
+                )
+                if entity.metadata["etag"] == etag:
+                    return None, etag
+            entity = self._table_client.get_entity(
+                partition_key=key,
+                row_key="cm",
+            )
+        except ResourceNotFoundError:
+            return None, None
+        return _dechunk_entity(entity), entity.metadata["etag"]
+
+    def exists(self, key: str) -> bool:
+        try:
+            self._table_client.get_entity(
+                partition_key=key,
+                row_key="cm",
+                select=["PartitionKey"],
+            )
+        except ResourceNotFoundError:
+            return False
+        return True
+
+    def get_etag(self, key: str) -> Optional[str]:
+        try:
+            entity = self._table_client.get_entity(
+                partition_key=key,
+                row_key="cm",
+                select=["PartitionKey"],
+            )
+        except ResourceNotFoundError:
+            return None
+        return entity.metadata["etag"]
+
     def upload_data(self, key: str, etag: str, data: bytes) -> str:
         if not isinstance(data, bytes):
             raise ValueError(f"Data must be bytes like, got {type(data)}")
@@ -0,0 +1,276 @@
+import hashlib
+import mmap
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+from cloudmappings.errors import KeySyncError
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider
+
+# Etags are always quoted in file names, so never start with "#" and can't collide with temporary files
+_temp_file_marker = "#"
+# Once over its maximum size the cache is evicted to this fraction of it, so scans for the files to evict are
+# amortised over many writes
+_evict_to_fraction = 0.9
+
+
+class CachedStorageProvider(StorageProvider):
+    def __init__(
+        self,
+        storage_provider: StorageProvider,
+        directory: str,
+        max_size: Optional[int] = None,
+        revalidate: bool = True,
+    ) -> None:
+        self._storage_provider = storage_provider
+        self._directory = os.path.abspath(directory)
+        self._max_size = max_size
+        self._revalidate = revalidate
+        self._evict_lock = threading.Lock()
+        # Estimated total size of the cached files, counted when the directory is scanned and tracked since. Other
+        # processes may share the directory, so it is only accurate as of the last scan.
+        self._cached_size: Optional[int] = None
+
+    @property
+    def wrapped_storage_provider(self) -> StorageProvider:
+        return self._storage_provider
+
+    def logical_name(self) -> str:
+        # The cache is transparent, so mappings of the cached and uncached storage are equivalent
+        return self._storage_provider.logical_name()
+
+    def create_if_not_exists(self) -> bool:
+        os.makedirs(self._directory, exist_ok=True)
+        return self._storage_provider.create_if_not_exists()
+
+    def encode_key(self, unsafe_key) -> str:
+        return self._storage_provider.encode_key(unsafe_key)
+
+    def decode_key(self, encoded_key) -> str:
+        return self._storage_provider.decode_key(encoded_key)
+
+    def is_retryable_error(self, error: BaseException) -> bool:
+        return self._storage_provider.is_retryable_error(error)
+
+    def _key_directory(self, key: str) -> str:
+        # One directory per key, containing a file per cached version named by its etag. The directory
+        # is named by a hash, so keys of any length or characters may be cached, from many storages.
+        digest = hashlib.sha256(f"{self._storage_provider.logical_name()}\n{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self._directory, digest[:2], digest)
+
+    def _path(self, key: str, etag: str) -> str:
+        return os.path.join(self._key_directory(key), quote(etag, safe=""))
+
+    def _cached_etags(self, key: str) -> Iterator[str]:
+        try:
+            names = os.listdir(self._key_directory(key))
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.startswith(_temp_file_marker):
+                yield unquote(name)
+
+    def _newest_cached_etag(self, key: str) -> Optional[str]:
+        # Usually only one version of a key is cached, but concurrent writes may briefly cache several
+        newest = None
+        try:
+            entries = list(os.scandir(self._key_directory(key)))
+        except FileNotFoundError:
+            return None
+        for entry in entries:
+            if not entry.name.startswith(_temp_file_marker):
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if newest is None or mtime > newest[0]:
+                    newest = (mtime, unquote(entry.name))
+        return None if newest is None else newest[1]
+
+    def _remove(self, path: str) -> int:
+        # Returns the size of the file removed, if any
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    def _record_size_change(self, change: int) -> bool:
+        # Returns whether the cache may now exceed its maximum size
+        if self._max_size is None:
+            return False
+        with self._evict_lock:
+            if self._cached_size is None:
+                return True
+            self._cached_size += change
+            return self._cached_size > self._max_size
+
+    def _evict_key(self, key: str, keep_etag: Optional[str] = None) -> None:
+        # Files that are open or mapped into memory remain readable after being removed
+        removed = 0
+        for etag in list(self._cached_etags(key)):
+            if etag != keep_etag:
+                removed += self._remove(self._path(key, etag))
+        if removed:
+            self._record_size_change(-removed)
+
+    def _store(self, key: str, etag: str, data: bytes) -> None:
+        directory = self._key_directory(key)
+        os.makedirs(directory, exist_ok=True)
+        path = self._path(key, etag)
+        temp_path = os.path.join(directory, f"{_temp_file_marker}{uuid4().hex}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(temp_path, path)
+        self._evict_key(key, keep_etag=etag)
+        if self._record_size_change(len(data) - replaced):
+            self._evict_to_max_size(keep_path=path)
+
+    def _evict_to_max_size(self, keep_path: str) -> None:
+        # Evicts the least recently used files, as each hit updates the modification time of its file. Only
+        # scans the directory once the tracked size exceeds the maximum, then evicts below it to leave slack.
+        with self._evict_lock:
+            if self._cached_size is not None and self._cached_size <= self._max_size:
+                return  # Evicted by another thread while waiting for the lock
+            files = []
+            for shard in os.scandir(self._directory):
+                for key_directory in os.scandir(shard.path) if shard.is_dir() else ():
+                    for entry in os.scandir(key_directory.path):
+                        if not entry.name.startswith(_temp_file_marker) and entry.path != keep_path:
+                            try:
+                                stat = entry.stat()
+                            except FileNotFoundError:
+                                continue
+                            files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            try:
+                total_size = sum(size for _, size, _ in files) + os.path.getsize(keep_path)
+            except FileNotFoundError:
+                total_size = sum(size for _, size, _ in files)
+            if total_size > self._max_size:
+                for _, size, path in sorted(files):
+                    if total_size <= self._max_size * _evict_to_fraction:
+                        break
+                    total_size -= self._remove(path)
+            self._cached_size = total_size
+
+    def _fetch(self, key: str, etag: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        # Ensures the latest version of the key is cached, returning the path of its file and its etag
+        if etag is not None and os.path.exists(self._path(key, etag)):
+            cached_etag = etag
+            if not self._revalidate:
+                return self._path(key, etag), etag
+        else:
+            # Any other cached version may still be the latest, so the requested etag is merely stale
+            cached_etag = self._newest_cached_etag(key)
+        # Only downloads the data if the cached version (if any) is not the latest
+        data, latest_etag = self._storage_provider.download_data_if_changed(key=key, etag=cached_etag)
+        if latest_etag is None:
+            self._evict_key(key)
+        elif data is not None:
+            self._store(key, latest_etag, data)
+        if etag is not None and etag != latest_etag:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        if latest_etag is None:
+            return None, None
+        return self._path(key, latest_etag), latest_etag
+
+    def _open_cached(self, key: str, etag: Optional[str]):
+        # A cached file may be evicted between fetching and opening it, in which case fetch it again
+        while True:
+            path, _ = self._fetch(key, etag)
+            if path is None:
+                return None
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            if os.utime in os.supports_fd:
+                os.utime(f.fileno())  # Mark as recently used
+            return f
+
+    def download_data(self, key: str, etag: str) -> bytes:
+        f = self._open_cached(key, etag)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def download_buffer(self, key: str, etag: Optional[str]) -> memoryview:
+        f = self._open_cached(key, etag)
+        if f is None:
+            return None
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")  # Empty files can't be mapped
+            # Cached files are replaced rather than modified, so the mapping is never changed
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        return self._storage_provider.download_data_if_changed(key=key, etag=etag)
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        return self._storage_provider.download_range(key=key, etag=etag, start=start, end=end)
+
+    def exists(self, key: str) -> bool:
+        return self._storage_provider.exists(key)
+
+    def get_etag(self, key: str) -> Optional[str]:
+        return self._storage_provider.get_etag(key)
+
+    def upload_data(self, key: str, etag: str, data: bytes) -> str:
+        new_etag = self._storage_provider.upload_data(key=key, etag=etag, data=data)
+        # Write through, so the value can be read back without downloading it
+        self._store(key, new_etag, data)
+        return new_etag
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        new_etag = self._storage_provider.copy_data(source_key=source_key, source_etag=source_etag, key=key, etag=etag)
+        # The data is copied within the cloud, so is not cached until it is read
+        self._evict_key(key)
+        return new_etag
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        new_etag = self._storage_provider.append_data(key=key, etag=etag, data=data)
+        # Only the appended data is known, so the value is not cached until it is read
+        self._evict_key(key)
+        return new_etag
+
+    def upload_many(
+        self, keys_etags_and_data: Dict[str, Tuple[Optional[str], bytes]], max_workers: int = 16
+    ) -> Tuple[Dict[str, str], Dict[str, BaseException]]:
+        etags, errors = self._storage_provider.upload_many(keys_etags_and_data, max_workers=max_workers)
+        for key, etag in etags.items():
+            self._store(key, etag, keys_etags_and_data[key][1])
+        return etags, errors
+
+    def delete_data(self, key: str, etag: str) -> None:
+        self._storage_provider.delete_data(key=key, etag=etag)
+        self._evict_key(key)
+
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        errors = self._storage_provider.delete_many(keys_and_etags, max_workers=max_workers)
+        for key in keys_and_etags:
+            if key not in errors:
+                self._evict_key(key)
+        return errors
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        return self._storage_provider.list_keys_and_etags_delimited(key_prefix, delimiter)
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return self._storage_provider.list_keys_and_etags(key_prefix)
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        return self._storage_provider.list_keys_and_stats_delimited(key_prefix, delimiter)
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        return self._storage_provider.list_keys_and_stats(key_prefix)
@@ -1,11 +1,26 @@
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
 
+from google.api_core.exceptions import GoogleAPICallError, NotFound, PreconditionFailed
 from google.cloud import storage
 from google.cloud.exceptions import Conflict
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import Timeout
 from google.cloud.storage.blob import Blob
 
 from cloudmappings.errors import KeySyncError
-from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.instrumentation import phase
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider, _concurrent_errors, resolve_range
+from cloudmappings.transport import SharedTransport
+
+# Request timeout, throttling (429) and server errors
+_retryable_status_codes = {408, 429, 500, 502, 503, 504}
+# Prefix of the temporary parts composed onto blobs when appending, which is outside the keys of any mapping
+# with a key prefix, and skipped when listing for mappings without one
+_append_parts_prefix = ".cloudmappings-append/"
+# The most components a composite object may have, each append composing one more
+_max_compose_components = 1024
 
 
 class GoogleCloudStorageProvider(StorageProvider):
@@ -14,10 +29,19 @@ class GoogleCloudStorageProvider(StorageProvider):
         bucket_name: str,
         project: str,
         credentials=None,
+        client_options=None,
+        transport: SharedTransport = None,
     ) -> None:
+        self._request_args = {}
+        client_args = {}
+        if transport is not None:
+            self._request_args["timeout"] = transport.timeout
+            client_args["_http"] = transport.google_session(credentials=credentials)
         self._client = storage.Client(
             project=project,
             credentials=credentials,
+            client_options=client_options,
+            **client_args,
         )
         self._bucket = self._client.bucket(
             bucket_name=bucket_name,
@@ -40,30 +64,90 @@ class GoogleCloudStorageProvider(StorageProvider):
             exists = True
         return exists
 
+    def is_retryable_error(self, error: BaseException) -> bool:
+        if isinstance(error, GoogleAPICallError) and error.code in _retryable_status_codes:
+            return True
+        return isinstance(error, (RequestsConnectionError, Timeout)) or super().is_retryable_error(error)
+
     def _parse_etag(self, blob: Blob) -> str:
         if blob is None:
             return None
         return f"{blob.generation}{blob.metageneration}"
 
     def download_data(self, key: str, etag: str) -> bytes:
-        b = self._bucket.get_blob(
-            blob_name=key,
-        )
+        with phase("precondition"):
+            b = self._bucket.get_blob(
+                blob_name=key,
+                **self._request_args,
+            )
         existing_etag = self._parse_etag(b)
         if etag is not None and etag != existing_etag:
             raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
         if b is None:
             return None
-        return b.download_as_bytes(
-            if_generation_match=b.generation,
-        )
+        with phase("transfer"):
+            return b.download_as_bytes(
+                if_generation_match=b.generation,
+                **self._request_args,
+            )
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        with phase("precondition"):
+            b = self._bucket.get_blob(
+                blob_name=key,
+                **self._request_args,
+            )
+        existing_etag = self._parse_etag(b)
+        if etag is not None and etag != existing_etag:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        if b is None:
+            return None
+        offset, stop = resolve_range(start, end, b.size)
+        if offset == stop:
+            return DownloadedRange(data=b"", size=b.size, etag=existing_etag)
+        with phase("transfer"):
+            data = b.download_as_bytes(
+                start=offset,
+                end=stop - 1,
+                if_generation_match=b.generation,
+                **self._request_args,
+            )
+        return DownloadedRange(data=data, size=b.size, etag=existing_etag)
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        # Etags combine the generation and metageneration, so compare them against the blob's metadata
+        # rather than with if_generation_not_match, then only download the body if they differ
+        with phase("precondition"):
+            b = self._bucket.get_blob(
+                blob_name=key,
+                **self._request_args,
+            )
+        existing_etag = self._parse_etag(b)
+        if b is None or etag == existing_etag:
+            return None, existing_etag
+        with phase("transfer"):
+            return (
+                b.download_as_bytes(
+                    if_generation_match=b.generation,
+                    **self._request_args,
+                ),
+                existing_etag,
+            )
+
+    def exists(self, key: str) -> bool:
+        return self._bucket.blob(blob_name=key).exists(**self._request_args)
+
+    def get_etag(self, key: str) -> Optional[str]:
+        return self._parse_etag(self._bucket.get_blob(blob_name=key, **self._request_args))
 
     def upload_data(self, key: str, etag: str, data: bytes) -> str:
         if not isinstance(data, bytes):
             raise ValueError(f"Data must be bytes like, got {type(data)}")
-        b = self._bucket.get_blob(
-            blob_name=key,
-        )
+        with phase("precondition"):
+            b = self._bucket.get_blob(
+                blob_name=key,
+                **self._request_args,
+            )
         existing_etag = self._parse_etag(b)
         if etag != existing_etag:
             raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
@@ -71,30 +155,215 @@ class GoogleCloudStorageProvider(StorageProvider):
             b = self._bucket.blob(
                 blob_name=key,
             )
-        b.upload_from_string(
-            data=data,
-            if_generation_match=b.generation,
-        )
+        with phase("transfer"):
+            b.upload_from_string(
+                data=data,
+                if_generation_match=b.generation,
+                **self._request_args,
+            )
         return f"{b.generation}{b.metageneration}"
 
-    def delete_data(self, key: str, etag: str) -> None:
-        b = self._bucket.get_blob(
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        with phase("precondition"):
+            source = self._bucket.get_blob(
+                blob_name=source_key,
+                **self._request_args,
+            )
+            existing = self._bucket.get_blob(
+                blob_name=key,
+                **self._request_args,
+            )
+        if source is None or (source_etag is not None and source_etag != self._parse_etag(source)):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag)
+        if etag != self._parse_etag(existing):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        # A new blob, so its metadata is copied from the source rather than from the existing destination
+        b = self._bucket.blob(
             blob_name=key,
         )
+        token = None
+        try:
+            with phase("transfer"):
+                # Large objects, or those copied between locations, are rewritten over several requests
+                while True:
+                    token, _, _ = b.rewrite(
+                        source=source,
+                        token=token,
+                        if_generation_match=0 if existing is None else existing.generation,
+                        if_source_generation_match=source.generation,
+                        **self._request_args,
+                    )
+                    if token is None:
+                        break
+        except (NotFound, PreconditionFailed) as e:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+        return self._parse_etag(b)
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        if etag is None:
+            return self.upload_data(key=key, etag=etag, data=data)
+        with phase("precondition"):
+            existing = self._bucket.get_blob(
+                blob_name=key,
+                **self._request_args,
+            )
+        if etag != self._parse_etag(existing):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        if (existing.component_count or 1) >= _max_compose_components:
+            # Too many appends to compose another, so rewrite the blob as a single component
+            try:
+                with phase("transfer"):
+                    existing_data = existing.download_as_bytes(
+                        if_generation_match=existing.generation,
+                        **self._request_args,
+                    )
+                    b = self._bucket.blob(
+                        blob_name=key,
+                    )
+                    b.upload_from_string(
+                        data=existing_data + data,
+                        if_generation_match=existing.generation,
+                        **self._request_args,
+                    )
+            except (NotFound, PreconditionFailed) as e:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+            return self._parse_etag(b)
+        # Upload the data as a temporary part, then compose the existing blob and the part into the blob
+        part = self._bucket.blob(
+            blob_name=f"{_append_parts_prefix}{uuid4().hex}",
+        )
+        try:
+            with phase("transfer"):
+                part.upload_from_string(
+                    data=data,
+                    if_generation_match=0,
+                    **self._request_args,
+                )
+                b = self._bucket.blob(
+                    blob_name=key,
+                )
+                b.compose(
+                    sources=[existing, part],
+                    if_generation_match=existing.generation,
+                    if_source_generation_match=[existing.generation, part.generation],
+                    **self._request_args,
+                )
+        except (NotFound, PreconditionFailed) as e:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+        finally:
+            try:
+                part.delete(**self._request_args)
+            except NotFound:
+                pass
+        return self._parse_etag(b)
+
+    def delete_data(self, key: str, etag: str) -> None:
+        with phase("precondition"):
+            b = self._bucket.get_blob(
+                blob_name=key,
+                **self._request_args,
+            )
         existing_etag = self._parse_etag(b)
         if etag != existing_etag:
             raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
         self._bucket.delete_blob(
             blob_name=key,
             if_generation_match=b.generation,
+            **self._request_args,
         )
 
-    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
-        keys_and_ids = {
-            b.name: self._parse_etag(b)
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        keys = list(keys_and_etags)
+        # As for delete_data, the etags are checked first, then the generations checked are deleted
+        blobs = {}
+        with phase("precondition"):
+            errors = _concurrent_errors(
+                lambda k: blobs.__setitem__(k, self._bucket.get_blob(blob_name=k, **self._request_args)),
+                keys,
+                max_workers,
+            )
+        to_delete = []
+        for key in keys:
+            if key in errors:
+                continue
+            if self._parse_etag(blobs[key]) != keys_and_etags[key]:
+                errors[key] = KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=keys_and_etags[key])
+            else:
+                to_delete.append(key)
+
+        def delete_blob(key: str) -> None:
+            try:
+                self._bucket.delete_blob(
+                    blob_name=key,
+                    if_generation_match=blobs[key].generation,
+                    **self._request_args,
+                )
+            except (NotFound, PreconditionFailed) as e:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=keys_and_etags[key]) from e
+
+        def delete_blob_if_exists(key: str) -> None:
+            if self._bucket.get_blob(blob_name=key, **self._request_args) is not None:
+                delete_blob(key)
+
+        # Batch requests delete up to 100 blobs in each request
+        batches = [to_delete[i : i + 100] for i in range(0, len(to_delete), 100)]
+
+        def delete_batch(batch: List[str]) -> Dict[str, BaseException]:
+            try:
+                with self._client.batch():
+                    for key in batch:
+                        self._bucket.delete_blob(
+                            blob_name=key,
+                            if_generation_match=blobs[key].generation,
+                            **self._request_args,
+                        )
+            except GoogleAPICallError:
+                # The batch makes every request before raising the first error, so the keys it deleted are gone.
+                # Delete each key that remains one at a time to find which failed.
+                return _concurrent_errors(delete_blob_if_exists, batch, max_workers)
+            except Exception as e:
+                return {k: e for k in batch}
+            return {}
+
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+                for batch_errors in executor.map(delete_batch, batches):
+                    errors.update(batch_errors)
+        return errors
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        blobs = self._client.list_blobs(
+            bucket_or_name=self._bucket,
+            prefix=key_prefix,
+            delimiter=delimiter,
+            **self._request_args,
+        )
+        keys_and_stats = {
+            b.name: KeyStat(self._parse_etag(b), b.size, b.updated)
+            for b in blobs
+            if not b.name.startswith(_append_parts_prefix)
+        }
+        # Prefixes are collected while paging through the blobs
+        return keys_and_stats, sorted(p for p in blobs.prefixes if p != _append_parts_prefix)
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        keys_and_stats, prefixes = self.list_keys_and_stats_delimited(key_prefix, delimiter)
+        return {k: stat.etag for k, stat in keys_and_stats.items()}, prefixes
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        return {
+            b.name: KeyStat(self._parse_etag(b), b.size, b.updated)
             for b in self._client.list_blobs(
                 bucket_or_name=self._bucket,
                 prefix=key_prefix,
+                **self._request_args,
             )
+            if not b.name.startswith(_append_parts_prefix)
         }
-        return keys_and_ids
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return {k: stat.etag for k, stat in self.list_keys_and_stats(key_prefix).items()}
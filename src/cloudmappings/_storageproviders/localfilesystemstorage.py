@@ -0,0 +1,305 @@
+import mmap
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+from cloudmappings.errors import KeySyncError
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider, resolve_range
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, writes are then only atomic within a single process
+    fcntl = None
+
+# Encoded keys never contain "#" (it is always quoted), so files starting with it can't collide with keys
+_internal_file_marker = "#"
+_lock_file_name = f"{_internal_file_marker}cloudmappings.lock"
+# Encoded keys never have a path segment of "%" (it is always quoted), so it names the files and directories of
+# empty segments, which the file system can't represent. Encoded keys themselves keep empty segments, so the
+# encoding of a key prefix remains a prefix of the encoding of its keys.
+_empty_segment_name = "%"
+
+
+def _etag_from_stat(stat: os.stat_result) -> str:
+    # Every write is renamed into place from a new file, so the inode changes with each write,
+    # and the mtime and size guard against inode reuse after deletes.
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def _key_stat(stat: os.stat_result) -> KeyStat:
+    return KeyStat(_etag_from_stat(stat), stat.st_size, datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc))
+
+
+class LocalFileSystemStorageProvider(StorageProvider):
+    def __init__(
+        self,
+        directory: str,
+    ) -> None:
+        self._directory = os.path.abspath(directory)
+        self._thread_lock = threading.Lock()
+
+    def encode_key(self, unsafe_key) -> str:
+        # Keep "/" so keys map to subdirectories, but quote "." so no path segment can be "." or ".."
+        return quote(unsafe_key, safe="/", errors="strict").replace(".", "%2E")
+
+    def decode_key(self, encoded_key) -> str:
+        return unquote(encoded_key, errors="strict")
+
+    def logical_name(self) -> str:
+        return "CloudStorageProvider=LocalFileSystem," f"Directory={self._directory}"
+
+    def create_if_not_exists(self):
+        already_exists = os.path.isdir(self._directory)
+        os.makedirs(self._directory, exist_ok=True)
+        return already_exists
+
+    def _path(self, key: str) -> str:
+        # Keys with empty segments, such as "a//b", "a/" or "/a", are distinct from those without
+        return os.path.join(self._directory, *(segment or _empty_segment_name for segment in key.split("/")))
+
+    def _directory_path(self, directory: str, separator: str) -> str:
+        # The directory of a key prefix partitioned at its last "/", the root directory if it has none
+        return self._path(directory) if separator else self._directory
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # Conditional writes and deletes check the etag and modify the file while holding this lock,
+        # which is shared between threads, and between processes when fcntl is available
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self._directory, _lock_file_name), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _existing_etag(self, path: str) -> Optional[str]:
+        try:
+            return _etag_from_stat(os.stat(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _remove_empty_parents(self, path: str) -> None:
+        parent = os.path.dirname(path)
+        while parent != self._directory and parent.startswith(self._directory):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                return
+            parent = os.path.dirname(parent)
+
+    def _write_temp_file(self, directory: str, data: bytes) -> str:
+        temp_path = os.path.join(directory, f"{_internal_file_marker}{uuid4().hex}.tmp")
+        while True:
+            os.makedirs(directory, exist_ok=True)
+            try:
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                return temp_path
+            except FileNotFoundError:
+                pass  # The empty directory was removed by a concurrent delete, recreate it
+
+    def download_data(self, key: str, etag: str) -> bytes:
+        try:
+            with open(self._path(key), "rb") as f:
+                # Stat the open file, so the etag is consistent with the data read even if replaced meanwhile
+                existing_etag = _etag_from_stat(os.fstat(f.fileno()))
+                if etag is not None and etag != existing_etag:
+                    raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+                return f.read()
+        except (FileNotFoundError, NotADirectoryError) as e:
+            if etag is None:
+                return None
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+
+    def download_buffer(self, key: str, etag: Optional[str]) -> memoryview:
+        try:
+            with open(self._path(key), "rb") as f:
+                stat = os.fstat(f.fileno())
+                if etag is not None and etag != _etag_from_stat(stat):
+                    raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+                if stat.st_size == 0:
+                    return memoryview(b"")  # Empty files can't be mapped
+                # Writes replace the file rather than modifying it, so the mapping is never changed
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (FileNotFoundError, NotADirectoryError) as e:
+            if etag is None:
+                return None
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        try:
+            with open(self._path(key), "rb") as f:
+                stat = os.fstat(f.fileno())
+                existing_etag = _etag_from_stat(stat)
+                if etag is not None and etag != existing_etag:
+                    raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+                offset, stop = resolve_range(start, end, stat.st_size)
+                f.seek(offset)
+                return DownloadedRange(data=f.read(stop - offset), size=stat.st_size, etag=existing_etag)
+        except (FileNotFoundError, NotADirectoryError) as e:
+            if etag is None:
+                return None
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        try:
+            with open(self._path(key), "rb") as f:
+                existing_etag = _etag_from_stat(os.fstat(f.fileno()))
+                if etag == existing_etag:
+                    return None, existing_etag
+                return f.read(), existing_etag
+        except (FileNotFoundError, NotADirectoryError):
+            return None, None
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def get_etag(self, key: str) -> Optional[str]:
+        return self._existing_etag(self._path(key))
+
+    def upload_data(self, key: str, etag: str, data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        path = self._path(key)
+        # Write the data outside of the lock, then atomically rename it into place if the etag matches
+        temp_path = self._write_temp_file(os.path.dirname(path), data)
+        try:
+            with self._locked():
+                if etag != self._existing_etag(path):
+                    raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+                os.replace(temp_path, path)
+                return _etag_from_stat(os.stat(path))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        path = self._path(key)
+        try:
+            source = open(self._path(source_key), "rb")
+        except (FileNotFoundError, NotADirectoryError) as e:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag) from e
+        with source:
+            if source_etag is not None and source_etag != _etag_from_stat(os.fstat(source.fileno())):
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag)
+            # Copy the file outside of the lock, then atomically rename it into place as for uploads
+            temp_path = self._write_temp_file(os.path.dirname(path), b"")
+            try:
+                with open(temp_path, "wb") as f:
+                    shutil.copyfileobj(source, f)
+                with self._locked():
+                    if etag != self._existing_etag(path):
+                        raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+                    os.replace(temp_path, path)
+                    return _etag_from_stat(os.stat(path))
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        if etag is None:
+            return self.upload_data(key=key, etag=etag, data=data)
+        path = self._path(key)
+        try:
+            existing = open(path, "rb")
+        except (FileNotFoundError, NotADirectoryError) as e:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag) from e
+        with existing:
+            if etag != _etag_from_stat(os.fstat(existing.fileno())):
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+            # Files mapped into memory must never change, so append to a copy and rename it into place
+            temp_path = self._write_temp_file(os.path.dirname(path), b"")
+            try:
+                with open(temp_path, "wb") as f:
+                    shutil.copyfileobj(existing, f)
+                    f.write(data)
+                with self._locked():
+                    if etag != self._existing_etag(path):
+                        raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+                    os.replace(temp_path, path)
+                    return _etag_from_stat(os.stat(path))
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def delete_data(self, key: str, etag: str) -> None:
+        path = self._path(key)
+        with self._locked():
+            existing_etag = self._existing_etag(path)
+            if existing_etag is None or etag != existing_etag:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+            os.remove(path)
+            self._remove_empty_parents(path)
+
+    def _scan(self, directory: str, encoded_directory: str, name_prefix: str) -> Iterator[Tuple[str, os.DirEntry]]:
+        try:
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for entry in entries:
+            segment = "" if entry.name == _empty_segment_name else entry.name
+            if entry.name.startswith(_internal_file_marker) or not segment.startswith(name_prefix):
+                continue
+            encoded_key = encoded_directory + segment
+            if entry.is_dir(follow_symlinks=False):
+                yield from self._scan(entry.path, encoded_key + "/", "")
+            else:
+                yield encoded_key, entry
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        if delimiter != "/":
+            return super().list_keys_and_stats_delimited(key_prefix, delimiter)
+        # Directories are the levels of the key space, so only scan the directory the prefix is within
+        directory, separator, name_prefix = (key_prefix or "").rpartition("/")
+        encoded_directory = directory + separator
+        try:
+            entries = list(os.scandir(self._directory_path(directory, separator)))
+        except (FileNotFoundError, NotADirectoryError):
+            return {}, []
+        keys_and_stats, prefixes = {}, []
+        for entry in entries:
+            segment = "" if entry.name == _empty_segment_name else entry.name
+            if entry.name.startswith(_internal_file_marker) or not segment.startswith(name_prefix):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    prefixes.append(encoded_directory + segment + "/")
+                else:
+                    keys_and_stats[encoded_directory + segment] = _key_stat(entry.stat(follow_symlinks=False))
+            except FileNotFoundError:
+                pass  # Deleted since scanning
+        return keys_and_stats, prefixes
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        keys_and_stats, prefixes = self.list_keys_and_stats_delimited(key_prefix, delimiter)
+        return {k: stat.etag for k, stat in keys_and_stats.items()}, prefixes
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        # Only scan the deepest directory the prefix fully specifies, filtering it by the remaining name
+        directory, separator, name_prefix = (key_prefix or "").rpartition("/")
+        encoded_directory = directory + separator
+        keys_and_stats = {}
+        for encoded_key, entry in self._scan(
+            self._directory_path(directory, separator), encoded_directory, name_prefix
+        ):
+            try:
+                keys_and_stats[encoded_key] = _key_stat(entry.stat(follow_symlinks=False))
+            except FileNotFoundError:
+                pass  # Deleted since scanning
+        return keys_and_stats
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return {k: stat.etag for k, stat in self.list_keys_and_stats(key_prefix).items()}
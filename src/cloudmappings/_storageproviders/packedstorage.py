@@ -0,0 +1,471 @@
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
+from uuid import uuid4
+
+from cloudmappings.errors import KeySyncError
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider, resolve_range
+
+logger = logging.getLogger(__name__)
+
+R = TypeVar("R")
+
+# Ranges of the same pack are read with a single request when the bytes between them are fewer than this
+_max_range_gap = 64 * 1024
+
+
+class _Entry(NamedTuple):
+    """The location of a value within a pack"""
+
+    pack: str
+    offset: int
+    length: int
+    etag: str
+
+
+class _Change(NamedTuple):
+    """A conditional change to an entry of the index"""
+
+    expected_etag: Optional[str]
+    entry: Optional[_Entry]  # None to delete the key
+    expected_pack: Optional[str] = None  # Only change the entry while it is in this pack, when relocating
+
+
+def _dump_index(entries: Dict[str, _Entry]) -> bytes:
+    # Pack names are repeated across many entries, so are stored once and referenced by position
+    packs = {}
+    rows = {k: [packs.setdefault(e.pack, len(packs)), e.offset, e.length, e.etag] for k, e in entries.items()}
+    return zlib.compress(json.dumps({"packs": list(packs), "entries": rows}, separators=(",", ":")).encode("utf-8"))
+
+
+def _load_index(data: bytes) -> Dict[str, _Entry]:
+    index = json.loads(zlib.decompress(data).decode("utf-8"))
+    packs = index["packs"]
+    return {k: _Entry(packs[p], offset, length, etag) for k, (p, offset, length, etag) in index["entries"].items()}
+
+
+class _Batch:
+    """Writes waiting to be uploaded together"""
+
+    def __init__(self) -> None:
+        self.writes: Dict[str, Tuple[Optional[str], bytes]] = {}
+        self.size = 0
+        self.done = False
+        self.etags: Dict[str, str] = {}
+        self.errors: Dict[str, BaseException] = {}
+
+    def accepts(self, key: str, size: int, pack_size: int) -> bool:
+        return key not in self.writes and (not self.writes or self.size + size <= pack_size)
+
+
+class PackedStorageProvider(StorageProvider):
+    def __init__(
+        self,
+        storage_provider: StorageProvider,
+        prefix: str = "packed/",
+        pack_size: int = 4 * 1024 * 1024,
+        index_shards: int = 64,
+        revalidate: bool = True,
+        compaction_interval: Optional[float] = None,
+        max_workers: int = 16,
+    ) -> None:
+        if index_shards < 1:
+            raise ValueError(f"index_shards must be at least 1, got {index_shards}")
+        self._storage_provider = storage_provider
+        self._prefix = prefix
+        self._pack_size = pack_size
+        self._index_shards = index_shards
+        self._index_width = len(f"{index_shards - 1:x}")
+        self._revalidate = revalidate
+        self._max_workers = max_workers
+
+        # Each index shard as last read or written, with the etag of its object
+        self._shards: Dict[int, Tuple[Optional[str], Dict[str, _Entry]]] = {}
+        self._shards_lock = threading.Lock()
+
+        # Writes made while a batch is being uploaded wait, and are uploaded together in the next batch
+        self._batch_condition = threading.Condition()
+        self._open_batch = _Batch()
+        self._uploading = False
+
+        if compaction_interval is not None:
+            thread = threading.Thread(
+                target=self._compact_periodically,
+                args=(compaction_interval,),
+                name="cloudmappings-compaction",
+                daemon=True,
+            )
+            thread.start()
+
+    @property
+    def wrapped_storage_provider(self) -> StorageProvider:
+        return self._storage_provider
+
+    def logical_name(self) -> str:
+        return f"CloudStorageProvider=Packed,Prefix={self._prefix},Storage=({self._storage_provider.logical_name()})"
+
+    def create_if_not_exists(self) -> bool:
+        return self._storage_provider.create_if_not_exists()
+
+    def encode_key(self, unsafe_key) -> str:
+        # Keys are stored within the index rather than as the names of objects, so need no encoding
+        return unsafe_key
+
+    def decode_key(self, encoded_key) -> str:
+        return encoded_key
+
+    def is_retryable_error(self, error: BaseException) -> bool:
+        return self._storage_provider.is_retryable_error(error)
+
+    def _concurrently(self, request: Callable[..., R], items: Iterable) -> List[R]:
+        items = list(items)
+        if len(items) <= 1:
+            return [request(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, len(items))) as executor:
+            return list(executor.map(request, items))
+
+    def _index_name(self, shard: int) -> str:
+        return self._storage_provider.encode_key(f"{self._prefix}index/{shard:0{self._index_width}x}")
+
+    def _pack_name(self, pack: str) -> str:
+        return self._storage_provider.encode_key(f"{self._prefix}packs/{pack}")
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % self._index_shards
+
+    def _load_shard(self, shard: int, refresh: bool = True) -> Tuple[Optional[str], Dict[str, _Entry]]:
+        # Shards are cached with the etag they were read at, so are only downloaded again once changed.
+        # Cached entries are replaced rather than modified, so may be read without holding the lock.
+        with self._shards_lock:
+            cached = self._shards.get(shard)
+        if cached is not None and not refresh:
+            return cached
+        cached_etag, entries = cached if cached is not None else (None, {})
+        data, etag = self._storage_provider.download_data_if_changed(key=self._index_name(shard), etag=cached_etag)
+        if etag is None:
+            entries = {}
+        elif data is not None:
+            entries = _load_index(data)
+        with self._shards_lock:
+            self._shards[shard] = (etag, entries)
+        return etag, entries
+
+    def _update_shard(self, shard: int, changes: Dict[str, _Change]) -> Dict[str, BaseException]:
+        while True:
+            index_etag, entries = self._load_shard(shard)
+            entries = dict(entries)
+            errors = {}
+            for key, change in changes.items():
+                existing = entries.get(key)
+                existing_etag = None if existing is None else existing.etag
+                if (
+                    change.expected_etag != existing_etag
+                    or (change.entry is None and existing is None)
+                    or (change.expected_pack is not None and change.expected_pack != existing.pack)
+                ):
+                    errors[key] = KeySyncError(
+                        storage_provider_name=self.logical_name(), key=key, etag=change.expected_etag
+                    )
+                elif change.entry is None:
+                    del entries[key]
+                else:
+                    entries[key] = change.entry
+            if len(errors) == len(changes):
+                return errors
+            try:
+                new_etag = self._storage_provider.upload_data(
+                    key=self._index_name(shard), etag=index_etag, data=_dump_index(entries)
+                )
+            except KeySyncError:
+                continue  # The shard was changed by another client since read, so apply the changes again
+            with self._shards_lock:
+                self._shards[shard] = (new_etag, entries)
+            return errors
+
+    def _update_index(self, changes: Dict[str, _Change]) -> Dict[str, BaseException]:
+        # Each shard is read and written once for all of its changes, with the shards updated concurrently
+        by_shard: Dict[int, Dict[str, _Change]] = defaultdict(dict)
+        for key, change in changes.items():
+            by_shard[self._shard(key)][key] = change
+        errors = {}
+        for shard_errors in self._concurrently(lambda shard: self._update_shard(shard, by_shard[shard]), by_shard):
+            errors.update(shard_errors)
+        return errors
+
+    def _lookup(self, key: str, etag: Optional[str], refresh: bool) -> Optional[_Entry]:
+        entry = self._load_shard(self._shard(key), refresh=refresh)[1].get(key)
+        if etag is not None and (entry is None or entry.etag != etag) and not refresh:
+            # The cached index may be stale
+            entry = self._load_shard(self._shard(key))[1].get(key)
+        if etag is not None and (entry is None or entry.etag != etag):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        return entry
+
+    def _read(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> Optional[DownloadedRange]:
+        refresh = self._revalidate
+        while True:
+            entry = self._lookup(key, etag, refresh)
+            if entry is None:
+                return None
+            offset, stop = resolve_range(start, end, entry.length)
+            if offset == stop:
+                return DownloadedRange(data=b"", size=entry.length, etag=entry.etag)
+            # Packs are never modified, so need no etag
+            downloaded = self._storage_provider.download_range(
+                key=self._pack_name(entry.pack), etag=None, start=entry.offset + offset, end=entry.offset + stop
+            )
+            if downloaded is not None:
+                return DownloadedRange(data=downloaded.data, size=entry.length, etag=entry.etag)
+            if refresh:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+            # The value has been moved by compaction since the index was read, so read the index again
+            refresh = True
+
+    def download_data(self, key: str, etag: str) -> bytes:
+        downloaded = self._read(key, etag, 0, None)
+        return None if downloaded is None else downloaded.data
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        return self._read(key, etag, start, end)
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        entry = self._lookup(key, None, refresh=True)
+        if entry is None:
+            return None, None
+        if entry.etag == etag:
+            return None, etag
+        try:
+            return self.download_data(key, entry.etag), entry.etag
+        except KeySyncError:
+            return self.download_data_if_changed(key, etag)  # Changed again since the index was read
+
+    def download_many(
+        self, keys_and_etags: Dict[str, Optional[str]], max_workers: int = 16
+    ) -> Dict[str, Optional[bytes]]:
+        # Read the index once for all keys, then read the values of each pack together
+        shards = {self._shard(key) for key in keys_and_etags}
+        if self._revalidate:
+            self._concurrently(self._load_shard, shards)
+        entries = {key: self._lookup(key, etag, refresh=False) for key, etag in keys_and_etags.items()}
+
+        by_pack: Dict[str, List[Tuple[str, _Entry]]] = defaultdict(list)
+        for key, entry in entries.items():
+            if entry is not None:
+                by_pack[entry.pack].append((key, entry))
+        ranges = []
+        for pack, pack_entries in by_pack.items():
+            # Values written together are adjacent, so coalesce the ranges of values close to each other
+            pack_entries.sort(key=lambda e: e[1].offset)
+            current = [pack_entries[0]]
+            for key, entry in pack_entries[1:]:
+                last = current[-1][1]
+                if entry.offset - (last.offset + last.length) <= _max_range_gap:
+                    current.append((key, entry))
+                else:
+                    ranges.append(current)
+                    current = [(key, entry)]
+            ranges.append(current)
+
+        def read_range(range_entries: List[Tuple[str, _Entry]]) -> Dict[str, bytes]:
+            start = range_entries[0][1].offset
+            stop = max(entry.offset + entry.length for _, entry in range_entries)
+            downloaded = self._storage_provider.download_range(
+                key=self._pack_name(range_entries[0][1].pack), etag=None, start=start, end=stop
+            )
+            if downloaded is None:
+                # Moved by compaction since the index was read, so read each value again from the index
+                return {key: self.download_data(key, keys_and_etags[key]) for key, _ in range_entries}
+            return {
+                key: downloaded.data[entry.offset - start : entry.offset - start + entry.length]
+                for key, entry in range_entries
+            }
+
+        downloaded: Dict[str, Optional[bytes]] = {key: None for key in keys_and_etags}
+        for values in self._concurrently(read_range, ranges):
+            downloaded.update(values)
+        return downloaded
+
+    def exists(self, key: str) -> bool:
+        return self._lookup(key, None, refresh=True) is not None
+
+    def get_etag(self, key: str) -> Optional[str]:
+        entry = self._lookup(key, None, refresh=True)
+        return None if entry is None else entry.etag
+
+    def _split_into_packs(self, keys_and_sizes: Iterable[Tuple[str, int]]) -> List[List[str]]:
+        packs: List[List[str]] = [[]]
+        pack_size = 0
+        for key, size in keys_and_sizes:
+            if packs[-1] and pack_size + size > self._pack_size:
+                packs.append([])
+                pack_size = 0
+            packs[-1].append(key)
+            pack_size += size
+        return [keys for keys in packs if keys]
+
+    def _write_pack(self, keys_and_data: List[Tuple[str, bytes]]) -> Dict[str, _Entry]:
+        # Named by the time they were written, so compaction can tell the packs that may be about to be indexed
+        pack = f"{time.time_ns():016x}-{uuid4().hex}"
+        entries = {}
+        offset = 0
+        for key, data in keys_and_data:
+            entries[key] = _Entry(pack, offset, len(data), f"{pack}-{offset:x}")
+            offset += len(data)
+        self._storage_provider.upload_data(
+            key=self._pack_name(pack), etag=None, data=b"".join(data for _, data in keys_and_data)
+        )
+        return entries
+
+    def upload_many(
+        self, keys_etags_and_data: Dict[str, Tuple[Optional[str], bytes]], max_workers: int = 16
+    ) -> Tuple[Dict[str, str], Dict[str, BaseException]]:
+        errors: Dict[str, BaseException] = {}
+        for key, (_, data) in keys_etags_and_data.items():
+            if not isinstance(data, bytes):
+                errors[key] = ValueError(f"Data must be bytes like, got {type(data)}")
+        packs = self._split_into_packs(
+            (key, len(data)) for key, (_, data) in keys_etags_and_data.items() if key not in errors
+        )
+
+        # Write the packs first, so the index never refers to a pack that does not exist. Packs left without
+        # entries, if the index can't be updated, are deleted by compaction.
+        def write_pack(keys: List[str]) -> Dict[str, _Change]:
+            try:
+                entries = self._write_pack([(key, keys_etags_and_data[key][1]) for key in keys])
+            except Exception as e:
+                errors.update({key: e for key in keys})
+                return {}
+            return {key: _Change(keys_etags_and_data[key][0], entry) for key, entry in entries.items()}
+
+        changes = {}
+        for pack_changes in self._concurrently(write_pack, packs):
+            changes.update(pack_changes)
+        try:
+            errors.update(self._update_index(changes))
+        except Exception as e:
+            errors.update({key: e for key in changes})
+        etags = {key: change.entry.etag for key, change in changes.items() if key not in errors}
+        return etags, errors
+
+    def upload_data(self, key: str, etag: str, data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        with self._batch_condition:
+            while not self._open_batch.accepts(key, len(data), self._pack_size):
+                self._batch_condition.wait()
+            batch = self._open_batch
+            batch.writes[key] = (etag, data)
+            batch.size += len(data)
+            # The first writer to find no batch uploading uploads the open batch, including the writes
+            # of any others that joined it, while later writers join the next batch
+            while not batch.done:
+                if self._uploading:
+                    self._batch_condition.wait()
+                    continue
+                self._uploading = True
+                self._open_batch = _Batch()
+                self._batch_condition.notify_all()
+                self._batch_condition.release()
+                try:
+                    try:
+                        batch.etags, batch.errors = self.upload_many(batch.writes, max_workers=self._max_workers)
+                    except Exception as e:
+                        batch.errors = {k: e for k in batch.writes}
+                finally:
+                    self._batch_condition.acquire()
+                    batch.done = True
+                    self._uploading = False
+                    self._batch_condition.notify_all()
+        if key in batch.errors:
+            raise batch.errors[key]
+        return batch.etags[key]
+
+    def delete_data(self, key: str, etag: str) -> None:
+        errors = self._update_index({key: _Change(etag, None)})
+        if key in errors:
+            raise errors[key]
+
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        return self._update_index({key: _Change(etag, None) for key, etag in keys_and_etags.items()})
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        keys_and_stats = {}
+        for _, entries in self._concurrently(self._load_shard, range(self._index_shards)):
+            for k, e in entries.items():
+                if k.startswith(key_prefix or ""):
+                    # Packs are named by the time they were written, which compaction updates as it rewrites them
+                    written = datetime.fromtimestamp(int(e.pack.split("-", 1)[0], 16) / 1e9, tz=timezone.utc)
+                    keys_and_stats[k] = KeyStat(e.etag, e.length, written)
+        return keys_and_stats
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return {k: stat.etag for k, stat in self.list_keys_and_stats(key_prefix).items()}
+
+    def compact(self, min_garbage_ratio: float = 0.5, grace: float = 600.0) -> int:
+        live: Dict[str, List[Tuple[str, _Entry]]] = defaultdict(list)
+        for _, entries in self._concurrently(self._load_shard, range(self._index_shards)):
+            for key, entry in entries.items():
+                live[entry.pack].append((key, entry))
+        packs_prefix = self._storage_provider.encode_key(f"{self._prefix}packs/")
+        packs = {
+            self._storage_provider.decode_key(name)[len(f"{self._prefix}packs/") :]: etag
+            for name, etag in self._storage_provider.list_keys_and_etags(packs_prefix).items()
+        }
+        # Packs written recently may be about to be indexed, so are left alone
+        cutoff = time.time_ns() - int(grace * 1e9)
+        packs = {pack: etag for pack, etag in packs.items() if int(pack.split("-", 1)[0], 16) < cutoff}
+
+        def garbage_ratio(pack: str) -> float:
+            if not live[pack]:
+                return 1.0
+            size = self._storage_provider.download_range(key=self._pack_name(pack), etag=None, start=0, end=0).size
+            return 1 - sum(entry.length for _, entry in live[pack]) / size
+
+        ratios = dict(zip(packs, self._concurrently(garbage_ratio, packs)))
+        compacted = [pack for pack, ratio in ratios.items() if ratio >= min_garbage_ratio]
+
+        # Rewrite the values still live in the packs compacted into new packs, keeping their etags
+        def read_live(pack: str) -> Dict[str, Tuple[_Entry, bytes]]:
+            if not live[pack]:
+                return {}
+            data = self._storage_provider.download_data(key=self._pack_name(pack), etag=packs[pack])
+            return {key: (entry, data[entry.offset : entry.offset + entry.length]) for key, entry in live[pack]}
+
+        relocating: Dict[str, Tuple[_Entry, bytes]] = {}
+        for values in self._concurrently(read_live, compacted):
+            relocating.update(values)
+        packs_relocated_to = self._split_into_packs((key, len(data)) for key, (_, data) in relocating.items())
+        changes = {}
+        for entries in self._concurrently(
+            lambda keys: self._write_pack([(key, relocating[key][1]) for key in keys]), packs_relocated_to
+        ):
+            for key, entry in entries.items():
+                previous = relocating[key][0]
+                changes[key] = _Change(previous.etag, entry._replace(etag=previous.etag), expected_pack=previous.pack)
+        # Entries changed since read no longer refer to the packs compacted, so need not be relocated
+        errors = self._update_index(changes)
+        if not all(isinstance(e, KeySyncError) for e in errors.values()):
+            raise next(e for e in errors.values() if not isinstance(e, KeySyncError))
+
+        def delete_pack(pack: str) -> None:
+            try:
+                self._storage_provider.delete_data(key=self._pack_name(pack), etag=packs[pack])
+            except KeySyncError:
+                pass  # Deleted by another compaction
+
+        self._concurrently(delete_pack, compacted)
+        return len(compacted)
+
+    def _compact_periodically(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("Compaction of packed storage failed")
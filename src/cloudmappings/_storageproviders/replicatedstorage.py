@@ -0,0 +1,272 @@
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Deque, Dict, List, Optional, Sequence
+
+from cloudmappings.errors import KeySyncError, PartialWriteError
+from cloudmappings.storageprovider import KeyStat, StorageProvider
+
+
+class ReplicatedStorageProvider(StorageProvider):
+    def __init__(
+        self,
+        replicas: Sequence[StorageProvider],
+        hedge_percentile: float = 95.0,
+        initial_hedge_delay: float = 0.05,
+        latency_window: int = 1000,
+        min_latency_samples: int = 20,
+        max_workers: int = 32,
+    ) -> None:
+        if not replicas:
+            raise ValueError("At least one replica is required")
+        self._replicas = list(replicas)
+        self._hedge_percentile = hedge_percentile
+        self._initial_hedge_delay = initial_hedge_delay
+        self._min_latency_samples = min_latency_samples
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cloudmappings-replicated")
+
+        self._lock = threading.Lock()
+        self._latencies: List[Deque[float]] = [deque(maxlen=latency_window) for _ in self._replicas]
+        self._hedge_delays: List[Optional[float]] = [None] * len(self._replicas)
+        self.hedged_requests = 0
+        """Number of reads for which a hedged request was sent to another replica"""
+
+    @property
+    def replicas(self) -> List[StorageProvider]:
+        return list(self._replicas)
+
+    def logical_name(self) -> str:
+        return "CloudStorageProvider=Replicated," f"Replicas=({'; '.join(r.logical_name() for r in self._replicas)})"
+
+    def encode_key(self, unsafe_key) -> str:
+        # Keys are encoded for the first replica, and re-encoded for each of the others
+        return self._replicas[0].encode_key(unsafe_key)
+
+    def decode_key(self, encoded_key) -> str:
+        return self._replicas[0].decode_key(encoded_key)
+
+    def _replica_key(self, replica: int, key: str) -> str:
+        if replica == 0:
+            return key
+        return self._replicas[replica].encode_key(self.decode_key(key))
+
+    def _split_etag(self, key: str, etag: Optional[str]) -> List[Optional[str]]:
+        # The etag of a replicated value is the json list of the etag in each replica, with
+        # null for replicas that do not have the key
+        if etag is None:
+            return [None] * len(self._replicas)
+        try:
+            etags = json.loads(etag)
+        except ValueError:
+            etags = None
+        if not isinstance(etags, list) or len(etags) != len(self._replicas):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        return etags
+
+    @staticmethod
+    def _join_etags(etags: List[Optional[str]]) -> str:
+        return json.dumps(etags, separators=(",", ":"))
+
+    def _record_latency(self, replica: int, latency: float) -> None:
+        with self._lock:
+            latencies = self._latencies[replica]
+            latencies.append(latency)
+            # Recomputing the percentile is O(n log n), so only refresh it every few samples
+            if len(latencies) >= self._min_latency_samples and len(latencies) % 10 == 0:
+                ordered = sorted(latencies)
+                index = min(len(ordered) - 1, int(len(ordered) * self._hedge_percentile / 100))
+                self._hedge_delays[replica] = ordered[index]
+
+    def _hedge_delay(self, replica: int) -> float:
+        delay = self._hedge_delays[replica]
+        return self._initial_hedge_delay if delay is None else delay
+
+    def latency_percentile(self, replica: int, percentile: float) -> Optional[float]:
+        """Gets a percentile of the recent read latencies of a replica, in seconds, or `None` if
+        no reads from it have completed"""
+        with self._lock:
+            ordered = sorted(self._latencies[replica])
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def _timed_download(self, replica: int, key: str, etag: Optional[str]) -> bytes:
+        start = time.perf_counter()
+        data = self._replicas[replica].download_data(key=self._replica_key(replica, key), etag=etag)
+        # Hedged requests that lose are still recorded once they complete, so slow replicas are measured
+        self._record_latency(replica, time.perf_counter() - start)
+        return data
+
+    def _fan_out(self, submit) -> list:
+        # Runs a request against every replica concurrently, raising the first error once all complete
+        futures: List[Future] = [self._executor.submit(submit, i) for i in range(len(self._replicas))]
+        wait(futures)
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            raise next((e for e in errors if isinstance(e, KeySyncError)), errors[0])
+        return [f.result() for f in futures]
+
+    def _fan_out_write(self, key: str, etags: List[Optional[str]], submit) -> List[Optional[str]]:
+        # As _fan_out, for a write returning the new etag in each replica. When only some replicas were written
+        # they have diverged, so the etag of the key as it now is is raised, for the caller to repair them
+        futures: List[Future] = [self._executor.submit(submit, i) for i in range(len(self._replicas))]
+        wait(futures)
+        errors = {i: f.exception() for i, f in enumerate(futures) if f.exception() is not None}
+        written = [etags[i] if i in errors else f.result() for i, f in enumerate(futures)]
+        if errors and written == etags:
+            # Nothing was written, so the replicas are as they were
+            raise next((e for e in errors.values() if isinstance(e, KeySyncError)), next(iter(errors.values())))
+        if errors:
+            etag = None if all(e is None for e in written) else self._join_etags(written)
+            expected_etag = None if all(e is None for e in etags) else self._join_etags(etags)
+            raise PartialWriteError(
+                storage_provider_name=self.logical_name(),
+                key=key,
+                expected_etag=expected_etag,
+                etag=etag,
+                errors=errors,
+            ) from next(iter(errors.values()))
+        return written
+
+    def is_retryable_error(self, error: BaseException) -> bool:
+        return any(r.is_retryable_error(error) for r in self._replicas)
+
+    def create_if_not_exists(self):
+        return all(self._fan_out(lambda i: self._replicas[i].create_if_not_exists()))
+
+    def download_data(self, key: str, etag: str) -> bytes:
+        etags = self._split_etag(key, etag)
+        # Try the replicas expected to be fastest first, skipping those that don't have the key
+        candidates = sorted(
+            (i for i in range(len(self._replicas)) if etag is None or etags[i] is not None),
+            key=self._hedge_delay,
+        )
+        if not candidates:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+
+        pending: Dict[Future, int] = {}
+        errors = []
+        last_started = None
+
+        def start_next() -> None:
+            nonlocal last_started
+            if candidates:
+                last_started = candidates.pop(0)
+                future = self._executor.submit(self._timed_download, last_started, key, etags[last_started])
+                pending[future] = last_started
+
+        start_next()
+        while pending:
+            # Once the latest request has taken longer than the percentile of its replica's latency, hedge
+            timeout = self._hedge_delay(last_started) if candidates else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                with self._lock:
+                    self.hedged_requests += 1
+                start_next()
+                continue
+            for future in done:
+                del pending[future]
+                error = future.exception()
+                if error is None:
+                    return future.result()
+                if isinstance(error, KeySyncError):
+                    # Every replica is written to, so a changed value in one means the key has been modified
+                    raise error
+                errors.append(error)
+                start_next()
+        raise errors[0]
+
+    def exists(self, key: str) -> bool:
+        # As when listing, a key exists if it is in any replica
+        return any(self._fan_out(lambda i: self._replicas[i].exists(self._replica_key(i, key))))
+
+    def get_etag(self, key: str) -> Optional[str]:
+        etags = self._fan_out(lambda i: self._replicas[i].get_etag(self._replica_key(i, key)))
+        return None if all(e is None for e in etags) else self._join_etags(etags)
+
+    def upload_data(self, key: str, etag: str, data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        etags = self._split_etag(key, etag)
+        return self._join_etags(
+            self._fan_out_write(
+                key,
+                etags,
+                lambda i: self._replicas[i].upload_data(key=self._replica_key(i, key), etag=etags[i], data=data),
+            )
+        )
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        source_etags = self._split_etag(source_key, source_etag)
+        if source_etag is not None and any(e is None for e in source_etags):
+            # A replica without the source can't copy it, so copy the value through the client instead
+            return super().copy_data(source_key=source_key, source_etag=source_etag, key=key, etag=etag)
+        etags = self._split_etag(key, etag)
+        return self._join_etags(
+            self._fan_out_write(
+                key,
+                etags,
+                lambda i: self._replicas[i].copy_data(
+                    source_key=self._replica_key(i, source_key),
+                    source_etag=source_etags[i],
+                    key=self._replica_key(i, key),
+                    etag=etags[i],
+                ),
+            )
+        )
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        etags = self._split_etag(key, etag)
+        if etag is not None and any(e is None for e in etags):
+            # A replica without the value can't append to it, so write the whole value instead
+            return super().append_data(key=key, etag=etag, data=data)
+        return self._join_etags(
+            self._fan_out_write(
+                key,
+                etags,
+                lambda i: self._replicas[i].append_data(key=self._replica_key(i, key), etag=etags[i], data=data),
+            )
+        )
+
+    def delete_data(self, key: str, etag: str) -> None:
+        etags = self._split_etag(key, etag)
+        if all(e is None for e in etags):
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+
+        def delete(i: int) -> None:
+            # Replicas that do not have the key are already in the desired state
+            if etags[i] is not None:
+                self._replicas[i].delete_data(key=self._replica_key(i, key), etag=etags[i])
+
+        self._fan_out_write(key, etags, delete)
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        listings = self._fan_out(
+            lambda i: self._replicas[i].list_keys_and_stats(
+                self._replica_key(i, key_prefix) if key_prefix else key_prefix
+            )
+        )
+        keys_and_stats: Dict[str, List[Optional[KeyStat]]] = {}
+        for i, listing in enumerate(listings):
+            for replica_key, replica_stat in listing.items():
+                key = replica_key if i == 0 else self.encode_key(self._replicas[i].decode_key(replica_key))
+                keys_and_stats.setdefault(key, [None] * len(self._replicas))[i] = replica_stat
+        joined = {}
+        for key, stats in keys_and_stats.items():
+            # The size is that of the first replica with the key, and the value was last modified by the latest write
+            listed = [stat for stat in stats if stat is not None]
+            modified = [stat.last_modified for stat in listed if stat.last_modified is not None]
+            joined[key] = KeyStat(
+                self._join_etags([None if stat is None else stat.etag for stat in stats]),
+                listed[0].size,
+                max(modified) if modified else None,
+            )
+        return joined
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return {k: stat.etag for k, stat in self.list_keys_and_stats(key_prefix).items()}
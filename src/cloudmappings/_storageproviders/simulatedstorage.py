@@ -0,0 +1,289 @@
+import bisect
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import count
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from cloudmappings.errors import KeySyncError, ThrottlingError
+from cloudmappings.notifications import ChangeEvent, QueueChangeSource
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider, resolve_range
+
+Latency = Union[float, Callable[[random.Random], float]]
+
+
+class SimulatedStorageProvider(StorageProvider):
+    def __init__(
+        self,
+        name: str = "simulated",
+        latency: Latency = 0.0,
+        bandwidth: Optional[float] = None,
+        requests_per_second: Optional[float] = None,
+        burst: int = 1,
+        failure_rate: float = 0.0,
+        list_page_size: int = 1000,
+        seed: Optional[int] = None,
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._name = name
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._requests_per_second = requests_per_second
+        self._burst = burst
+        self._failure_rate = failure_rate
+        self._list_page_size = list_page_size
+        self._random = random.Random(seed)
+        self._sleep = sleep
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._exists = False
+        self._objects: Dict[str, Tuple[str, bytes]] = {}
+        # The wall clock time each object was last modified, as returned by listings
+        self._last_modified: Dict[str, float] = {}
+        # Keys in order, so listing a prefix only visits the keys beginning with it
+        self._sorted_keys: List[str] = []
+        self._etag_counter = count()
+        self._tokens = float(burst)
+        self._tokens_updated = clock()
+        self.request_counts = Counter()
+        """Number of requests made to the simulated service, by operation. Includes throttled and failed requests."""
+        self._subscriptions: List[QueueChangeSource] = []
+
+    def __reduce__(self):
+        raise TypeError(
+            "A SimulatedStorageProvider can't be pickled, as its values are held in the memory of one process"
+        )
+
+    def logical_name(self) -> str:
+        return "CloudStorageProvider=Simulated," f"Name={self._name}"
+
+    def _take_token(self) -> bool:
+        # Token bucket, refilled at requests_per_second up to a capacity of burst
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._tokens_updated) * self._requests_per_second)
+        self._tokens_updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _request(self, operation: str, key: Optional[str], transferred_bytes: int = 0) -> None:
+        # Models the cost of a single request to the service: throttling, failures, latency and bandwidth
+        with self._lock:
+            self.request_counts[operation] += 1
+            throttled = self._requests_per_second is not None and not self._take_token()
+            failed = self._failure_rate > 0 and self._random.random() < self._failure_rate
+            delay = self._latency(self._random) if callable(self._latency) else self._latency
+        if throttled:
+            raise ThrottlingError(storage_provider_name=self.logical_name(), key=key)
+        if failed:
+            raise ConnectionError(f"Simulated request failure.\nCloud storage: '{self.logical_name()}'\nKey: '{key}'")
+        if self._bandwidth is not None:
+            delay += transferred_bytes / self._bandwidth
+        if delay > 0:
+            self._sleep(delay)
+
+    def _new_etag(self) -> str:
+        return f"{next(self._etag_counter):x}"
+
+    def subscribe(self) -> QueueChangeSource:
+        """Subscribes to notifications of changes, as a cloud storage service publishes to a queue"""
+        subscription = QueueChangeSource()
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def _notify(self, key: str, etag: Optional[str]) -> None:
+        # Called while holding the lock, so notifications are sequenced in the order of changes
+        event = ChangeEvent(key=key, deleted=etag is None, etag=etag, sequencer=self._new_etag())
+        for subscription in self._subscriptions:
+            subscription.put(event)
+
+    def create_if_not_exists(self):
+        self._request("create_if_not_exists", None)
+        with self._lock:
+            already_exists = self._exists
+            self._exists = True
+        return already_exists
+
+    def download_data(self, key: str, etag: str) -> bytes:
+        with self._lock:
+            existing_etag, data = self._objects.get(key, (None, None))
+        self._request("download_data", key, transferred_bytes=0 if data is None else len(data))
+        with self._lock:
+            existing_etag, data = self._objects.get(key, (None, None))
+        if etag is not None and etag != existing_etag:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        return data
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        with self._lock:
+            existing_etag, data = self._objects.get(key, (None, None))
+        offset, stop = resolve_range(start, end, 0 if data is None else len(data))
+        self._request("download_range", key, transferred_bytes=stop - offset)
+        with self._lock:
+            existing_etag, data = self._objects.get(key, (None, None))
+        if etag is not None and etag != existing_etag:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        if data is None:
+            return None
+        offset, stop = resolve_range(start, end, len(data))
+        return DownloadedRange(data=data[offset:stop], size=len(data), etag=existing_etag)
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        with self._lock:
+            existing_etag, data = self._objects.get(key, (None, None))
+        # As with a conditional GET, no data is transferred when the etag is unchanged
+        changed = data is not None and etag != existing_etag
+        self._request("download_data_if_changed", key, transferred_bytes=len(data) if changed else 0)
+        with self._lock:
+            existing_etag, data = self._objects.get(key, (None, None))
+        if data is None or etag == existing_etag:
+            return None, existing_etag
+        return data, existing_etag
+
+    def exists(self, key: str) -> bool:
+        self._request("exists", key)
+        with self._lock:
+            return key in self._objects
+
+    def get_etag(self, key: str) -> Optional[str]:
+        self._request("get_etag", key)
+        with self._lock:
+            existing_etag, _ = self._objects.get(key, (None, None))
+        return existing_etag
+
+    def upload_data(self, key: str, etag: str, data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        self._request("upload_data", key, transferred_bytes=len(data))
+        with self._lock:
+            existing_etag, _ = self._objects.get(key, (None, None))
+            if etag != existing_etag:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+            new_etag = self._new_etag()
+            if existing_etag is None:
+                bisect.insort(self._sorted_keys, key)
+            self._objects[key] = (new_etag, data)
+            self._last_modified[key] = time.time()
+            self._notify(key, new_etag)
+        return new_etag
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        # As a server-side copy, no data is transferred to or from the client
+        self._request("copy_data", key)
+        with self._lock:
+            existing_source_etag, data = self._objects.get(source_key, (None, None))
+            if data is None or (source_etag is not None and source_etag != existing_source_etag):
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag)
+            existing_etag, _ = self._objects.get(key, (None, None))
+            if etag != existing_etag:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+            new_etag = self._new_etag()
+            if existing_etag is None:
+                bisect.insort(self._sorted_keys, key)
+            self._objects[key] = (new_etag, data)
+            self._last_modified[key] = time.time()
+            self._notify(key, new_etag)
+        return new_etag
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        # As an append within the cloud, only the appended data is transferred
+        self._request("append_data", key, transferred_bytes=len(data))
+        with self._lock:
+            existing_etag, existing = self._objects.get(key, (None, b""))
+            if etag != existing_etag:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+            new_etag = self._new_etag()
+            if existing_etag is None:
+                bisect.insort(self._sorted_keys, key)
+            self._objects[key] = (new_etag, existing + data)
+            self._last_modified[key] = time.time()
+            self._notify(key, new_etag)
+        return new_etag
+
+    def delete_data(self, key: str, etag: str) -> None:
+        self._request("delete_data", key)
+        with self._lock:
+            existing_etag, _ = self._objects.get(key, (None, None))
+            if existing_etag is None or etag != existing_etag:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+            self._delete(key)
+
+    def _delete(self, key: str) -> None:
+        # Called while holding the lock
+        del self._objects[key]
+        del self._last_modified[key]
+        del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
+        self._notify(key, None)
+
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        keys = list(keys_and_etags)
+        errors = {}
+        # As a batch API, up to 1000 keys are deleted in each request
+        for i in range(0, len(keys), 1000):
+            batch = keys[i : i + 1000]
+            try:
+                self._request("delete_many", batch[0])
+            except Exception as e:
+                errors.update({k: e for k in batch})
+                continue
+            with self._lock:
+                for key in batch:
+                    existing_etag, _ = self._objects.get(key, (None, None))
+                    if existing_etag is None or keys_and_etags[key] != existing_etag:
+                        errors[key] = KeySyncError(
+                            storage_provider_name=self.logical_name(), key=key, etag=keys_and_etags[key]
+                        )
+                    else:
+                        self._delete(key)
+        return errors
+
+    def _keys_with_prefix(self, key_prefix: str) -> Iterator[str]:
+        key_prefix = key_prefix or ""
+        for i in range(bisect.bisect_left(self._sorted_keys, key_prefix), len(self._sorted_keys)):
+            if not self._sorted_keys[i].startswith(key_prefix):
+                return
+            yield self._sorted_keys[i]
+
+    def _stat(self, key: str) -> KeyStat:
+        # Called while holding the lock
+        etag, data = self._objects[key]
+        return KeyStat(etag, len(data), datetime.fromtimestamp(self._last_modified[key], tz=timezone.utc))
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        keys_and_stats, prefixes = {}, set()
+        with self._lock:
+            for k in self._keys_with_prefix(key_prefix):
+                index = k.find(delimiter, len(key_prefix or ""))
+                if index == -1:
+                    keys_and_stats[k] = self._stat(k)
+                else:
+                    prefixes.add(k[: index + len(delimiter)])
+        # Each page holds both keys and prefixes
+        for _ in range(max(1, -(-(len(keys_and_stats) + len(prefixes)) // self._list_page_size))):
+            self._request("list_keys_and_etags_delimited", key_prefix)
+        return keys_and_stats, sorted(prefixes)
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        keys_and_stats, prefixes = self.list_keys_and_stats_delimited(key_prefix, delimiter)
+        return {k: stat.etag for k, stat in keys_and_stats.items()}, prefixes
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        with self._lock:
+            keys_and_stats = {k: self._stat(k) for k in self._keys_with_prefix(key_prefix)}
+        # Listings are paginated, each page being a separate request
+        for _ in range(max(1, -(-len(keys_and_stats) // self._list_page_size))):
+            self._request("list_keys_and_etags", key_prefix)
+        return keys_and_stats
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return {k: stat.etag for k, stat in self.list_keys_and_stats(key_prefix).items()}
@@ -1,15 +1,30 @@
+import io
 from abc import ABC, abstractmethod
-from typing import Any, Dict, MutableMapping, Optional, TypeVar
+from typing import Any, Callable, Dict, Iterable, Iterator, MutableMapping, NamedTuple, Optional, TypeVar
 
 from cloudmappings.serialisers import CloudMappingSerialisation
-from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.storageprovider import KeyStat, StorageProvider
 
 T = TypeVar("T")
 
 
+class MappedValue(NamedTuple):
+    """The result of a function applied to the value of a key by `CloudMapping.map_values`"""
+
+    key: str
+    """The key whose value the function was applied to"""
+    value: Any
+    """The result of the function, or `None` if it failed or was written to an output mapping"""
+    error: Optional[BaseException]
+    """The error raised reading the value, applying the function or writing the result, if any"""
+
+
 class CloudMapping(MutableMapping[str, T], ABC):
     """A cloud-mapping, a `MutableMapping` implementation backed by common cloud storage solutions.
     Implements the `MutableMapping` interface, can be used just as a standard `dict()`.
+
+    A `CloudMapping` may be shared between threads. Operations on the same key are serialised,
+    so that writes from one thread never cause a `cloudmappings.errors.KeySyncError` in another.
     """
 
     read_blindly: bool
@@ -43,7 +58,7 @@ class CloudMapping(MutableMapping[str, T], ABC):
     """
 
     @abstractmethod
-    def sync_with_cloud(self, key_prefix: str = None) -> None:
+    def sync_with_cloud(self, key_prefix: str = None, max_workers: int = 16, partition: bool = False) -> None:
         """Synchronise this `CloudMapping` with the cloud.
 
         This allows a `CloudMapping` to reflect the most recent updates to the cloud resource,
@@ -60,6 +75,356 @@ class CloudMapping(MutableMapping[str, T], ABC):
         key_prefix : str, optional
             Only sync keys beginning with the specified prefix, the key_prefix configured on the
             mapping is prepended in combination with this parameter.
+        max_workers : int, default=16
+            The maximum number of listings to make concurrently
+        partition : bool, default=False
+            Whether to first discover the layout of the key space with delimiter listings (on "/"),
+            and then list the disjoint prefixes found concurrently. Listings are paginated, so this
+            makes syncing many keys spread across "directories" much faster.
+        """
+        pass
+
+    @abstractmethod
+    def wait_for_sync(self, timeout: Optional[float] = None) -> bool:
+        """Waits for the initial sync of a mapping created with `sync_in_background=True` to finish.
+
+        Until then, keys not yet listed are looked up in the cloud individually as they are used, and
+        methods that need every key, such as `keys()`, `len()`, `values()` and `clear()`, wait for it.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum seconds to wait, waiting indefinitely if not given
+
+        Returns
+        -------
+        bool
+            `True` once the initial sync has finished, or `False` if the timeout expired first
+
+        Raises
+        ------
+        Exception
+            The error that the initial sync failed with, if it did
+        """
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Deletes every key of the mapping from the cloud, without downloading their values.
+
+        Keys are deleted in batches where the storage provider supports it (1000 per request for
+        AWS S3, 256 for Azure Blob Storage and 100 for Google Cloud Storage), and concurrently.
+        As with `del d[key]`, keys whose value in the cloud has changed since being synchronised
+        are not deleted. The other keys are still deleted, and then the error for one of the keys
+        not deleted is raised, such as a `cloudmappings.errors.KeySyncError`.
+        """
+        pass
+
+    @abstractmethod
+    def copy(self, source_key: str, key: str, destination: Optional["CloudMapping[T]"] = None) -> None:
+        """Copies the value of a key to another key, within the cloud rather than through the client.
+
+        Storage providers copy the bytes server-side (AWS S3 `CopyObject`, Azure `Copy Blob` and Google
+        Cloud Storage `rewrite`), so they are never downloaded or uploaded. The copy is conditional on the
+        etags of both keys, as for `d[key]` and `d[key] = value`, and the etag of the copy is synchronised
+        without downloading it. When the destination is a mapping of different storage, the value is
+        downloaded and uploaded instead.
+
+        Parameters
+        ----------
+        source_key : str
+            The key to copy the value of
+        key : str
+            The key to copy the value to
+        destination : CloudMapping, optional
+            The mapping to copy the value to, defaults to this mapping. Values are copied as stored, so
+            it must use the same serialisation
+
+        Raises
+        ------
+        KeyError
+            If the source key is unknown
+        """
+        pass
+
+    @abstractmethod
+    def move(self, source_key: str, key: str, destination: Optional["CloudMapping[T]"] = None) -> None:
+        """Moves the value of a key to another key, copying it as by `copy`, then deleting the source
+        key only if it is unchanged. See `copy`.
+        """
+        pass
+
+    @abstractmethod
+    def copy_prefix(self, source_prefix: str, prefix: str, destination: Optional["CloudMapping[T]"] = None) -> None:
+        """Copies the value of every key beginning with a prefix to the same key beginning with another
+        prefix instead, concurrently, as by `copy`. For example, to copy a "directory" of values into a
+        new version. Only keys known to the mapping (as for `keys()`) are copied.
+
+        Parameters
+        ----------
+        source_prefix : str
+            The prefix of the keys to copy
+        prefix : str
+            The prefix replacing the source prefix of each key copied to
+        destination : CloudMapping, optional
+            The mapping to copy the values to, defaults to this mapping
+        """
+        pass
+
+    @abstractmethod
+    def transform(
+        self, key: str, fn: Callable[[T], T], max_retries: int = 16, backoff: float = 0.01, default: T = ...
+    ) -> T:
+        """Atomically replaces the value of a key with the result of a function of its latest value.
+
+        The latest value and etag of the key are read in a single request, without syncing any other key,
+        and the result of `fn` is written conditionally on that etag. If another writer changed the key in
+        between, the write fails and is retried with the new latest value, after waiting a random time up
+        to `backoff` seconds, doubling after each retry. Writers that contend are so spread out, rather
+        than all retrying together. `fn` may be called many times, so it should have no side effects.
+
+        For example, `cm.transform("counter", lambda n: n + 1, default=0)` increments a counter shared
+        by many processes without losing any increments.
+
+        Parameters
+        ----------
+        key : str
+            The key to transform the value of
+        fn : Callable[[T], T]
+            The function from the current value to the new value
+        max_retries : int, default=16
+            The maximum number of times to retry after the write fails due to contention
+        backoff : float, default=0.01
+            Seconds of the maximum wait before the first retry
+        default : T, optional
+            The value to pass to `fn` if the key has no value in the cloud
+
+        Returns
+        -------
+        T
+            The new value written
+
+        Raises
+        ------
+        KeyError
+            If the key has no value in the cloud and no `default` is given
+        KeySyncError
+            If the write still fails after `max_retries` retries
+        """
+        pass
+
+    @abstractmethod
+    def map_values(
+        self,
+        fn: Callable[[T], Any],
+        keys: Optional[Iterable[str]] = None,
+        prefix: Optional[str] = None,
+        out: Optional[MutableMapping[str, Any]] = None,
+        processes: Optional[int] = None,
+        threads_per_process: int = 16,
+    ) -> Iterator[MappedValue]:
+        """Applies a function to the value of many keys in parallel, across a pool of worker processes,
+        each reading and writing with many threads.
+
+        The keys are split into chunks that are sent to the workers along with their etags, so each value
+        read is validated as for `d[key]`. Each worker creates this mapping (and `out`) once, from a pickled
+        copy: the storage provider is constructed again with the same arguments, so each worker has its own
+        connections, and the mapping has the same serialisation, key prefix, key codec and retry policy (with
+        a concurrency limit per worker). Instrumentation is only recorded for the calling process. The
+        deserialisation of values, `fn`, and the serialisation of results so run on every core, rather than
+        being limited by the GIL.
+
+        Results are yielded as each chunk finishes, in the order of the keys, and keys are only sent to the
+        workers as the results are iterated, so iterate over all of them to process every key. The error
+        for each key that failed is yielded rather than raised, so one failure does not stop the others.
+
+        For example, `errors = [r for r in cm.map_values(fn, prefix="raw/", out=out) if r.error]`.
+
+        Parameters
+        ----------
+        fn : Callable[[T], Any]
+            The function to apply to each value. It is pickled to send to the workers, so must be defined
+            at the top level of a module, as must the mapping's serialisation functions
+        keys : Iterable[str], optional
+            The keys to apply the function to, defaults to every key of the mapping (as for `keys()`)
+        prefix : str, optional
+            Only apply the function to keys beginning with the prefix
+        out : MutableMapping, optional
+            A mapping to write the result of each key to under the same key, rather than yielding it. When
+            it is a `CloudMapping` the workers write to it directly, and its etags are then updated, otherwise
+            results are written to it by the calling process
+        processes : int, optional
+            The number of worker processes, defaults to the number of CPUs. If `0`, the function is applied
+            within the calling process, with threads only, which suits storages that can't be pickled such
+            as `SimulatedStorage`
+        threads_per_process : int, default=16
+            The number of keys each process reads, transforms and writes concurrently
+
+        Returns
+        -------
+        Iterator[MappedValue]
+            The key, result (unless written to `out`) and error (if any) of each key
+
+        Raises
+        ------
+        TypeError
+            When using worker processes, if `fn` or the arguments a storage provider was constructed with
+            can't be pickled, such as credential objects holding locks. A `SharedTransport` is pickled with
+            its settings only, so each worker has its own connections
+        """
+        pass
+
+    @abstractmethod
+    def get_fresh(self, key: str) -> T:
+        """Gets the latest value of a key from the cloud, revalidating the value previously
+        returned for the key rather than downloading it again if it is unchanged.
+
+        The last value and etag returned for each key are kept, and a conditional request is made
+        that only transfers the value if its etag has changed. This makes polling large values that
+        rarely change, such as configuration or models, cost one small request per poll. The key
+        is also synchronised with the cloud, as by `sync_with_cloud`.
+
+        Parameters
+        ----------
+        key : str
+            The key to get the latest value of
+
+        Raises
+        ------
+        KeyError
+            If there is no value for the key in the cloud
+        """
+        pass
+
+    @abstractmethod
+    def read_range(self, key: str, start: int, end: Optional[int] = None) -> bytes:
+        """Reads a range of the bytes stored for a key, without downloading the whole value.
+
+        The bytes are those stored in the cloud, they are not deserialised, so this is intended for
+        mappings using the `none()` serialiser, for example of Parquet or Zarr files where only a
+        footer or slice is needed. The range has the semantics of a python slice, `value[start:end]`,
+        so `read_range(key, -8)` reads the last 8 bytes. As with `d[key]`, the range is validated
+        against the key's etag (unless reading blindly), so it can't be read from a different version.
+
+        Parameters
+        ----------
+        key : str
+            The key to read a range of
+        start : int
+            The offset of the first byte of the range, counting from the end if negative
+        end : int, optional
+            The offset of the byte after the last byte of the range, counting from the end if
+            negative, defaults to the end of the value
+
+        Raises
+        ------
+        KeyError
+            If the key is unknown, or when reading blindly has no value in the cloud
+        """
+        pass
+
+    @abstractmethod
+    def get_buffer(self, key: str) -> memoryview:
+        """Gets the bytes stored for a key as a read-only `memoryview`.
+
+        The bytes are those stored in the cloud, they are not deserialised, so this is intended for
+        mappings using the `none()` serialiser, for example to pass values to numpy or PyArrow. When
+        the value is on the local disk, with `LocalFileSystemStorage` or `CachedStorage`, the view is
+        of the file mapped into memory with `mmap` rather than a copy. Pages are then loaded lazily and
+        shared between processes through the OS page cache, so large values need little memory.
+
+        Parameters
+        ----------
+        key : str
+            The key to get the bytes of
+
+        Raises
+        ------
+        KeyError
+            If the key is unknown, or when reading blindly has no value in the cloud
+        """
+        pass
+
+    @abstractmethod
+    def open(self, key: str, buffer_size: int = 64 * 1024) -> io.BufferedReader:
+        """Opens the bytes stored for a key as a read-only, seekable file-like object, which
+        downloads only the ranges that are read. See `read_range`.
+
+        Parameters
+        ----------
+        key : str
+            The key to open
+        buffer_size : int, default=64KiB
+            The minimum number of bytes downloaded by each read
+        """
+        pass
+
+    @abstractmethod
+    def append(self, key: str, data: bytes) -> None:
+        """Appends bytes to the end of the bytes stored for a key, creating the key if it is unknown.
+
+        As with `read_range`, the bytes are those stored in the cloud, they are not serialised, so this is
+        intended for mappings using the `none()` serialiser, for example of logs or event streams. Only the
+        appended bytes are uploaded: Azure Blob Storage appends blocks to an append blob (a value uploaded
+        as a block blob is rewritten as an append blob once), Google Cloud Storage composes the value with
+        the appended bytes, and AWS S3 copies the value into a multipart upload followed by the appended
+        bytes (values smaller than 5MiB are rewritten, as parts must be at least 5MiB). As with
+        `d[key] = value`, the append is conditional on the key's etag.
+
+        Parameters
+        ----------
+        key : str
+            The key to append to
+        data : bytes
+            The bytes to append
+
+        Raises
+        ------
+        KeySyncError
+            If the value in the cloud has changed since it was synchronised, or if the key is unknown but
+            has a value in the cloud
+        """
+        pass
+
+    @abstractmethod
+    def stat(self, key: str) -> KeyStat:
+        """Gets the etag, size and last modified time of the value of a key, without making any requests.
+
+        These are as listed by the last `sync_with_cloud`, or as written by this mapping (the last modified
+        time then being the time of the write on this machine). The size is of the bytes stored in the
+        cloud, after serialisation. The size and last modified time are `None` if unknown, such as for
+        storages whose listings do not include them, or keys changed by `get_fresh` or change notifications
+        without their value being downloaded.
+
+        Parameters
+        ----------
+        key : str
+            The key to get the metadata of
+
+        Raises
+        ------
+        KeyError
+            If the key is unknown
+        """
+        pass
+
+    @abstractmethod
+    def total_size(self, key_prefix: str = "") -> int:
+        """The total size in bytes of the values of the keys known to the mapping, as by `stat`.
+
+        No requests are made for keys of known size. The size of each key whose size is unknown, such as
+        for storages whose listings do not include sizes, is requested from the cloud (as an empty range
+        of its value, so without downloading it), and is then known to `stat`.
+
+        Parameters
+        ----------
+        key_prefix : str, optional
+            Only count keys beginning with the prefix
+
+        Raises
+        ------
+        KeySyncError
+            If the value of a key of unknown size has changed in the cloud
         """
         pass
 
@@ -1,13 +1,42 @@
-from typing import Any, Optional, TypeVar
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Sequence, Set, TypeVar
 
 from cloudmappings._cloudmappinginternal import CloudMappingInternal
 from cloudmappings.cloudmapping import CloudMapping
+from cloudmappings.instrumentation import Instrumentation, InstrumentedStorageProvider
+from cloudmappings.keycodecs import IdentityKeyCodec, KeyCodec
+from cloudmappings.retry import RetryingStorageProvider, RetryPolicy
 from cloudmappings.serialisers import CloudMappingSerialisation
 from cloudmappings.serialisers.core import pickle
+from cloudmappings.sharedindex import SharedEtagIndex
 from cloudmappings.storageprovider import StorageProvider
+from cloudmappings.transport import SharedTransport
 
 T = TypeVar("T")
 
+# The logical names of the cloud resources known to exist, so mappings of them needn't check again
+_known_to_exist: Set[str] = set()
+_known_to_exist_lock = threading.Lock()
+
+
+def _create_if_not_exists(storage_provider: StorageProvider, once: bool) -> bool:
+    name = storage_provider.logical_name()
+    if once:
+        with _known_to_exist_lock:
+            if name in _known_to_exist:
+                return True
+    already_exists = storage_provider.create_if_not_exists()
+    with _known_to_exist_lock:
+        _known_to_exist.add(name)
+    return already_exists
+
+
+def _recreate_mapping(storage_provider: StorageProvider, options: Dict[str, Any]) -> CloudMapping:
+    # Creates a mapping equivalent to another, such as in the worker processes of `CloudMapping.map_values`.
+    # The cloud resource was created or found to exist by the original mapping, so isn't checked again.
+    return CloudStorage(storage_provider)._create_mapping(sync_initially=False, create_if_not_exists=False, **options)
+
 
 class CloudStorage:
     def __init__(self, storage_provider: StorageProvider) -> None:
@@ -25,6 +54,12 @@ class CloudStorage:
         read_blindly_default: Any = None,
         serialisation: CloudMappingSerialisation[T] = pickle(),
         key_prefix: Optional[str] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        shared_index: Optional[SharedEtagIndex] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        key_codec: Optional[KeyCodec] = None,
+        max_workers: int = 16,
+        sync_in_background: bool = False,
     ) -> CloudMapping[T]:
         """A cloud-mapping, a `MutableMapping` implementation backed by common cloud storage solutions.
 
@@ -55,19 +90,116 @@ class CloudStorage:
         key_prefix : Optional[str], default=None
             Prefix to apply to keys in cloud storage. Enables `CloudMapping`s to map to a subdirectory
             within a cloud storage service, as opposed to the whole resource.
+        instrumentation : Optional[Instrumentation], default=None
+            Instrumentation to record the timings, bytes transferred and outcomes of each call to the
+            storage provider and each serialisation step. No instrumentation is performed when `None`.
+        shared_index : Optional[SharedEtagIndex], default=None
+            An index of etags to share with mappings in other processes on the same host. Only one
+            process lists the cloud to sync the index initially, and writes from any process update it.
+        retry_policy : Optional[RetryPolicy], default=None
+            Policy to retry requests that fail with transient errors such as throttling, and to adapt
+            the number of requests made concurrently. No requests are retried when `None`.
+        key_codec : Optional[KeyCodec], default=None
+            Maps keys to the names they are stored under in the cloud, for example a `HashedShardKeyCodec`
+            to spread keys with shared prefixes across storage partitions. Keys are stored under
+            themselves when `None`. Mappings of the same values must use the same codec.
+        max_workers : int, default=16
+            The maximum number of requests made concurrently by methods that access many keys, such
+            as `update`, `values`, `clear` and comparing mappings with `==`.
+        sync_in_background : bool, default=False
+            Whether to return the mapping without waiting for the initial sync, which is instead made in
+            a background thread. Until it finishes, keys not yet listed are looked up in the cloud as they
+            are used, reading a value and its etag in a single request, and `keys()`, `len()` and other
+            methods that need every key wait for it (see `CloudMapping.wait_for_sync`). The existence of
+            the cloud resource is also only checked by the first such mapping of it in each process. This
+            suits short-lived processes, such as serverless functions, that only use a few keys.
         """
+        return self._create_mapping(
+            sync_initially=sync_initially,
+            read_blindly=read_blindly,
+            read_blindly_error=read_blindly_error,
+            read_blindly_default=read_blindly_default,
+            serialisation=serialisation,
+            key_prefix=key_prefix,
+            instrumentation=instrumentation,
+            shared_index=shared_index,
+            retry_policy=retry_policy,
+            key_codec=key_codec,
+            max_workers=max_workers,
+            sync_in_background=sync_in_background,
+        )
+
+    def _create_mapping(
+        self,
+        sync_initially: bool,
+        read_blindly: bool,
+        read_blindly_error: bool,
+        read_blindly_default: Any,
+        serialisation: CloudMappingSerialisation[T],
+        key_prefix: Optional[str],
+        retry_policy: Optional[RetryPolicy],
+        key_codec: Optional[KeyCodec],
+        max_workers: int,
+        instrumentation: Optional[Instrumentation] = None,
+        shared_index: Optional[SharedEtagIndex] = None,
+        sync_in_background: bool = False,
+        create_if_not_exists: bool = True,
+    ) -> CloudMapping[T]:
+        storage_provider = self.storage_provider
+        if retry_policy is not None:
+            storage_provider = RetryingStorageProvider(storage_provider, retry_policy)
+        if instrumentation is not None:
+            storage_provider = InstrumentedStorageProvider(storage_provider, instrumentation)
+
         mapping = CloudMappingInternal()
-        mapping._storage_provider = self.storage_provider
-        mapping._etags = {}
+        mapping._storage_provider = storage_provider
+        if shared_index is not None:
+            namespace = f"{storage_provider.logical_name()}|{key_prefix or ''}"
+            if key_codec is not None:
+                namespace += f"|{key_codec!r}"
+            mapping._etags = shared_index.etags(namespace=namespace)
+            mapping._key_lock = shared_index.key_locks(namespace=namespace)
+        else:
+            mapping._etags = {}
         mapping._serialisation = serialisation
         mapping._key_prefix = key_prefix
+        mapping._key_codec = key_codec if key_codec is not None else IdentityKeyCodec()
+        mapping._instrumentation = instrumentation
+        mapping._max_workers = max_workers
+        # Pickled to create the mapping again in other processes, so instrumentation and the shared index are
+        # left out. The storage provider is constructed again when unpickled, so it has its own connections.
+        mapping._recreate = partial(
+            _recreate_mapping,
+            self.storage_provider,
+            dict(
+                read_blindly=read_blindly,
+                read_blindly_error=read_blindly_error,
+                read_blindly_default=read_blindly_default,
+                serialisation=serialisation,
+                key_prefix=key_prefix,
+                retry_policy=retry_policy,
+                key_codec=key_codec,
+                max_workers=max_workers,
+            ),
+        )
 
         mapping.read_blindly = read_blindly
         mapping.read_blindly_error = read_blindly_error
         mapping.read_blindly_default = read_blindly_default
 
-        if self.storage_provider.create_if_not_exists() and sync_initially:
-            mapping.sync_with_cloud()
+        if create_if_not_exists:
+            already_exists = _create_if_not_exists(storage_provider, once=sync_in_background)
+        else:
+            already_exists = True
+        if already_exists and sync_initially:
+            if shared_index is not None:
+                sync = partial(shared_index.sync_once, namespace=mapping._etags.namespace, sync=mapping.sync_with_cloud)
+            else:
+                sync = mapping.sync_with_cloud
+            if sync_in_background:
+                mapping._sync_in_background(sync)
+            else:
+                sync()
 
         return mapping
 
@@ -80,6 +212,7 @@ class AzureBlobStorage(CloudStorage):
         account_url: str = None,
         connection_string: str = None,
         create_container_metadata=None,
+        transport: SharedTransport = None,
     ) -> None:
         """A cloud-mapping backed by an Azure Blob Storage Container
 
@@ -97,6 +230,9 @@ class AzureBlobStorage(CloudStorage):
         connection_string : str, default=None
             A connection string to use for the Azure Blob Storage Container. Takes precedence over
             `account_url` and `credential` if given
+        transport : SharedTransport, default=None
+            Configures the connection pool size, timeouts and keep-alive of requests. Pass the same
+            `SharedTransport` to multiple `CloudStorage`s to share connections between them
 
         See Also
         --------
@@ -113,6 +249,7 @@ class AzureBlobStorage(CloudStorage):
                 account_url=account_url,
                 connection_string=connection_string,
                 create_container_metadata=create_container_metadata,
+                transport=transport,
             )
         )
 
@@ -124,6 +261,7 @@ class AzureTableStorage(CloudStorage):
         credential: Any = None,
         endpoint: str = None,
         connection_string: str = None,
+        transport: SharedTransport = None,
     ) -> None:
         """A cloud-mapping backed by an Azure Table Storage Table
 
@@ -142,6 +280,9 @@ class AzureTableStorage(CloudStorage):
         connection_string : str, default=None
             A connection string to use for the Azure Table Storage Table. Takes precedence over
             `endpoint` and `credential` if given
+        transport : SharedTransport, default=None
+            Configures the connection pool size, timeouts and keep-alive of requests. Pass the same
+            `SharedTransport` to multiple `CloudStorage`s to share connections between them
 
         See Also
         --------
@@ -157,6 +298,7 @@ class AzureTableStorage(CloudStorage):
                 credential=credential,
                 endpoint=endpoint,
                 connection_string=connection_string,
+                transport=transport,
             )
         )
 
@@ -167,6 +309,8 @@ class GoogleCloudStorage(CloudStorage):
         bucket_name: str,
         project: str,
         credentials: Any = None,
+        client_options: Any = None,
+        transport: SharedTransport = None,
     ) -> None:
         """A cloud-mapping backed by a Google Cloud Storage Bucket
 
@@ -178,6 +322,12 @@ class GoogleCloudStorage(CloudStorage):
             The GCP project to use
         credentials : optional
             A credentials object from various google client libraries
+        client_options : dict or google.api_core.client_options.ClientOptions, optional
+            Client options passed to the storage client, for example `{"api_endpoint": url}` to use
+            an emulator such as fake-gcs-server
+        transport : SharedTransport, default=None
+            Configures the connection pool size, timeouts and keep-alive of requests. Pass the same
+            `SharedTransport` to multiple `CloudStorage`s to share connections between them
 
         See Also
         --------
@@ -187,7 +337,15 @@ class GoogleCloudStorage(CloudStorage):
             GoogleCloudStorageProvider,
         )
 
-        super().__init__(GoogleCloudStorageProvider(bucket_name=bucket_name, project=project, credentials=credentials))
+        super().__init__(
+            GoogleCloudStorageProvider(
+                bucket_name=bucket_name,
+                project=project,
+                credentials=credentials,
+                client_options=client_options,
+                transport=transport,
+            )
+        )
 
 
 class AWSS3Storage(CloudStorage):
@@ -195,6 +353,8 @@ class AWSS3Storage(CloudStorage):
         self,
         bucket_name: str,
         silence_warning: bool = False,
+        endpoint_url: str = None,
+        transport: SharedTransport = None,
     ) -> None:
         """A cloud-mapping backed by an AWS S3 Bucket
 
@@ -210,6 +370,12 @@ class AWSS3Storage(CloudStorage):
             The name of the S3 Bucket to use within AWS
         silence_warning : bool, default=False
             Whether to silence the warning logged about using S3 backed cloud-mappings concurrently
+        endpoint_url : str, default=None
+            The S3 endpoint to use, defaults to AWS. May be used for S3 compatible services or
+            emulators such as moto server
+        transport : SharedTransport, default=None
+            Configures the connection pool size, timeouts and keep-alive of requests. Pass the same
+            `SharedTransport` to multiple `CloudStorage`s to share connections between them
 
         See Also
         --------
@@ -217,4 +383,295 @@ class AWSS3Storage(CloudStorage):
         """
         from cloudmappings._storageproviders.awss3storage import AWSS3StorageProvider
 
-        super().__init__(AWSS3StorageProvider(bucket_name=bucket_name, silence_warning=silence_warning))
+        super().__init__(
+            AWSS3StorageProvider(
+                bucket_name=bucket_name,
+                silence_warning=silence_warning,
+                endpoint_url=endpoint_url,
+                transport=transport,
+            )
+        )
+
+
+class LocalFileSystemStorage(CloudStorage):
+    def __init__(
+        self,
+        directory: str,
+    ) -> None:
+        """A cloud-mapping backed by a directory on the local file system
+
+        Each key is stored as a file, with forward slashes in keys mapping to subdirectories. This
+        means, as with hierarchical namespaces in cloud storage, directories and files cannot share
+        the same key. Writes are made atomic by writing to a temporary file before renaming it into
+        place, and etags are derived from the inode, modification time and size of each file. On
+        platforms without `fcntl` (Windows), conditional writes are only atomic within a single process.
+
+        Parameters
+        ----------
+        directory : str
+            The path of the directory to store values within, it will be created if it does not exist
+
+        See Also
+        --------
+        cloud-mapping : `CloudMapping`
+        """
+        from cloudmappings._storageproviders.localfilesystemstorage import (
+            LocalFileSystemStorageProvider,
+        )
+
+        super().__init__(LocalFileSystemStorageProvider(directory=directory))
+
+
+class SimulatedStorage(CloudStorage):
+    def __init__(
+        self,
+        name: str = "simulated",
+        latency: Any = 0.0,
+        bandwidth: Optional[float] = None,
+        requests_per_second: Optional[float] = None,
+        burst: int = 1,
+        failure_rate: float = 0.0,
+        list_page_size: int = 1000,
+        seed: Optional[int] = None,
+        sleep: Callable[[float], None] = None,
+        clock: Callable[[], float] = None,
+    ) -> None:
+        """A cloud-mapping backed by a simulated, in-memory cloud storage service
+
+        Values are held in memory and etags are enforced as they are by the cloud providers. The cost
+        of each request to the simulated service may be configured, allowing the performance of
+        `CloudMapping`s to be modelled deterministically without a network. Each call to the storage
+        provider is a single request, except listing which makes one request per page of keys.
+
+        Parameters
+        ----------
+        name : str, default="simulated"
+            A name to identify the simulated service by
+        latency : float or Callable[[random.Random], float], default=0.0
+            The latency of each request in seconds. If a callable is given, it is called for each
+            request with a seeded `random.Random` and should return a latency sampled from the
+            desired distribution, for example `lambda r: r.lognormvariate(-3, 0.5)`
+        bandwidth : float, default=None
+            Bytes per second transferred by each request, `None` for unlimited
+        requests_per_second : float, default=None
+            The sustained request rate after which requests are throttled, `None` for unlimited.
+            Throttled requests raise a `cloudmappings.errors.ThrottlingError`
+        burst : int, default=1
+            The number of requests that may be made at once before `requests_per_second` applies
+        failure_rate : float, default=0.0
+            The probability of each request failing with a `ConnectionError`
+        list_page_size : int, default=1000
+            The number of keys returned by each listing request
+        seed : int, default=None
+            Seed for the random number generator used for latencies and failures
+        sleep : Callable[[float], None], default=None
+            Function used to wait for latency, defaults to `time.sleep`
+        clock : Callable[[], float], default=None
+            Function returning the current time in seconds for rate limiting, defaults to `time.monotonic`
+
+        See Also
+        --------
+        cloud-mapping : `CloudMapping`
+        """
+        import time
+
+        from cloudmappings._storageproviders.simulatedstorage import (
+            SimulatedStorageProvider,
+        )
+
+        super().__init__(
+            SimulatedStorageProvider(
+                name=name,
+                latency=latency,
+                bandwidth=bandwidth,
+                requests_per_second=requests_per_second,
+                burst=burst,
+                failure_rate=failure_rate,
+                list_page_size=list_page_size,
+                seed=seed,
+                sleep=sleep or time.sleep,
+                clock=clock or time.monotonic,
+            )
+        )
+
+
+class ReplicatedStorage(CloudStorage):
+    def __init__(
+        self,
+        replicas: Sequence[CloudStorage],
+        hedge_percentile: float = 95.0,
+        initial_hedge_delay: float = 0.05,
+        latency_window: int = 1000,
+        min_latency_samples: int = 20,
+        max_workers: int = 32,
+    ) -> None:
+        """A cloud-mapping replicated across several cloud storages, for example in two regions or
+        with two providers, to reduce the tail latency of reads
+
+        Writes and deletes are made to every replica concurrently. Reads are first sent to the replica
+        expected to respond fastest, and if it has not responded within the `hedge_percentile` of its
+        recent latencies a hedged request is sent to the next replica, returning whichever responds
+        first. The etag of each value is the etag from every replica, so each replica is kept in sync
+        independently. If a write fails on some replicas, the value's etag will not match on the others
+        until the mapping is synced again.
+
+        Parameters
+        ----------
+        replicas : Sequence[CloudStorage]
+            The cloud storages to replicate values across. Keys are encoded as for the first replica
+        hedge_percentile : float, default=95.0
+            The percentile of a replica's recent read latencies after which a hedged request is sent
+        initial_hedge_delay : float, default=0.05
+            Seconds after which a hedged request is sent, until enough latencies have been recorded
+        latency_window : int, default=1000
+            The number of recent read latencies recorded for each replica
+        min_latency_samples : int, default=20
+            The number of latencies to record for a replica before using them to decide when to hedge
+        max_workers : int, default=32
+            The maximum number of threads used to make requests to the replicas concurrently
+
+        See Also
+        --------
+        cloud-mapping : `CloudMapping`
+        """
+        from cloudmappings._storageproviders.replicatedstorage import (
+            ReplicatedStorageProvider,
+        )
+
+        super().__init__(
+            ReplicatedStorageProvider(
+                replicas=[r.storage_provider for r in replicas],
+                hedge_percentile=hedge_percentile,
+                initial_hedge_delay=initial_hedge_delay,
+                latency_window=latency_window,
+                min_latency_samples=min_latency_samples,
+                max_workers=max_workers,
+            )
+        )
+
+
+class CachedStorage(CloudStorage):
+    def __init__(
+        self,
+        storage: CloudStorage,
+        directory: str,
+        max_size: Optional[int] = None,
+        revalidate: bool = True,
+    ) -> None:
+        """A cloud-mapping of another cloud storage, with values cached on the local disk
+
+        Values read or written are stored in files within the directory, one per key, named by the
+        etag of the value. Reads only download a value if the cached version is not the latest,
+        and `CloudMapping.get_buffer` returns the cached file mapped into memory rather than a copy,
+        so processes on the same host share its pages through the OS page cache. The cache may be
+        shared by many processes, and many storages.
+
+        Parameters
+        ----------
+        storage : CloudStorage
+            The cloud storage to cache values of
+        directory : str
+            The path of the directory to cache values within, it will be created if it does not exist
+        max_size : int, default=None
+            The maximum total size in bytes of cached values, after which the least recently used are
+            evicted. `None` for unlimited
+        revalidate : bool, default=True
+            Whether to check with the cloud that a cached value is still the latest each time it is
+            read. If `False`, cached values with the expected etag are read without making a request,
+            so reads of values changed by others raise `cloudmappings.errors.KeySyncError` only when writing
+
+        See Also
+        --------
+        cloud-mapping : `CloudMapping`
+        """
+        from cloudmappings._storageproviders.cachedstorage import CachedStorageProvider
+
+        super().__init__(
+            CachedStorageProvider(
+                storage_provider=storage.storage_provider,
+                directory=directory,
+                max_size=max_size,
+                revalidate=revalidate,
+            )
+        )
+
+
+class PackedStorage(CloudStorage):
+    def __init__(
+        self,
+        storage: CloudStorage,
+        prefix: str = "packed/",
+        pack_size: int = 4 * 1024 * 1024,
+        index_shards: int = 64,
+        revalidate: bool = True,
+        compaction_interval: Optional[float] = None,
+        max_workers: int = 16,
+    ) -> None:
+        """A cloud-mapping of another cloud storage, with many small values packed into each object
+
+        Values written together, by `CloudMapping.update` or by concurrent writes, are uploaded in a single
+        pack object, and an index maps each key to the range of its pack holding its value. Reads download
+        only that range, and iterating `values()` or `items()` reads the adjacent values of a pack with a
+        single request. This avoids the cost and latency of a request per value, which dominate for many
+        small values. Etags are enforced per key, just as for other storages.
+
+        The index is split into shards by a hash of each key, which are each read and written whole, with
+        the writes to each shard made conditionally, so mappings in many processes may write at once.
+        Values overwritten or deleted remain in their packs until reclaimed by `compact`.
+
+        Parameters
+        ----------
+        storage : CloudStorage
+            The cloud storage to store packs and the index in
+        prefix : str, default="packed/"
+            The prefix of the objects of the packs and index within the storage
+        pack_size : int, default=4MiB
+            The size in bytes of the values after which a batch is split into another pack
+        index_shards : int, default=64
+            The number of shards of the index. Shards are read and written whole, so choose enough that
+            each holds at most around a hundred thousand keys. Can't be changed once values are stored
+        revalidate : bool, default=True
+            Whether to check with the cloud that the cached index is the latest for each read. If `False`,
+            reads of values with the expected etag make a single request for the range of the value
+        compaction_interval : float, default=None
+            Seconds between compactions made in a background thread, `None` to only compact with `compact`
+        max_workers : int, default=16
+            The maximum number of requests to make concurrently
+
+        See Also
+        --------
+        cloud-mapping : `CloudMapping`
+        """
+        from cloudmappings._storageproviders.packedstorage import PackedStorageProvider
+
+        super().__init__(
+            PackedStorageProvider(
+                storage_provider=storage.storage_provider,
+                prefix=prefix,
+                pack_size=pack_size,
+                index_shards=index_shards,
+                revalidate=revalidate,
+                compaction_interval=compaction_interval,
+                max_workers=max_workers,
+            )
+        )
+
+    def compact(self, min_garbage_ratio: float = 0.5, grace: float = 600.0) -> int:
+        """Reclaims the space of values that have been overwritten or deleted, by rewriting the values
+        still used in packs mostly unused into new packs, and deleting the old packs. Values keep their
+        etags, so mappings remain in sync.
+
+        Parameters
+        ----------
+        min_garbage_ratio : float, default=0.5
+            The fraction of a pack that must be unused for it to be compacted
+        grace : float, default=600.0
+            Seconds after being written before a pack may be compacted, as packs are written before the
+            values within them are added to the index
+
+        Returns
+        -------
+        int
+            The number of packs deleted
+        """
+        return self.storage_provider.compact(min_garbage_ratio=min_garbage_ratio, grace=grace)
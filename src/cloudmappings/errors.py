@@ -1,3 +1,6 @@
+from typing import Dict, Optional
+
+
 class KeySyncError(KeyError):
     storage_provider_name: str
     key: str
@@ -13,6 +16,48 @@ class KeySyncError(KeyError):
             f"Key: '{key}', etag: '{etag}'"
         )
 
+    def __reduce__(self):
+        return (KeySyncError, (self.storage_provider_name, self.key, self.expected_etag))
+
+
+class PartialWriteError(KeySyncError):
+    """Raised when a write or delete of a `ReplicatedStorage` succeeded in some replicas and failed in others,
+    which leaves the replicas out of sync with each other.
+
+    `etag` is the etag of the key as it now is, with the new etags of the replicas written and the previous
+    etags of those that failed, so a retry conditional on it repairs the replicas that failed. A mapping's
+    etag is updated to it by `sync_with_cloud`. `errors` holds the error of each replica that failed.
+    """
+
+    etag: Optional[str]
+    errors: Dict[int, BaseException]
+
+    def __init__(
+        self,
+        storage_provider_name: str,
+        key: str,
+        expected_etag: Optional[str],
+        etag: Optional[str],
+        errors: Dict[int, BaseException],
+    ) -> None:
+        self.storage_provider_name = storage_provider_name
+        self.key = key
+        self.expected_etag = expected_etag
+        self.etag = etag
+        self.errors = errors
+        KeyError.__init__(
+            self,
+            f"Write succeeded in only some replicas.\n"
+            f"Cloud storage: '{storage_provider_name}'\n"
+            f"Key: '{key}', etag: '{expected_etag}', now: '{etag}', failed replicas: {sorted(errors)}",
+        )
+
+    def __reduce__(self):
+        return (
+            PartialWriteError,
+            (self.storage_provider_name, self.key, self.expected_etag, self.etag, self.errors),
+        )
+
 
 class ValueSizeError(ValueError):
     storage_provider_name: str
@@ -24,3 +69,21 @@ class ValueSizeError(ValueError):
         super().__init__(
             f"Value is too big to fit in cloud.\n" f"Cloud storage: '{storage_provider_name}'\n" f"Key: '{key}'"
         )
+
+    def __reduce__(self):
+        return (ValueSizeError, (self.storage_provider_name, self.key))
+
+
+class ThrottlingError(Exception):
+    storage_provider_name: str
+    key: str
+
+    def __init__(self, storage_provider_name: str, key: str = None) -> None:
+        self.storage_provider_name = storage_provider_name
+        self.key = key
+        super().__init__(
+            f"Request was throttled by cloud storage.\n" f"Cloud storage: '{storage_provider_name}'\n" f"Key: '{key}'"
+        )
+
+    def __reduce__(self):
+        return (ThrottlingError, (self.storage_provider_name, self.key))
@@ -0,0 +1,303 @@
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from cloudmappings.errors import KeySyncError
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider
+
+_active = threading.local()
+
+
+@dataclass
+class OperationRecord:
+    """A record of a single operation performed by a `CloudMapping`, either a call to its
+    `StorageProvider` or a serialisation step"""
+
+    provider: str
+    """The logical name of the storage provider the operation was performed against"""
+    operation: str
+    """The name of the operation, for example `download_data` or `loads`"""
+    key: Optional[str]
+    """The key the operation was performed on, or the key prefix for listings"""
+    duration: float = 0.0
+    """Total duration of the operation in seconds"""
+    bytes_in: int = 0
+    """Number of bytes downloaded or deserialised"""
+    bytes_out: int = 0
+    """Number of bytes uploaded or serialised"""
+    outcome: str = "success"
+    """One of `success`, `not_found`, `not_modified`, `key_sync_error` or `error`"""
+    retries: int = 0
+    """Number of times the operation was retried before completing"""
+    phases: Dict[str, float] = field(default_factory=dict)
+    """Durations in seconds of phases within the operation, for example `precondition` requests"""
+    error: Optional[BaseException] = None
+    """The exception raised by the operation, if any"""
+
+
+class Instrumentation:
+    def __init__(
+        self,
+        callback: Callable[[OperationRecord], None] = None,
+        opentelemetry: bool = False,
+    ) -> None:
+        """Instrumentation of the operations performed by a `CloudMapping`.
+
+        Each call to the mapping's `StorageProvider` and each serialisation step is timed and
+        recorded as an `OperationRecord`. Pass an instance to `CloudStorage.create_mapping` to
+        enable it, when not passed mappings are not instrumented and have no overhead.
+
+        Parameters
+        ----------
+        callback : Callable[[OperationRecord], None], default=None
+            Function called with the record of each operation once it completes
+        opentelemetry : bool, default=False
+            Whether to also create an OpenTelemetry span for each operation, and record the
+            `cloudmappings.operation.duration` histogram and `cloudmappings.operation.bytes`
+            counter metrics. Requires `opentelemetry-api`
+        """
+        self._callbacks: List[Callable[[OperationRecord], None]] = []
+        if callback is not None:
+            self._callbacks.append(callback)
+        self._tracer = None
+        if opentelemetry:
+            from opentelemetry import metrics, trace
+
+            self._tracer = trace.get_tracer("cloudmappings")
+            meter = metrics.get_meter("cloudmappings")
+            self._duration_histogram = meter.create_histogram(
+                "cloudmappings.operation.duration", unit="s", description="Duration of cloud-mapping operations"
+            )
+            self._bytes_counter = meter.create_counter(
+                "cloudmappings.operation.bytes", unit="By", description="Bytes transferred by cloud-mapping operations"
+            )
+
+    def add_callback(self, callback: Callable[[OperationRecord], None]) -> None:
+        """Add another function to be called with the record of each operation"""
+        self._callbacks.append(callback)
+
+    @contextmanager
+    def measure(self, provider: str, operation: str, key: Optional[str]) -> Iterator[OperationRecord]:
+        """Time an operation, yielding its record so that bytes transferred and the outcome may be
+        set within the block. The record is emitted when the block exits."""
+        record = OperationRecord(provider=provider, operation=operation, key=key)
+        span = None
+        if self._tracer is not None:
+            from opentelemetry import context, trace
+
+            span = self._tracer.start_span(f"cloudmappings.{operation}")
+            # Make the span current, so spans from the cloud sdks are nested within it
+            context_token = context.attach(trace.set_span_in_context(span))
+        parent, _active.record = getattr(_active, "record", None), record
+        start = time.perf_counter()
+        try:
+            yield record
+        except KeySyncError as e:
+            record.outcome, record.error = "key_sync_error", e
+            raise
+        except BaseException as e:
+            record.outcome, record.error = "error", e
+            raise
+        finally:
+            record.duration = time.perf_counter() - start
+            _active.record = parent
+            if span is not None:
+                context.detach(context_token)
+                self._emit_opentelemetry(span, record)
+            for callback in self._callbacks:
+                callback(record)
+
+    def _emit_opentelemetry(self, span, record: OperationRecord) -> None:
+        attributes = {
+            "cloudmappings.provider": record.provider,
+            "cloudmappings.operation": record.operation,
+            "cloudmappings.outcome": record.outcome,
+        }
+        span.set_attributes(
+            {
+                **attributes,
+                "cloudmappings.key": record.key or "",
+                "cloudmappings.bytes_in": record.bytes_in,
+                "cloudmappings.bytes_out": record.bytes_out,
+                "cloudmappings.retries": record.retries,
+                **{f"cloudmappings.phase.{p}": d for p, d in record.phases.items()},
+            }
+        )
+        if record.error is not None:
+            span.record_exception(record.error)
+        span.end()
+        self._duration_histogram.record(record.duration, attributes=attributes)
+        self._bytes_counter.add(record.bytes_in, attributes={**attributes, "cloudmappings.direction": "in"})
+        self._bytes_counter.add(record.bytes_out, attributes={**attributes, "cloudmappings.direction": "out"})
+
+
+def current_record() -> Optional[OperationRecord]:
+    """Gets the record of the operation currently being measured on this thread, if any.
+    Allows layers within an operation to annotate its record."""
+    return getattr(_active, "record", None)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Times a phase of the operation currently being measured on this thread, for example the
+    precondition request made before a download. Does nothing when no operation is being measured."""
+    record = getattr(_active, "record", None)
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.phases[name] = record.phases.get(name, 0.0) + time.perf_counter() - start
+
+
+class InstrumentedStorageProvider(StorageProvider):
+    """A `StorageProvider` that records each call made to the `StorageProvider` it wraps"""
+
+    def __init__(self, storage_provider: StorageProvider, instrumentation: Instrumentation) -> None:
+        self._storage_provider = storage_provider
+        self._instrumentation = instrumentation
+
+    @property
+    def wrapped_storage_provider(self) -> StorageProvider:
+        return self._storage_provider
+
+    def _measure(self, operation: str, key: Optional[str]):
+        return self._instrumentation.measure(self._storage_provider.logical_name(), operation, key)
+
+    def logical_name(self) -> str:
+        return self._storage_provider.logical_name()
+
+    def create_if_not_exists(self) -> bool:
+        with self._measure("create_if_not_exists", None):
+            return self._storage_provider.create_if_not_exists()
+
+    def encode_key(self, unsafe_key) -> str:
+        return self._storage_provider.encode_key(unsafe_key)
+
+    def decode_key(self, encoded_key) -> str:
+        return self._storage_provider.decode_key(encoded_key)
+
+    def is_retryable_error(self, error: BaseException) -> bool:
+        return self._storage_provider.is_retryable_error(error)
+
+    def download_data(self, key: str, etag: str) -> bytes:
+        with self._measure("download_data", key) as record:
+            data = self._storage_provider.download_data(key=key, etag=etag)
+            if data is None:
+                record.outcome = "not_found"
+            else:
+                record.bytes_in = len(data)
+            return data
+
+    def download_buffer(self, key: str, etag: Optional[str]) -> memoryview:
+        with self._measure("download_buffer", key) as record:
+            buffer = self._storage_provider.download_buffer(key=key, etag=etag)
+            if buffer is None:
+                record.outcome = "not_found"
+            else:
+                record.bytes_in = buffer.nbytes
+            return buffer
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        with self._measure("download_range", key) as record:
+            downloaded = self._storage_provider.download_range(key=key, etag=etag, start=start, end=end)
+            if downloaded is None:
+                record.outcome = "not_found"
+            else:
+                record.bytes_in = len(downloaded.data)
+            return downloaded
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        with self._measure("download_data_if_changed", key) as record:
+            data, latest_etag = self._storage_provider.download_data_if_changed(key=key, etag=etag)
+            if latest_etag is None:
+                record.outcome = "not_found"
+            elif data is None:
+                record.outcome = "not_modified"
+            else:
+                record.bytes_in = len(data)
+            return data, latest_etag
+
+    def exists(self, key: str) -> bool:
+        with self._measure("exists", key) as record:
+            exists = self._storage_provider.exists(key)
+            if not exists:
+                record.outcome = "not_found"
+            return exists
+
+    def get_etag(self, key: str) -> Optional[str]:
+        with self._measure("get_etag", key) as record:
+            etag = self._storage_provider.get_etag(key)
+            if etag is None:
+                record.outcome = "not_found"
+            return etag
+
+    def upload_data(self, key: str, etag: str, data: bytes) -> str:
+        with self._measure("upload_data", key) as record:
+            if isinstance(data, bytes):
+                record.bytes_out = len(data)
+            return self._storage_provider.upload_data(key=key, etag=etag, data=data)
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        with self._measure("append_data", key) as record:
+            if isinstance(data, bytes):
+                record.bytes_out = len(data)
+            return self._storage_provider.append_data(key=key, etag=etag, data=data)
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        with self._measure("copy_data", key):
+            return self._storage_provider.copy_data(source_key=source_key, source_etag=source_etag, key=key, etag=etag)
+
+    def delete_data(self, key: str, etag: str) -> None:
+        with self._measure("delete_data", key):
+            self._storage_provider.delete_data(key=key, etag=etag)
+
+    def download_many(
+        self, keys_and_etags: Dict[str, Optional[str]], max_workers: int = 16
+    ) -> Dict[str, Optional[bytes]]:
+        with self._measure("download_many", None) as record:
+            downloaded = self._storage_provider.download_many(keys_and_etags, max_workers=max_workers)
+            record.bytes_in = sum(len(data) for data in downloaded.values() if data is not None)
+            return downloaded
+
+    def upload_many(
+        self, keys_etags_and_data: Dict[str, Tuple[Optional[str], bytes]], max_workers: int = 16
+    ) -> Tuple[Dict[str, str], Dict[str, BaseException]]:
+        with self._measure("upload_many", None) as record:
+            record.bytes_out = sum(len(data) for _, data in keys_etags_and_data.values() if isinstance(data, bytes))
+            etags, errors = self._storage_provider.upload_many(keys_etags_and_data, max_workers=max_workers)
+            if errors:
+                all_key_sync_errors = all(isinstance(e, KeySyncError) for e in errors.values())
+                record.outcome = "key_sync_error" if all_key_sync_errors else "error"
+            return etags, errors
+
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        with self._measure("delete_many", None) as record:
+            errors = self._storage_provider.delete_many(keys_and_etags, max_workers=max_workers)
+            if errors:
+                all_key_sync_errors = all(isinstance(e, KeySyncError) for e in errors.values())
+                record.outcome = "key_sync_error" if all_key_sync_errors else "error"
+            return errors
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        with self._measure("list_keys_and_etags_delimited", key_prefix):
+            return self._storage_provider.list_keys_and_etags_delimited(key_prefix, delimiter)
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        with self._measure("list_keys_and_etags", key_prefix):
+            return self._storage_provider.list_keys_and_etags(key_prefix)
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        # The same request as listing etags, so recorded as the same operation
+        with self._measure("list_keys_and_etags_delimited", key_prefix):
+            return self._storage_provider.list_keys_and_stats_delimited(key_prefix, delimiter)
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        with self._measure("list_keys_and_etags", key_prefix):
+            return self._storage_provider.list_keys_and_stats(key_prefix)
@@ -0,0 +1,131 @@
+import zlib
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+
+class KeyCodec(ABC):
+    """Maps the keys of a `CloudMapping` to the names they are stored under in the cloud.
+
+    A codec is applied to each key after the mapping's key prefix is prepended, and before the
+    storage provider's own `encode_key`, so it is independent of the storage provider used.
+    """
+
+    @abstractmethod
+    def encode(self, key: str) -> str:
+        """Encodes a key into the name it is stored under
+
+        Parameters
+        ----------
+        key : str
+            The key, including the mapping's key prefix
+
+        Returns
+        -------
+        str
+            The name to store the key under
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, stored_key: str) -> Optional[str]:
+        """Decodes the name a key is stored under back to the key
+
+        Parameters
+        ----------
+        stored_key : str
+            The name listed from the cloud
+
+        Returns
+        -------
+        str
+            The key, or `None` if the name could not have been encoded by this codec
+        """
+        pass
+
+    @abstractmethod
+    def listing_prefixes(self, key_prefix: str) -> List[str]:
+        """The prefixes of stored names to list to find all keys beginning with a prefix
+
+        Parameters
+        ----------
+        key_prefix : str
+            The prefix of the keys to find, including the mapping's key prefix
+
+        Returns
+        -------
+        List[str]
+            Disjoint prefixes of the stored names, which may be listed concurrently
+        """
+        pass
+
+
+class IdentityKeyCodec(KeyCodec):
+    """Stores each key under the key itself, the default"""
+
+    def encode(self, key: str) -> str:
+        return key
+
+    def decode(self, stored_key: str) -> Optional[str]:
+        return stored_key
+
+    def listing_prefixes(self, key_prefix: str) -> List[str]:
+        return [key_prefix]
+
+    def __repr__(self) -> str:
+        return "IdentityKeyCodec()"
+
+
+class HashedShardKeyCodec(KeyCodec):
+    def __init__(self, shards: int = 256, separator: str = "/") -> None:
+        """Stores each key under a short shard prefix, chosen by a hash of the key.
+
+        Keys that share long or sequential prefixes, such as timestamps or run ids, are then spread
+        evenly across the key space. Cloud storage services partition their key space by prefix, so
+        this spreads requests across partitions rather than concentrating them on one, avoiding
+        per-prefix request limits such as those of AWS S3 and Azure Table Storage partitions.
+
+        Keys seen by the mapping are unchanged, but listing a prefix requires listing it within every
+        shard, which `sync_with_cloud` does concurrently. Objects stored without a shard prefix are
+        ignored when listing. The number of shards can't be changed once values are stored.
+
+        Parameters
+        ----------
+        shards : int, default=256
+            The number of shards to spread keys across
+        separator : str, default="/"
+            Separates the shard from the key in stored names
+        """
+        if shards < 1:
+            raise ValueError(f"shards must be at least 1, got {shards}")
+        self._shards = shards
+        self._separator = separator
+        self._width = len(f"{shards - 1:x}")
+
+    @property
+    def shards(self) -> int:
+        """The number of shards keys are spread across"""
+        return self._shards
+
+    def shard(self, key: str) -> int:
+        """The shard a key is stored within"""
+        return zlib.crc32(key.encode("utf-8")) % self._shards
+
+    def _shard_prefix(self, shard: int) -> str:
+        return f"{shard:0{self._width}x}{self._separator}"
+
+    def encode(self, key: str) -> str:
+        return self._shard_prefix(self.shard(key)) + key
+
+    def decode(self, stored_key: str) -> Optional[str]:
+        split = self._width + len(self._separator)
+        shard_prefix, key = stored_key[:split], stored_key[split:]
+        # Only names stored in their key's own shard were encoded by this codec
+        if shard_prefix != self._shard_prefix(self.shard(key)):
+            return None
+        return key
+
+    def listing_prefixes(self, key_prefix: str) -> List[str]:
+        return [self._shard_prefix(shard) + key_prefix for shard in range(self._shards)]
+
+    def __repr__(self) -> str:
+        return f"HashedShardKeyCodec(shards={self._shards}, separator={self._separator!r})"
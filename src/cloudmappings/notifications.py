@@ -0,0 +1,462 @@
+import base64
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set
+from urllib.parse import unquote_plus
+
+from cloudmappings.cloudmapping import CloudMapping
+
+# Sequencers are compared as strings once left padded to the same width
+_sequencer_width = 64
+# The sequencers of only the most recently changed keys are kept, as changes arrive out of order by moments at most
+_sequencers_max_size = 65536
+
+
+class ChangeEvent(NamedTuple):
+    """A change to the data at a key in cloud storage, as notified by the cloud"""
+
+    key: str
+    """The encoded key that changed, as listed by `StorageProvider.list_keys_and_etags`"""
+    deleted: bool
+    """Whether the data at the key was deleted"""
+    etag: Optional[str] = None
+    """The new etag of the data at the key, if known, in the format of the storage provider"""
+    sequencer: Optional[str] = None
+    """Orders changes to the same key, later changes having greater sequencers once left padded with zeros"""
+
+
+class ChangeSource(ABC):
+    """A source of notifications of changes to cloud storage, such as a queue the cloud publishes to"""
+
+    @abstractmethod
+    def receive(self, wait: float) -> List[ChangeEvent]:
+        """Receives the next changes, waiting up to `wait` seconds for any to arrive
+
+        Parameters
+        ----------
+        wait : float
+            The maximum number of seconds to wait for changes
+
+        Returns
+        -------
+        List[ChangeEvent]
+            The changes received, which may be empty
+        """
+        pass
+
+    @abstractmethod
+    def acknowledge(self) -> None:
+        """Acknowledges the changes last received have been applied, so they are not received again"""
+        pass
+
+    def abandon(self) -> None:
+        """Abandons the changes last received without acknowledging them, as they failed to be applied,
+        so they are received again"""
+        pass
+
+
+class QueueChangeSource(ChangeSource):
+    """A `ChangeSource` of changes put into an in-memory queue, for example by a `SimulatedStorage`"""
+
+    def __init__(self) -> None:
+        self._events: List[ChangeEvent] = []
+        self._received: List[ChangeEvent] = []
+        self._condition = threading.Condition()
+
+    def put(self, event: ChangeEvent) -> None:
+        """Puts a change into the queue"""
+        with self._condition:
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def receive(self, wait: float) -> List[ChangeEvent]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._events, timeout=wait)
+            events, self._events = self._events, []
+            self._received.extend(events)
+            return events
+
+    def acknowledge(self) -> None:
+        with self._condition:
+            self._received = []
+
+    def abandon(self) -> None:
+        with self._condition:
+            self._events, self._received = self._received + self._events, []
+
+
+def _parse_s3_events(body: str, bucket_name: Optional[str] = None) -> List[ChangeEvent]:
+    message = json.loads(body)
+    # Notifications delivered through SNS are wrapped in its own envelope
+    if message.get("Type") == "Notification" and "Message" in message:
+        message = json.loads(message["Message"])
+    events = []
+    for record in message.get("Records", []):
+        name = record.get("eventName", "")
+        if not name.startswith(("ObjectCreated:", "ObjectRemoved:")):
+            continue
+        if bucket_name is not None and record["s3"]["bucket"]["name"] != bucket_name:
+            continue
+        s3_object = record["s3"]["object"]
+        events.append(
+            ChangeEvent(
+                # Keys are url encoded in notifications, with spaces as "+"
+                key=unquote_plus(s3_object["key"]),
+                deleted=name.startswith("ObjectRemoved:"),
+                # Etags are held in the object's metadata, which notifications don't include
+                etag=None,
+                sequencer=s3_object.get("sequencer"),
+            )
+        )
+    return events
+
+
+class SQSChangeSource(ChangeSource):
+    def __init__(self, queue_url: str, bucket_name: Optional[str] = None, client: Any = None, max_messages: int = 10):
+        """Receives AWS S3 event notifications from an AWS SQS queue, either sent directly to the
+        queue or through an SNS topic.
+
+        Configure the bucket to send `s3:ObjectCreated:*` and `s3:ObjectRemoved:*` events to the queue.
+
+        Parameters
+        ----------
+        queue_url : str
+            The url of the SQS queue
+        bucket_name : str, default=None
+            Only changes to this bucket are received, or changes to any bucket if `None`
+        client : boto3 SQS client, default=None
+            The client to receive messages with, defaults to `boto3.client("sqs")`
+        max_messages : int, default=10
+            The maximum number of messages to receive at once, at most 10
+        """
+        if client is None:
+            import boto3
+
+            client = boto3.client("sqs")
+        self._client = client
+        self._queue_url = queue_url
+        self._bucket_name = bucket_name
+        self._max_messages = max_messages
+        self._receipt_handles: List[str] = []
+
+    def receive(self, wait: float) -> List[ChangeEvent]:
+        response = self._client.receive_message(
+            QueueUrl=self._queue_url,
+            MaxNumberOfMessages=self._max_messages,
+            WaitTimeSeconds=int(wait),
+        )
+        events = []
+        for message in response.get("Messages", []):
+            self._receipt_handles.append(message["ReceiptHandle"])
+            events.extend(_parse_s3_events(message["Body"], self._bucket_name))
+        return events
+
+    def acknowledge(self) -> None:
+        handles, self._receipt_handles = self._receipt_handles, []
+        for i in range(0, len(handles), 10):
+            self._client.delete_message_batch(
+                QueueUrl=self._queue_url,
+                Entries=[{"Id": str(j), "ReceiptHandle": h} for j, h in enumerate(handles[i : i + 10])],
+            )
+
+    def abandon(self) -> None:
+        # The messages are received again once their visibility timeout expires
+        self._receipt_handles = []
+
+
+def _parse_event_grid_events(content: str, container_name: Optional[str] = None) -> List[ChangeEvent]:
+    try:
+        message = json.loads(content)
+    except ValueError:
+        # Event Grid delivers events to storage queues base64 encoded
+        message = json.loads(base64.b64decode(content))
+    events = []
+    for event in message if isinstance(message, list) else [message]:
+        event_type = event.get("eventType", event.get("type"))
+        if event_type not in ("Microsoft.Storage.BlobCreated", "Microsoft.Storage.BlobDeleted"):
+            continue
+        # Subjects are of the form "/blobServices/default/containers/<container>/blobs/<blob>"
+        _, _, path = event["subject"].partition("/containers/")
+        container, _, blob = path.partition("/blobs/")
+        if container_name is not None and container != container_name:
+            continue
+        data = event.get("data", {})
+        deleted = event_type == "Microsoft.Storage.BlobDeleted"
+        events.append(
+            ChangeEvent(
+                key=blob,
+                deleted=deleted,
+                etag=None if deleted or "eTag" not in data else data["eTag"].strip('"'),
+                sequencer=data.get("sequencer"),
+            )
+        )
+    return events
+
+
+class AzureQueueChangeSource(ChangeSource):
+    def __init__(self, queue_client: Any, container_name: Optional[str] = None, max_messages: int = 32):
+        """Receives Azure Blob Storage events, published by Event Grid to an Azure Storage queue.
+
+        Subscribe the queue to the `Microsoft.Storage.BlobCreated` and `Microsoft.Storage.BlobDeleted`
+        events of the storage account.
+
+        Parameters
+        ----------
+        queue_client : azure.storage.queue.QueueClient
+            The client of the queue
+        container_name : str, default=None
+            Only changes to this container are received, or changes to any container if `None`
+        max_messages : int, default=32
+            The maximum number of messages to receive at once, at most 32
+        """
+        self._queue_client = queue_client
+        self._container_name = container_name
+        self._max_messages = max_messages
+        self._messages: List[Any] = []
+
+    def receive(self, wait: float) -> List[ChangeEvent]:
+        # Storage queues don't support long polling, so wait before polling again when empty
+        messages = list(self._queue_client.receive_messages(max_messages=self._max_messages))
+        if not messages and wait > 0:
+            time.sleep(wait)
+            messages = list(self._queue_client.receive_messages(max_messages=self._max_messages))
+        events = []
+        for message in messages:
+            self._messages.append(message)
+            events.extend(_parse_event_grid_events(message.content, self._container_name))
+        return events
+
+    def acknowledge(self) -> None:
+        messages, self._messages = self._messages, []
+        for message in messages:
+            self._queue_client.delete_message(message)
+
+    def abandon(self) -> None:
+        # The messages are received again once their visibility timeout expires
+        self._messages = []
+
+
+def _parse_gcs_event(attributes: Dict[str, str], data: bytes) -> Optional[ChangeEvent]:
+    event_type = attributes.get("eventType")
+    if event_type in ("OBJECT_FINALIZE", "OBJECT_METADATA_UPDATE"):
+        deleted = False
+    elif event_type in ("OBJECT_DELETE", "OBJECT_ARCHIVE"):
+        # The previous generation of an overwritten object is deleted, but the key still exists
+        if "overwrittenByGeneration" in attributes:
+            return None
+        deleted = True
+    else:
+        return None
+    metadata = json.loads(data) if data else {}
+    generation = metadata.get("generation", attributes.get("objectGeneration"))
+    metageneration = metadata.get("metageneration")
+    return ChangeEvent(
+        key=attributes["objectId"],
+        deleted=deleted,
+        # As for GoogleCloudStorage, etags combine the generation and metageneration
+        etag=None if deleted or metageneration is None else f"{generation}{metageneration}",
+        sequencer=None if generation is None else f"{int(generation):020d}{int(metageneration or 0):020d}",
+    )
+
+
+class PubSubChangeSource(ChangeSource):
+    def __init__(
+        self, subscription: str, bucket_name: Optional[str] = None, subscriber: Any = None, max_messages: int = 100
+    ):
+        """Receives Google Cloud Storage notifications from a Google Cloud Pub/Sub subscription.
+
+        Configure the bucket to publish notifications in the `JSON_API_V1` format to a topic, and
+        subscribe to the topic with a pull subscription.
+
+        Parameters
+        ----------
+        subscription : str
+            The path of the subscription, "projects/<project>/subscriptions/<subscription>"
+        bucket_name : str, default=None
+            Only changes to this bucket are received, or changes to any bucket if `None`
+        subscriber : google.cloud.pubsub_v1.SubscriberClient, default=None
+            The client to pull messages with, defaults to a new `SubscriberClient()`
+        max_messages : int, default=100
+            The maximum number of messages to receive at once
+        """
+        if subscriber is None:
+            from google.cloud import pubsub_v1
+
+            subscriber = pubsub_v1.SubscriberClient()
+        self._subscriber = subscriber
+        self._subscription = subscription
+        self._bucket_name = bucket_name
+        self._max_messages = max_messages
+        self._ack_ids: List[str] = []
+
+    def receive(self, wait: float) -> List[ChangeEvent]:
+        from google.api_core.exceptions import DeadlineExceeded
+
+        try:
+            response = self._subscriber.pull(
+                request={"subscription": self._subscription, "max_messages": self._max_messages},
+                timeout=max(wait, 1.0),
+            )
+        except DeadlineExceeded:
+            return []
+        events = []
+        for received in response.received_messages:
+            self._ack_ids.append(received.ack_id)
+            attributes = dict(received.message.attributes)
+            if self._bucket_name is not None and attributes.get("bucketId") != self._bucket_name:
+                continue
+            event = _parse_gcs_event(attributes, received.message.data)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def acknowledge(self) -> None:
+        ack_ids, self._ack_ids = self._ack_ids, []
+        if ack_ids:
+            self._subscriber.acknowledge(request={"subscription": self._subscription, "ack_ids": ack_ids})
+
+    def abandon(self) -> None:
+        # The messages are received again once their acknowledgement deadline expires
+        self._ack_ids = []
+
+
+class ChangeSubscriber:
+    def __init__(
+        self,
+        mapping: CloudMapping,
+        source: ChangeSource,
+        wait: float = 20.0,
+        on_error: Optional[Callable[[BaseException], None]] = None,
+    ) -> None:
+        """Keeps a `CloudMapping` in sync with the cloud by applying notifications of changes,
+        rather than by listing the cloud with `sync_with_cloud`.
+
+        Each change updates the mapping's etag for the key, so reads get the latest value and writes
+        don't raise a `cloudmappings.errors.KeySyncError` for changes already notified. Changes to keys
+        outside the mapping's key prefix are ignored, and changes received out of order are ignored
+        if they are older than a change already applied to one of the most recently changed keys. When a notification doesn't include the new
+        etag in the format of the mapping's storage provider (such as for AWS S3), it is fetched with
+        `StorageProvider.get_etag`, one small request for each changed key. It is also fetched for keys
+        the mapping has written since changes were last applied, as notifications of its own earlier
+        writes may arrive after it has written again.
+
+        Notifications are delivered some time after the change, so a mapping may still briefly be
+        out of sync. Call `start` to apply changes from a background thread, or `poll` to apply them
+        from the calling thread.
+
+        Parameters
+        ----------
+        mapping : CloudMapping
+            The mapping to keep in sync
+        source : ChangeSource
+            The source of change notifications, such as an `SQSChangeSource`, `AzureQueueChangeSource`
+            or `PubSubChangeSource`
+        wait : float, default=20.0
+            The maximum seconds the background thread waits for changes in each poll of the source
+        on_error : Callable[[BaseException], None], default=None
+            Called with errors raised polling in the background thread, which then continues. By
+            default errors are ignored
+        """
+        self._mapping = mapping
+        self._source = source
+        self._wait = wait
+        self._on_error = on_error
+        self._sequencers: "OrderedDict[str, str]" = OrderedDict()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # The keys whose etags the mapping has set since changes to them were last applied, as for syncs
+        self._written: Set[str] = set()
+        with mapping._etags_lock:
+            mapping._modified_during_syncs.append(self._written)
+
+    def apply(self, events: List[ChangeEvent]) -> int:
+        """Applies changes to the mapping, returning the number of keys of the mapping that changed"""
+        latest: Dict[str, ChangeEvent] = {}
+        sequencers: Dict[str, str] = {}
+        for event in events:
+            key = self._mapping._decode_key(event.key)
+            if key is None:
+                continue
+            sequencer = None if event.sequencer is None else event.sequencer.zfill(_sequencer_width)
+            last_sequencer = sequencers.get(key, self._sequencers.get(key))
+            if sequencer is not None and last_sequencer is not None and sequencer <= last_sequencer:
+                continue
+            if sequencer is not None:
+                sequencers[key] = sequencer
+            latest[key] = event
+        for key, event in latest.items():
+            with self._mapping._key_lock(key):
+                with self._mapping._etags_lock:
+                    written = key in self._written
+                    self._written.discard(key)
+                if written:
+                    # The notification may be of an earlier write by the mapping, so can't be trusted
+                    etag = self._mapping.storage_provider.get_etag(self._mapping._encode_key(key))
+                elif event.deleted:
+                    etag = None
+                elif event.etag is not None:
+                    etag = event.etag
+                else:
+                    etag = self._mapping.storage_provider.get_etag(self._mapping._encode_key(key))
+                self._mapping._set_etag(key, etag)
+                with self._mapping._etags_lock:
+                    self._written.discard(key)
+                self._mapping._forget_fresh_value(key)
+            # Only recorded once applied, so changes that failed to be applied are applied when received again
+            if key in sequencers:
+                self._sequencers[key] = sequencers[key]
+                self._sequencers.move_to_end(key)
+                if len(self._sequencers) > _sequencers_max_size:
+                    self._sequencers.popitem(last=False)
+        return len(latest)
+
+    def poll(self, wait: float = 0.0) -> int:
+        """Receives changes from the source and applies them, returning the number of keys of the
+        mapping that changed
+
+        Parameters
+        ----------
+        wait : float, default=0.0
+            The maximum seconds to wait for changes
+        """
+        events = self._source.receive(wait)
+        try:
+            applied = self.apply(events)
+        except BaseException:
+            self._source.abandon()
+            raise
+        self._source.acknowledge()
+        return applied
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.poll(self._wait)
+            except BaseException as e:
+                if self._on_error is not None:
+                    self._on_error(e)
+                self._stopped.wait(1.0)
+
+    def start(self) -> "ChangeSubscriber":
+        """Starts applying changes from a background thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="cloudmappings-change-subscriber", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops the background thread, after its current poll of the source"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "ChangeSubscriber":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
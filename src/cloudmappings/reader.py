@@ -0,0 +1,82 @@
+import io
+from typing import Optional
+
+from cloudmappings.storageprovider import StorageProvider
+
+
+class RangeReader(io.RawIOBase):
+    """A read-only, seekable, file-like view of the value at a key in cloud storage.
+
+    Each read downloads only the requested range of the value. Every range is downloaded from the
+    same version of the value, either the version of the etag given, or otherwise the version
+    first read from, raising a `cloudmappings.errors.KeySyncError` if it has since changed. Wrap
+    in an `io.BufferedReader` to make fewer, larger requests for many small reads."""
+
+    def __init__(self, storage_provider: StorageProvider, key: str, etag: Optional[str]) -> None:
+        self._storage_provider = storage_provider
+        self._key = key
+        self._etag = etag
+        self._size: Optional[int] = None
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    @property
+    def size(self) -> int:
+        """The size of the value in bytes"""
+        if self._size is None:
+            self._download(0, 0)
+        return self._size
+
+    @property
+    def etag(self) -> Optional[str]:
+        """The etag of the version of the value being read, `None` until first read if not given"""
+        return self._etag
+
+    def _download(self, start: int, end: Optional[int]) -> bytes:
+        downloaded = self._storage_provider.download_range(key=self._key, etag=self._etag, start=start, end=end)
+        if downloaded is None:
+            raise KeyError(self._key)
+        # Pin subsequent reads to the version read
+        self._etag, self._size = downloaded.etag, downloaded.size
+        return downloaded.data
+
+    def readinto(self, buffer) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if self._size is not None and self._position >= self._size:
+            return 0
+        data = self._download(self._position, self._position + len(buffer))
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self) -> bytes:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        data = self._download(self._position, None)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def tell(self) -> int:
+        return self._position
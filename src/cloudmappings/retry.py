@@ -0,0 +1,314 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from cloudmappings.instrumentation import current_record
+from cloudmappings.storageprovider import DownloadedRange, KeyStat, StorageProvider
+
+K = TypeVar("K")
+R = TypeVar("R")
+
+
+class AdaptiveConcurrencyLimit:
+    def __init__(
+        self,
+        initial: int = 16,
+        minimum: int = 1,
+        maximum: int = 256,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+    ) -> None:
+        """Limits the number of requests in flight at once, adjusting the limit with AIMD (additive
+        increase, multiplicative decrease) as is used for TCP congestion control.
+
+        Each request that completes without being throttled increases the limit by `increase / limit`,
+        so the limit grows by `increase` for each limit's worth of requests. Each throttled request
+        multiplies the limit by `decrease`, though only once for the requests that were already in
+        flight when the limit was last decreased. The limit so converges on the highest concurrency
+        the service sustains without throttling.
+
+        Parameters
+        ----------
+        initial : int, default=16
+            The initial number of concurrent requests allowed
+        minimum : int, default=1
+            The lowest the limit will decrease to
+        maximum : int, default=256
+            The highest the limit will increase to
+        increase : float, default=1.0
+            The amount the limit increases by after each limit's worth of successful requests
+        decrease : float, default=0.5
+            The factor the limit is multiplied by when requests are throttled
+        """
+        self._limit = float(initial)
+        self._minimum = minimum
+        self._maximum = maximum
+        self._increase = increase
+        self._decrease = decrease
+        self._in_flight = 0
+        self._decreases = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        """The current number of concurrent requests allowed"""
+        return max(self._minimum, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        """The number of requests currently in flight"""
+        return self._in_flight
+
+    def acquire(self) -> int:
+        """Waits until another request may be made. Returns a token to pass to `release`."""
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+            return self._decreases
+
+    def release(self, token: int, throttled: bool) -> None:
+        """Records that a request has completed, and whether it was throttled"""
+        with self._condition:
+            self._in_flight -= 1
+            if not throttled:
+                self._limit = min(self._maximum, self._limit + self._increase / self._limit)
+            elif token == self._decreases:
+                # Only decrease once for a window of requests, those started after the last decrease
+                self._limit = max(self._minimum, self._limit * self._decrease)
+                self._decreases += 1
+            self._condition.notify_all()
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = 8,
+        initial_backoff: float = 0.1,
+        max_backoff: float = 20.0,
+        backoff_multiplier: float = 2.0,
+        concurrency_limit: Optional[AdaptiveConcurrencyLimit] = None,
+        seed: Optional[int] = None,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        """Retries requests to cloud storage that fail with transient errors, such as throttling,
+        with exponential backoff, and adapts the number of requests made concurrently.
+
+        Which errors are retried is decided by each storage provider's `is_retryable_error`, for
+        example an AWS S3 `SlowDown`, an Azure `503 ServerBusy` or a Google Cloud Storage `429`.
+        The wait before each retry is chosen at random between zero and the exponential backoff
+        ("full jitter"), so clients that were throttled together do not all retry together.
+
+        Pass an instance to `CloudStorage.create_mapping` to enable it. Pass the same instance to
+        many mappings to share one concurrency limit between them.
+
+        Note that if the response to an upload or delete is lost after it was made, its retry
+        raises a `cloudmappings.errors.KeySyncError` as the etag in the cloud has since changed.
+
+        Parameters
+        ----------
+        max_attempts : int, default=8
+            The maximum number of times a request is attempted, including the first attempt
+        initial_backoff : float, default=0.1
+            Seconds of the backoff before the first retry
+        max_backoff : float, default=20.0
+            The maximum seconds of backoff before any retry
+        backoff_multiplier : float, default=2.0
+            The factor the backoff is multiplied by after each retry
+        concurrency_limit : AdaptiveConcurrencyLimit, default=None
+            Limits the number of requests in flight, defaults to an `AdaptiveConcurrencyLimit()`
+        seed : int, default=None
+            Seed for the random number generator used for jitter
+        sleep : Callable[[float], None], default=time.sleep
+            Function used to wait before retrying
+        """
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff_multiplier = backoff_multiplier
+        self.concurrency_limit = concurrency_limit if concurrency_limit is not None else AdaptiveConcurrencyLimit()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._sleep = sleep
+
+    def __reduce__(self):
+        # Pickled (for example for the workers of `CloudMapping.map_values`) with a new concurrency limit,
+        # as limits are only shared between the threads of one process
+        return (RetryPolicy, (self.max_attempts, self.initial_backoff, self.max_backoff, self.backoff_multiplier))
+
+    def backoff(self, retry: int) -> float:
+        """Seconds to wait before the given retry, counting from 1"""
+        ceiling = min(self.max_backoff, self.initial_backoff * self.backoff_multiplier ** (retry - 1))
+        with self._random_lock:
+            return self._random.uniform(0, ceiling)
+
+    def call(self, request: Callable[[], R], is_retryable: Callable[[BaseException], bool]) -> R:
+        """Makes a request, retrying it while it raises errors for which `is_retryable` is `True`"""
+        attempt = 1
+        while True:
+            token = self.concurrency_limit.acquire()
+            try:
+                result = request()
+            except BaseException as e:
+                retryable = is_retryable(e)
+                self.concurrency_limit.release(token, throttled=retryable)
+                if not retryable or attempt >= self.max_attempts:
+                    raise
+            else:
+                self.concurrency_limit.release(token, throttled=False)
+                return result
+            # Annotate the instrumented record of the operation, if any
+            record = current_record()
+            if record is not None:
+                record.retries += 1
+            self._sleep(self.backoff(attempt))
+            attempt += 1
+
+    def call_many(
+        self,
+        request: Callable[[List[K]], Tuple[Dict[K, R], Dict[K, BaseException]]],
+        keys: List[K],
+        is_retryable: Callable[[BaseException], bool],
+    ) -> Tuple[Dict[K, R], Dict[K, BaseException]]:
+        """Makes a batch request for many keys, which returns the result of each key that succeeded and the
+        error of each key that failed. Only the keys that failed with errors for which `is_retryable` is
+        `True` are retried, together as a smaller batch, and the batch is throttled if any of them were."""
+        results: Dict[K, R] = {}
+        errors: Dict[K, BaseException] = {}
+        attempt = 1
+        while True:
+            token = self.concurrency_limit.acquire()
+            try:
+                batch_results, batch_errors = request(keys)
+            except BaseException as e:
+                retryable = is_retryable(e)
+                self.concurrency_limit.release(token, throttled=retryable)
+                if not retryable or attempt >= self.max_attempts:
+                    raise
+            else:
+                results.update(batch_results)
+                errors.update(batch_errors)
+                keys = [k for k, e in batch_errors.items() if is_retryable(e)]
+                self.concurrency_limit.release(token, throttled=bool(keys))
+                if not keys or attempt >= self.max_attempts:
+                    return results, errors
+                for key in keys:
+                    del errors[key]
+            # Annotate the instrumented record of the operation, if any
+            record = current_record()
+            if record is not None:
+                record.retries += 1
+            self._sleep(self.backoff(attempt))
+            attempt += 1
+
+
+class RetryingStorageProvider(StorageProvider):
+    """A `StorageProvider` that retries the transient errors of the `StorageProvider` it wraps"""
+
+    def __init__(self, storage_provider: StorageProvider, retry_policy: RetryPolicy) -> None:
+        self._storage_provider = storage_provider
+        self._retry_policy = retry_policy
+
+    @property
+    def wrapped_storage_provider(self) -> StorageProvider:
+        return self._storage_provider
+
+    def _call(self, request: Callable[[], R]) -> R:
+        return self._retry_policy.call(request, self._storage_provider.is_retryable_error)
+
+    def logical_name(self) -> str:
+        return self._storage_provider.logical_name()
+
+    def create_if_not_exists(self) -> bool:
+        return self._call(self._storage_provider.create_if_not_exists)
+
+    def encode_key(self, unsafe_key) -> str:
+        return self._storage_provider.encode_key(unsafe_key)
+
+    def decode_key(self, encoded_key) -> str:
+        return self._storage_provider.decode_key(encoded_key)
+
+    def is_retryable_error(self, error: BaseException) -> bool:
+        return self._storage_provider.is_retryable_error(error)
+
+    def download_data(self, key: str, etag: str) -> bytes:
+        return self._call(lambda: self._storage_provider.download_data(key=key, etag=etag))
+
+    def download_buffer(self, key: str, etag: Optional[str]) -> memoryview:
+        return self._call(lambda: self._storage_provider.download_buffer(key=key, etag=etag))
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        return self._call(lambda: self._storage_provider.download_range(key=key, etag=etag, start=start, end=end))
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        return self._call(lambda: self._storage_provider.download_data_if_changed(key=key, etag=etag))
+
+    def exists(self, key: str) -> bool:
+        return self._call(lambda: self._storage_provider.exists(key))
+
+    def get_etag(self, key: str) -> Optional[str]:
+        return self._call(lambda: self._storage_provider.get_etag(key))
+
+    def upload_data(self, key: str, etag: str, data: bytes) -> str:
+        return self._call(lambda: self._storage_provider.upload_data(key=key, etag=etag, data=data))
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        return self._call(
+            lambda: self._storage_provider.copy_data(source_key=source_key, source_etag=source_etag, key=key, etag=etag)
+        )
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        return self._call(lambda: self._storage_provider.append_data(key=key, etag=etag, data=data))
+
+    def delete_data(self, key: str, etag: str) -> None:
+        self._call(lambda: self._storage_provider.delete_data(key=key, etag=etag))
+
+    def _batches_natively(self, method: str) -> bool:
+        # Whether the wrapped provider implements a method for many keys itself, rather than by default making
+        # a request for each key concurrently, in which case each of those requests is retried by this provider
+        return getattr(type(self._storage_provider), method) is not getattr(StorageProvider, method)
+
+    def download_many(
+        self, keys_and_etags: Dict[str, Optional[str]], max_workers: int = 16
+    ) -> Dict[str, Optional[bytes]]:
+        if not self._batches_natively("download_many"):
+            return super().download_many(keys_and_etags, max_workers=max_workers)
+        return self._call(lambda: self._storage_provider.download_many(keys_and_etags, max_workers=max_workers))
+
+    def upload_many(
+        self, keys_etags_and_data: Dict[str, Tuple[Optional[str], bytes]], max_workers: int = 16
+    ) -> Tuple[Dict[str, str], Dict[str, BaseException]]:
+        if not self._batches_natively("upload_many"):
+            return super().upload_many(keys_etags_and_data, max_workers=max_workers)
+        return self._retry_policy.call_many(
+            lambda keys: self._storage_provider.upload_many(
+                {k: keys_etags_and_data[k] for k in keys}, max_workers=max_workers
+            ),
+            list(keys_etags_and_data),
+            self._storage_provider.is_retryable_error,
+        )
+
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        if not self._batches_natively("delete_many"):
+            return super().delete_many(keys_and_etags, max_workers=max_workers)
+        _, errors = self._retry_policy.call_many(
+            lambda keys: ({}, self._storage_provider.delete_many({k: keys_and_etags[k] for k in keys}, max_workers)),
+            list(keys_and_etags),
+            self._storage_provider.is_retryable_error,
+        )
+        return errors
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        return self._call(lambda: self._storage_provider.list_keys_and_etags_delimited(key_prefix, delimiter))
+
+    def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
+        return self._call(lambda: self._storage_provider.list_keys_and_etags(key_prefix))
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        return self._call(lambda: self._storage_provider.list_keys_and_stats_delimited(key_prefix, delimiter))
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        return self._call(lambda: self._storage_provider.list_keys_and_stats(key_prefix))
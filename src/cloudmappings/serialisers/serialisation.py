@@ -5,6 +5,11 @@ from typing import Callable, Generic, List, TypeVar
 T = TypeVar("T")
 
 
+def _apply(input, func):
+    # A module level function, so that chained serialisations may be pickled
+    return func(input)
+
+
 @dataclass(frozen=True)
 class CloudMappingSerialisation(Generic[T]):
     """A combination of a dumps and a loads function, to control serialisation of objects
@@ -55,10 +60,6 @@ class CloudMappingSerialisation(Generic[T]):
         CloudMappingSerialisation
             A CloudMappingSerialisation with the given dumps and loads functions chained together
         """
-
-        def _apply(input, func):
-            return func(input)
-
         return CloudMappingSerialisation(
             dumps=partial(reduce, _apply, ordered_dumps_funcs),
             loads=partial(reduce, _apply, ordered_loads_funcs),
@@ -0,0 +1,356 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, MutableMapping, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, key locks are then only held within a single process
+    fcntl = None
+
+_schema = """
+CREATE TABLE IF NOT EXISTS etags (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS syncs (
+    namespace TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    synced REAL NOT NULL
+);
+"""
+
+
+def _process_is_alive(pid: int) -> bool:
+    if os.name == "nt":
+        return True  # os.kill would signal the process on Windows, so assume it is alive
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedEtagIndex:
+    def __init__(
+        self,
+        path: str,
+        timeout: float = 60.0,
+        mmap_size: int = 1024 * 1024 * 1024,
+        max_sync_age: Optional[float] = 3600.0,
+    ) -> None:
+        """An index of etags shared by `CloudMapping`s in many processes on the same host.
+
+        Pass the same index to `CloudStorage.create_mapping` in each process, for example each worker
+        of a multiprocessing or Dask pool. The first mapping created for each storage provider and key
+        prefix lists the cloud, and the other processes wait for and then use its listing instead of
+        each making their own. Writes and deletes from any process update the shared etags, so a value
+        written by one worker may be read or overwritten by the others without syncing.
+
+        The index is stored in a memory-mapped SQLite database at the given path, so each process reads
+        etags from the same pages of the OS page cache rather than holding its own copy. The path must
+        be on a local file system, as SQLite's locking is not reliable over network file systems.
+
+        An index may be pickled to send it to other processes, each process opens its own connections.
+
+        Parameters
+        ----------
+        path : str
+            Path of the database file to store the index in, it is created if it does not exist
+        timeout : float, default=60.0
+            Seconds to wait for another process to release its lock on the index before raising an error
+        mmap_size : int, default=1GiB
+            Maximum number of bytes of the database to memory map
+        max_sync_age : float, optional, default=3600.0
+            Seconds after a namespace was listed that the next mapping created for it lists the cloud again,
+            replacing every etag of the namespace, so a later run reusing the path doesn't use stale etags.
+            Should be longer than the mappings of one run take to be created. Never listed again if `None`,
+            see also `reset`
+        """
+        self._path = path
+        self._timeout = timeout
+        self._mmap_size = mmap_size
+        self._max_sync_age = max_sync_age
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(_schema)
+
+    def __getstate__(self):
+        return (self._path, self._timeout, self._mmap_size, self._max_sync_age)
+
+    def __setstate__(self, state) -> None:
+        self.__init__(*state)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can't be shared between threads, or with forked processes
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={int(self._mmap_size)}")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def key_locks(self, namespace: str, stripes: int = 4096) -> "CrossProcessStripedLocks":
+        """Gets striped locks for the keys within a namespace of the index, which are held across
+        all processes using the index"""
+        return CrossProcessStripedLocks(f"{self._path}.locks", namespace, stripes)
+
+    def etags(self, namespace: str) -> "SharedEtags":
+        """Gets a dict-like view of the etags within a namespace of the index"""
+        return SharedEtags(self, namespace)
+
+    def sync_once(self, namespace: str, sync: Callable[[], None], poll_interval: float = 0.05) -> bool:
+        """Calls sync to populate a namespace of the index, unless another process has already
+        done so, or is doing so, in which case this waits for it to finish.
+
+        Returns
+        -------
+        bool
+            `True` if this process synced the namespace, otherwise `False`
+        """
+        connection = self._connection()
+        while True:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT pid, synced FROM syncs WHERE namespace = ?", (namespace,)).fetchone()
+                expired = (
+                    row is not None
+                    and row[1]
+                    and self._max_sync_age is not None
+                    and time.time() - row[1] > self._max_sync_age
+                )
+                if row is not None and not expired and (row[1] or _process_is_alive(row[0])):
+                    claimed = False
+                else:
+                    # Nobody has synced, the process syncing has died, or the listing is too old, so take ownership
+                    if expired:
+                        connection.execute("DELETE FROM etags WHERE namespace = ?", (namespace,))
+                    connection.execute(
+                        "INSERT OR REPLACE INTO syncs (namespace, pid, synced) VALUES (?, ?, 0)",
+                        (namespace, os.getpid()),
+                    )
+                    claimed = True
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            if claimed:
+                break
+            if row[1]:
+                return False
+            time.sleep(poll_interval)
+
+        try:
+            sync()
+        except BaseException:
+            connection.execute("DELETE FROM syncs WHERE namespace = ?", (namespace,))
+            raise
+        connection.execute("UPDATE syncs SET synced = ? WHERE namespace = ?", (time.time(), namespace))
+        return True
+
+    def reset(self, namespace: Optional[str] = None) -> None:
+        """Forgets the etags of a namespace, or of every namespace, so the next mapping created for it
+        lists the cloud again. Call before reusing an index whose etags may be stale, such as from a
+        previous run, while no mappings are using it."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if namespace is None:
+                connection.execute("DELETE FROM etags")
+                connection.execute("DELETE FROM syncs")
+            else:
+                connection.execute("DELETE FROM etags WHERE namespace = ?", (namespace,))
+                connection.execute("DELETE FROM syncs WHERE namespace = ?", (namespace,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+
+class SharedEtags(MutableMapping[str, str]):
+    """A dict-like view of the etags in one namespace of a `SharedEtagIndex`. Each operation reads
+    or writes the index directly, so reflects changes made by other processes."""
+
+    def __init__(self, index: SharedEtagIndex, namespace: str) -> None:
+        self._index = index
+        self._namespace = namespace
+
+    @property
+    def namespace(self) -> str:
+        return self._namespace
+
+    def __getitem__(self, key: str) -> str:
+        row = (
+            self._index._connection()
+            .execute("SELECT etag FROM etags WHERE namespace = ? AND key = ?", (self._namespace, key))
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key: str, etag: str) -> None:
+        self._index._connection().execute(
+            "INSERT OR REPLACE INTO etags (namespace, key, etag) VALUES (?, ?, ?)", (self._namespace, key, etag)
+        )
+
+    def __delitem__(self, key: str) -> None:
+        cursor = self._index._connection().execute(
+            "DELETE FROM etags WHERE namespace = ? AND key = ?", (self._namespace, key)
+        )
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return (
+            self._index._connection()
+            .execute("SELECT 1 FROM etags WHERE namespace = ? AND key = ?", (self._namespace, key))
+            .fetchone()
+            is not None
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        rows = (
+            self._index._connection()
+            .execute("SELECT key FROM etags WHERE namespace = ? ORDER BY key", (self._namespace,))
+            .fetchall()
+        )
+        return (r[0] for r in rows)
+
+    def __len__(self) -> int:
+        return (
+            self._index._connection()
+            .execute("SELECT COUNT(*) FROM etags WHERE namespace = ?", (self._namespace,))
+            .fetchone()[0]
+        )
+
+    def update(self, other: Union[MutableMapping[str, str], Iterable[Tuple[str, str]]] = (), **kwargs: str) -> None:
+        # Write all etags in a single transaction, rather than one per key
+        items = list(other.items() if hasattr(other, "items") else other) + list(kwargs.items())
+        connection = self._index._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO etags (namespace, key, etag) VALUES (?, ?, ?)",
+                ((self._namespace, k, e) for k, e in items),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _items(self) -> Iterator[Tuple[str, str]]:
+        return iter(
+            self._index._connection()
+            .execute("SELECT key, etag FROM etags WHERE namespace = ? ORDER BY key", (self._namespace,))
+            .fetchall()
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not hasattr(other, "items"):
+            return NotImplemented
+        return dict(self._items()) == dict(other.items())
+
+    def __repr__(self) -> str:
+        return f"SharedEtags<{self._index.path}, {self._namespace}>"
+
+
+class _ProcessLockFile:
+    """The lock file of an index, and the state of its stripes, within one process.
+
+    `fcntl.lockf` locks are held by the process rather than by each open file, and are all released
+    when any of the process's descriptors of the file is closed, so every `CrossProcessStripedLocks`
+    of the same file in a process must share one descriptor, and one count of holds of each stripe."""
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "a+b") if fcntl is not None else None
+        self._guard = threading.Lock()
+        self._locks: Dict[int, threading.RLock] = {}
+        self._depths: Dict[int, int] = {}
+
+    def acquire(self, stripe: int) -> None:
+        with self._guard:
+            lock = self._locks.setdefault(stripe, threading.RLock())
+        lock.acquire()
+        # The depth of each stripe is only changed by the thread holding its lock
+        self._depths[stripe] = self._depths.get(stripe, 0) + 1
+        if self._depths[stripe] == 1 and self._file is not None:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, 1, stripe)
+
+    def release(self, stripe: int) -> None:
+        self._depths[stripe] -= 1
+        if self._depths[stripe] == 0 and self._file is not None:
+            fcntl.lockf(self._file, fcntl.LOCK_UN, 1, stripe)
+        self._locks[stripe].release()
+
+
+# The lock file of each path, per process, as locks are not inherited by forked processes
+_process_lock_files: Dict[Tuple[str, int], _ProcessLockFile] = {}
+_process_lock_files_lock = threading.Lock()
+
+
+def _process_lock_file(path: str) -> _ProcessLockFile:
+    with _process_lock_files_lock:
+        lock_file = _process_lock_files.get((path, os.getpid()))
+        if lock_file is None:
+            lock_file = _process_lock_files[(path, os.getpid())] = _ProcessLockFile(path)
+        return lock_file
+
+
+class CrossProcessStripedLocks:
+    """Striped locks that are held both between threads, and between processes on the same host.
+
+    Each stripe is a byte of a shared lock file, locked with `fcntl.lockf`. As these locks are held
+    by a process rather than a thread, each stripe also has a reentrant lock within the process,
+    shared by all instances locking the same file."""
+
+    def __init__(self, path: str, namespace: str, stripes: int) -> None:
+        self._path = path
+        self._namespace = namespace
+        self._stripes = stripes
+
+    def _stripe(self, key: str) -> int:
+        # Python's hash of strings differs between processes, so use a stable hash
+        return zlib.crc32(f"{self._namespace}|{key}".encode("utf-8")) % self._stripes
+
+    def _acquire(self, stripe: int) -> None:
+        _process_lock_file(self._path).acquire(stripe)
+
+    def _release(self, stripe: int) -> None:
+        _process_lock_file(self._path).release(stripe)
+
+    @contextmanager
+    def __call__(self, key: str) -> Iterator[None]:
+        stripe = self._stripe(key)
+        self._acquire(stripe)
+        try:
+            yield
+        finally:
+            self._release(stripe)
+
+    @contextmanager
+    def many(self, keys: Iterable[str]) -> Iterator[None]:
+        # Stripes are locked in ascending order, so threads and processes locking many keys can't deadlock
+        stripes = sorted({self._stripe(key) for key in keys})
+        acquired = []
+        try:
+            for stripe in stripes:
+                self._acquire(stripe)
+                acquired.append(stripe)
+            yield
+        finally:
+            for stripe in reversed(acquired):
+                self._release(stripe)
@@ -1,11 +1,80 @@
+import os
 from abc import ABC, abstractmethod
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 from urllib.parse import quote, unquote
 
+from cloudmappings.errors import KeySyncError, ThrottlingError
+
+# The number of levels of the key space delimited listings may descend to find partitions to list
+_max_partition_depth = 3
+
+
+class DownloadedRange(NamedTuple):
+    """A range of the data at a key, as downloaded by `StorageProvider.download_range`"""
+
+    data: bytes
+    """The data within the range"""
+    size: int
+    """The size in bytes of all the data at the key"""
+    etag: str
+    """The etag of the data the range was downloaded from"""
+
+
+class KeyStat(NamedTuple):
+    """The metadata of the value at a key, as listed by `StorageProvider.list_keys_and_stats`"""
+
+    etag: str
+    """The etag of the value"""
+    size: Optional[int]
+    """The size in bytes of the value, or `None` if the storage does not list sizes"""
+    last_modified: Optional[datetime]
+    """When the value was last modified, or `None` if the storage does not list modification times"""
+
+
+def resolve_range(start: int, end: Optional[int], size: int) -> Tuple[int, int]:
+    """Resolves a range with the semantics of a python slice, `data[start:end]`, to the absolute
+    offsets of its first byte and the byte after its last byte within data of the given size"""
+    offset, stop, _ = slice(start, end).indices(size)
+    return offset, max(offset, stop)
+
+
+def _concurrent_errors(request: Callable[[str], None], keys: List[str], max_workers: int) -> Dict[str, BaseException]:
+    """Makes a request for each key concurrently, returning the error raised for each key that failed"""
+
+    def request_error(key: str) -> Optional[BaseException]:
+        try:
+            request(key)
+        except Exception as e:
+            return e
+        return None
+
+    if not keys:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        return {k: e for k, e in zip(keys, executor.map(request_error, keys)) if e is not None}
+
+
+def _construct(cls: type, args: tuple, kwargs: dict) -> "StorageProvider":
+    return cls(*args, **kwargs)
+
 
 class StorageProvider(ABC):
     """Provides a consistent interface for interacting with Cloud Storage Providers."""
 
+    def __new__(cls, *args, **kwargs) -> "StorageProvider":
+        # Keep the arguments each provider is constructed with, so that it may be pickled
+        provider = super().__new__(cls)
+        provider._constructor_args = (args, kwargs)
+        return provider
+
+    def __reduce__(self):
+        # Unpickling constructs the provider again, so that each process (for example the workers of
+        # `CloudMapping.map_values`) creates its own clients and connections rather than sharing them
+        args, kwargs = self._constructor_args
+        return (_construct, (type(self), args, kwargs))
+
     @abstractmethod
     def logical_name(self) -> str:
         """Returns a human readable string identifying the current implementation, and which
@@ -67,6 +136,23 @@ class StorageProvider(ABC):
         """
         return unquote(encoded_key, errors="strict")
 
+    def is_retryable_error(self, error: BaseException) -> bool:
+        """Whether an error raised by this storage provider is transient, such as throttling or a
+        dropped connection, and so the request may succeed if retried. Defaults to `True` for
+        `cloudmappings.errors.ThrottlingError`, `ConnectionError` and `TimeoutError`
+
+        Parameters
+        ----------
+        error: BaseException
+            The error raised by a call to this storage provider
+
+        Returns
+        -------
+        bool
+            `True` if the request may be retried
+        """
+        return isinstance(error, (ThrottlingError, ConnectionError, TimeoutError))
+
     @abstractmethod
     def download_data(self, key: str, etag: str) -> bytes:
         """Download data from cloud storage
@@ -97,6 +183,135 @@ class StorageProvider(ABC):
         """
         pass
 
+    def download_buffer(self, key: str, etag: Optional[str]) -> memoryview:
+        """Download data from cloud storage as a read-only buffer
+
+        As `download_data`, but providers with the data on local disk, such as the local file system
+        or a local cache, return a `memoryview` of the file mapped into memory with `mmap` rather
+        than a copy. The pages of the file are then loaded lazily, and shared through the OS page
+        cache with other processes mapping the same file. Defaults to a view of `download_data`.
+
+        Parameters
+        ----------
+        key : str
+            The encoded key specifying which data to download
+        etag : str or None
+            Etag of the expected latest value in the cloud, or `None`
+
+        Raises
+        ------
+        KeySyncError
+            If an etag is specified and does not match the latest version in the cloud.
+
+        Returns
+        -------
+        memoryview
+            A read-only view of the data, or `None` if no etag is specified and there is no data at the key
+        """
+        data = self.download_data(key=key, etag=etag)
+        return None if data is None else memoryview(data)
+
+    def download_many(
+        self, keys_and_etags: Dict[str, Optional[str]], max_workers: int = 16
+    ) -> Dict[str, Optional[bytes]]:
+        """Download data at many keys from cloud storage.
+
+        As `download_data` for each key. Providers that store many values within each object read
+        the values of the same object together, otherwise defaults to downloading each key concurrently.
+
+        Parameters
+        ----------
+        keys_and_etags : Dict[str, Optional[str]]
+            A dictionary mapping each encoded key to download to the etag of its expected value in the
+            cloud, or `None` to download the latest value
+        max_workers : int, default=16
+            The maximum number of requests to make concurrently
+
+        Returns
+        -------
+        Dict[str, Optional[bytes]]
+            The data at each key, or `None` when a key without an expected etag has no data
+
+        Raises
+        ------
+        KeySyncError
+            When an etag specified does not match the value in the cloud
+        """
+        keys = list(keys_and_etags)
+        if not keys:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+            return dict(zip(keys, executor.map(lambda k: self.download_data(key=k, etag=keys_and_etags[k]), keys)))
+
+    def download_data_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        """Download data from cloud storage, only if it has changed
+
+        Downloads the data at the specified key only if its etag differs from the given etag, for
+        example the etag of a copy of the data already held. Providers that support conditional
+        requests make a single request, which transfers no data when the etag is unchanged.
+        Defaults to listing the key to get its latest etag, and downloading it if it has changed.
+
+        Parameters
+        ----------
+        key : str
+            The encoded key specifying which data to download
+        etag : str or None
+            Etag of the data already held, or `None` to always download
+
+        Returns
+        -------
+        Tuple[Optional[bytes], Optional[str]]
+            The data from the cloud and its latest etag. The data is `None` if the etag is unchanged,
+            and both are `None` if there is no data at the key
+        """
+        while True:
+            latest_etag = self.list_keys_and_etags(key).get(key)
+            if latest_etag is None or latest_etag == etag:
+                return None, latest_etag
+            try:
+                return self.download_data(key=key, etag=latest_etag), latest_etag
+            except KeySyncError:
+                pass  # Changed since listing, list it again
+
+    def download_range(self, key: str, etag: Optional[str], start: int, end: Optional[int]) -> DownloadedRange:
+        """Download a range of the data at a key from cloud storage
+
+        The range has the semantics of a python slice, `data[start:end]`, so a negative `start`
+        with no `end` gets a suffix of the data. As with `download_data`, if an etag is given it
+        is used to ensure the range is downloaded from the expected version of the data. Providers
+        that support ranged requests only transfer the range. Defaults to downloading all the data.
+
+        Parameters
+        ----------
+        key : str
+            The encoded key specifying which data to download
+        etag : str or None
+            Etag of the expected latest value in the cloud, or `None`
+        start : int
+            The offset of the first byte of the range, counting from the end if negative
+        end : int or None
+            The offset of the byte after the last byte of the range, counting from the end if
+            negative, or `None` for the end of the data
+
+        Raises
+        ------
+        KeySyncError
+            If an etag is specified and does not match the latest version in the cloud.
+
+        Returns
+        -------
+        DownloadedRange
+            The data in the range, the size of all the data and its etag. `None` if no etag is
+            specified and there is no data at the key
+        """
+        data, existing_etag = self.download_data_if_changed(key=key, etag=None)
+        if etag is not None and etag != existing_etag:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        if data is None:
+            return None
+        offset, stop = resolve_range(start, end, len(data))
+        return DownloadedRange(data=data[offset:stop], size=len(data), etag=existing_etag)
+
     @abstractmethod
     def upload_data(self, key: str, etag: str, data: bytes) -> str:
         """Upload data to cloud storage
@@ -149,6 +364,198 @@ class StorageProvider(ABC):
         """
         pass
 
+    def upload_many(
+        self, keys_etags_and_data: Dict[str, Tuple[Optional[str], bytes]], max_workers: int = 16
+    ) -> Tuple[Dict[str, str], Dict[str, BaseException]]:
+        """Upload data to many keys in cloud storage.
+
+        As `upload_data` for each key, only uploading data where the etag matches. Providers that store
+        many values within each object upload the values together, otherwise defaults to uploading each
+        key concurrently.
+
+        Parameters
+        ----------
+        keys_etags_and_data : Dict[str, Tuple[Optional[str], bytes]]
+            A dictionary mapping each encoded key to upload to the etag of its expected value in the
+            cloud (`None` if no value is expected), and the data to upload
+        max_workers : int, default=16
+            The maximum number of requests to make concurrently
+
+        Returns
+        -------
+        Tuple[Dict[str, str], Dict[str, BaseException]]
+            The etag of the newly uploaded data at each key uploaded, and the error for each key that
+            could not be uploaded, such as a `cloudmappings.errors.KeySyncError`
+        """
+        etags = {}
+
+        def upload(key: str) -> None:
+            etag, data = keys_etags_and_data[key]
+            etags[key] = self.upload_data(key=key, etag=etag, data=data)
+
+        errors = _concurrent_errors(upload, list(keys_etags_and_data), max_workers)
+        return etags, errors
+
+    def delete_many(self, keys_and_etags: Dict[str, str], max_workers: int = 16) -> Dict[str, BaseException]:
+        """Delete data at many keys from cloud storage.
+
+        As `delete_data` for each key, only deleting data whose etag matches. Providers with batch
+        APIs delete many keys in each request, otherwise defaults to deleting each key concurrently.
+
+        Parameters
+        ----------
+        keys_and_etags : Dict[str, str]
+            A dictionary mapping each encoded key to delete to the etag of its expected value in the cloud
+        max_workers : int, default=16
+            The maximum number of requests to make concurrently
+
+        Returns
+        -------
+        Dict[str, BaseException]
+            The error for each key that could not be deleted, such as a `cloudmappings.errors.KeySyncError`
+            when the etag does not match the value in the cloud. Empty if all keys were deleted
+        """
+        return _concurrent_errors(
+            lambda key: self.delete_data(key=key, etag=keys_and_etags[key]), list(keys_and_etags), max_workers
+        )
+
+    def copy_data(self, source_key: str, source_etag: Optional[str], key: str, etag: Optional[str]) -> str:
+        """Copy data from one key to another within cloud storage.
+
+        Copies the data at the source key, only if its etag matches, to the key, only if the etag of
+        the key matches as for `upload_data`. Providers copy the data within the cloud, without it
+        being downloaded. Defaults to downloading the data and uploading it again.
+
+        Parameters
+        ----------
+        source_key : str
+            The encoded key of the data to copy
+        source_etag : str or None
+            Etag of the expected value at the source key, or `None` to copy the latest value
+        key : str
+            The encoded key to copy the data to
+        etag : str or None
+            Etag of the expected value at the key, `None` if no value is expected
+
+        Returns
+        -------
+        str
+            Etag of the copied data at the key
+
+        Raises
+        ------
+        KeySyncError
+            When either etag does not match the value in the cloud, or there is no data at the source key
+        """
+        data = self.download_data(key=source_key, etag=source_etag)
+        if data is None:
+            raise KeySyncError(storage_provider_name=self.logical_name(), key=source_key, etag=source_etag)
+        return self.upload_data(key=key, etag=etag, data=data)
+
+    def append_data(self, key: str, etag: Optional[str], data: bytes) -> str:
+        """Append data to the end of the data at a key in cloud storage.
+
+        Only appends if the etag of the key matches as for `upload_data`, creating the key if `etag`
+        is `None`. Providers append within the cloud, so only the appended data is uploaded. Defaults
+        to downloading the data and uploading it again with the data appended.
+
+        Parameters
+        ----------
+        key : str
+            The encoded key to append the data to
+        etag : str or None
+            Etag of the expected value at the key, `None` if no value is expected
+        data : bytes
+            The data to append
+
+        Returns
+        -------
+        str
+            Etag of the data at the key after appending
+
+        Raises
+        ------
+        KeySyncError
+            When the etag does not match the value in the cloud
+        """
+        if not isinstance(data, bytes):
+            raise ValueError(f"Data must be bytes like, got {type(data)}")
+        existing = b""
+        if etag is not None:
+            existing = self.download_data(key=key, etag=etag)
+            if existing is None:
+                raise KeySyncError(storage_provider_name=self.logical_name(), key=key, etag=etag)
+        return self.upload_data(key=key, etag=etag, data=existing + data)
+
+    def exists(self, key: str) -> bool:
+        """Whether there is data at a key in cloud storage
+
+        Providers check the single key with one request, such as a HEAD request. Defaults to
+        listing the keys beginning with the key.
+
+        Parameters
+        ----------
+        key : str
+            The encoded key to check
+
+        Returns
+        -------
+        bool
+            `True` if there is data at the key
+        """
+        return key in self.list_keys_and_etags(key)
+
+    def get_etag(self, key: str) -> Optional[str]:
+        """Get the latest etag of the data at a key in cloud storage, without downloading it
+
+        Providers check the single key with one request, such as a HEAD request. Defaults to
+        listing the keys beginning with the key.
+
+        Parameters
+        ----------
+        key : str
+            The encoded key to get the etag of
+
+        Returns
+        -------
+        str
+            The latest etag of the data at the key, or `None` if there is no data at the key
+        """
+        return self.list_keys_and_etags(key).get(key)
+
+    def exists_many(self, keys: Iterable[str], max_workers: int = 16, use_listing: bool = False) -> Dict[str, bool]:
+        """Whether there is data at each of many keys in cloud storage
+
+        Either checks each key concurrently with `exists`, or makes one listing of the prefix the
+        keys share, which is fewer requests when the keys are dense under that prefix. A listing
+        pages through every key under the prefix, so is only made when asked for.
+
+        Parameters
+        ----------
+        keys : Iterable[str]
+            The encoded keys to check
+        max_workers : int, default=16
+            The maximum number of keys to check concurrently
+        use_listing : bool, default=False
+            Whether to list the shared prefix of the keys, rather than checking each. Only fewer
+            requests when the keys make up most of the keys under that prefix
+
+        Returns
+        -------
+        Dict[str, bool]
+            A dictionary mapping each key to whether there is data at it
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        if use_listing:
+            listed = self.list_keys_and_etags(os.path.commonprefix(keys))
+            return {k: k in listed for k in keys}
+        if len(keys) == 1:
+            return {keys[0]: self.exists(keys[0])}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+            return dict(zip(keys, executor.map(self.exists, keys)))
+
     @abstractmethod
     def list_keys_and_etags(self, key_prefix: str) -> Dict[str, str]:
         """List keys and etags from the cloud storage.
@@ -169,3 +576,123 @@ class StorageProvider(ABC):
             A dictionary mapping each key in the cloud to it's latest etag
         """
         pass
+
+    def list_keys_and_etags_delimited(self, key_prefix: str, delimiter: str = "/") -> Tuple[Dict[str, str], List[str]]:
+        """List the keys and etags directly beneath a prefix, and the prefixes of the keys nested beneath it.
+
+        As a delimiter listing, keys beginning with the prefix that contain the delimiter after it
+        are not returned, instead the prefix up to and including the delimiter is returned once for
+        all of them. This discovers the layout of the key space, so it can be listed concurrently.
+        Defaults to listing all keys beginning with the prefix, returning no nested prefixes.
+
+        Parameters
+        ----------
+        key_prefix : str
+            An encoded prefix specifying a subset of keys to query
+        delimiter : str, default="/"
+            The delimiter of levels of the key space
+
+        Returns
+        -------
+        Tuple[Dict[str, str], List[str]]
+            A dictionary mapping each key directly beneath the prefix to it's latest etag, and the
+            prefixes of the keys nested further beneath it
+        """
+        return self.list_keys_and_etags(key_prefix), []
+
+    def list_keys_and_stats(self, key_prefix: str) -> Dict[str, KeyStat]:
+        """List keys with their etags, sizes and modification times from the cloud storage.
+
+        As `list_keys_and_etags`, but keeps the size and last modified time of each value that
+        listings return alongside its etag, so they are known without a request per key. Defaults
+        to `list_keys_and_etags`, with the sizes and modification times unknown.
+
+        Parameters
+        ----------
+        key_prefix : str, optional
+            An encoded prefix specifying a subset of keys to query. If not given, all keys will
+            be queried
+
+        Returns
+        -------
+        Dict[str, KeyStat]
+            A dictionary mapping each key in the cloud to it's latest etag, size and modification time
+        """
+        return {k: KeyStat(etag, None, None) for k, etag in self.list_keys_and_etags(key_prefix).items()}
+
+    def list_keys_and_stats_delimited(
+        self, key_prefix: str, delimiter: str = "/"
+    ) -> Tuple[Dict[str, KeyStat], List[str]]:
+        """As `list_keys_and_etags_delimited`, but returning the `KeyStat` of each key as by `list_keys_and_stats`.
+        Defaults to listing all keys beginning with the prefix, returning no nested prefixes.
+        """
+        return self.list_keys_and_stats(key_prefix), []
+
+    def list_keys_and_etags_many(
+        self, key_prefixes: Iterable[str], max_workers: int = 16, partition: bool = False, delimiter: str = "/"
+    ) -> Dict[str, str]:
+        """List keys and etags beginning with any of many prefixes from the cloud storage, as by
+        `list_keys_and_stats_many`.
+
+        Returns
+        -------
+        Dict[str, str]
+            A dictionary mapping each key in the cloud beginning with any of the prefixes to it's latest etag
+        """
+        listed = self.list_keys_and_stats_many(
+            key_prefixes, max_workers=max_workers, partition=partition, delimiter=delimiter
+        )
+        return {k: stat.etag for k, stat in listed.items()}
+
+    def list_keys_and_stats_many(
+        self, key_prefixes: Iterable[str], max_workers: int = 16, partition: bool = False, delimiter: str = "/"
+    ) -> Dict[str, KeyStat]:
+        """List keys with their etags, sizes and modification times beginning with any of many prefixes
+        from the cloud storage.
+
+        Each prefix is listed concurrently with `list_keys_and_stats`, so listing many disjoint
+        prefixes, such as the shards of a `cloudmappings.keycodecs.HashedShardKeyCodec`, takes about
+        as long as listing the largest of them. Listings are paginated, so a single prefix with many
+        keys is listed one page after another. With `partition=True` the prefixes are first split
+        into the prefixes nested beneath them with `list_keys_and_stats_delimited`, a few levels deep,
+        until there are at least `max_workers` disjoint prefixes to list concurrently.
+
+        Parameters
+        ----------
+        key_prefixes : Iterable[str]
+            Encoded prefixes specifying the subsets of keys to query
+        max_workers : int, default=16
+            The maximum number of prefixes to list concurrently
+        partition : bool, default=False
+            Whether to partition the prefixes by delimiter listings before listing them
+        delimiter : str, default="/"
+            The delimiter of levels of the key space, used to partition the prefixes
+
+        Returns
+        -------
+        Dict[str, KeyStat]
+            A dictionary mapping each key in the cloud beginning with any of the prefixes to it's latest
+            etag, size and modification time
+        """
+        key_prefixes = list(dict.fromkeys(key_prefixes))
+        listed = {}
+        if partition:
+            for _ in range(_max_partition_depth):
+                if not key_prefixes or len(key_prefixes) >= max_workers:
+                    break
+                # Keys directly beneath the prefixes are listed, leaving those nested to list concurrently
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(key_prefixes))) as executor:
+                    nested_prefixes = []
+                    for keys_and_stats, prefixes in executor.map(
+                        lambda p: self.list_keys_and_stats_delimited(p, delimiter), key_prefixes
+                    ):
+                        listed.update(keys_and_stats)
+                        nested_prefixes.extend(prefixes)
+                key_prefixes = nested_prefixes
+        if len(key_prefixes) == 1 and not listed:
+            return self.list_keys_and_stats(key_prefixes[0])
+        if key_prefixes:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(key_prefixes))) as executor:
+                for keys_and_stats in executor.map(self.list_keys_and_stats, key_prefixes):
+                    listed.update(keys_and_stats)
+        return listed
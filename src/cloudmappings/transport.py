@@ -0,0 +1,154 @@
+import threading
+from typing import Any, Dict, Optional
+
+
+class SharedTransport:
+    def __init__(
+        self,
+        max_pool_connections: int = 64,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 60.0,
+        keep_alive: bool = True,
+    ) -> None:
+        """Configures, and shares, the HTTP connections used to make requests to cloud storage.
+
+        The cloud sdks default to small connection pools (10 connections), which are exhausted
+        when a `CloudMapping` is used from many threads, resulting in connections being discarded
+        and repeated TLS handshakes. Pass the same `SharedTransport` to each `CloudStorage` to share
+        one pool of connections between all of them, and all the `CloudMapping`s created from them.
+
+        Sessions are created lazily, and only for the cloud sdks actually used.
+
+        Parameters
+        ----------
+        max_pool_connections : int, default=64
+            The maximum number of connections to keep open to each host. Set this to at least the
+            number of threads making requests concurrently
+        connect_timeout : float, default=10.0
+            Seconds to wait for a connection to be established
+        read_timeout : float, default=60.0
+            Seconds to wait for data to be received on an established connection
+        keep_alive : bool, default=True
+            Whether to keep connections open to reuse for later requests, or to close them after each request
+            (by sending `Connection: close`). Means the same for every cloud sdk
+        """
+        self.max_pool_connections = max_pool_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self._lock = threading.Lock()
+        self._requests_session = None
+        self._boto3_session = None
+        self._boto3_clients: Dict[Optional[str], Any] = {}
+        self._boto3_resources: Dict[Optional[str], Any] = {}
+        self._google_sessions: Dict[int, Any] = {}
+
+    def __reduce__(self):
+        # Pickled with its settings only, so each process (for example the workers of `CloudMapping.map_values`)
+        # creates its own sessions and connections, shared by the providers unpickled together
+        return (
+            SharedTransport,
+            (self.max_pool_connections, self.connect_timeout, self.read_timeout, self.keep_alive),
+        )
+
+    @property
+    def timeout(self):
+        """The (connect, read) timeout tuple, as accepted by `requests` and the Google Cloud sdk"""
+        return (self.connect_timeout, self.read_timeout)
+
+    def _configure_requests_session(self, session):
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(pool_connections=self.max_pool_connections, pool_maxsize=self.max_pool_connections)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def requests_session(self):
+        """Gets the `requests.Session` shared by Azure storage providers"""
+        with self._lock:
+            if self._requests_session is None:
+                from requests import Session
+
+                self._requests_session = self._configure_requests_session(Session())
+            return self._requests_session
+
+    def azure_transport(self):
+        """Creates an `azure.core` transport using the shared `requests.Session`. The session is
+        not closed when the transport is, so the transport may be used by many Azure clients."""
+        from azure.core.pipeline.transport import RequestsTransport
+
+        return RequestsTransport(
+            session=self.requests_session(),
+            session_owner=False,
+            connection_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+        )
+
+    def boto3_client(self, endpoint_url: str = None):
+        """Gets the S3 client shared by AWS storage providers using the same endpoint"""
+        with self._lock:
+            if endpoint_url not in self._boto3_clients:
+                self._boto3_clients[endpoint_url] = self._configure_boto3_client(
+                    self._get_boto3_session().client("s3", endpoint_url=endpoint_url, config=self._botocore_config())
+                )
+            return self._boto3_clients[endpoint_url]
+
+    def boto3_resource(self, endpoint_url: str = None):
+        """Gets the S3 resource shared by AWS storage providers using the same endpoint"""
+        with self._lock:
+            if endpoint_url not in self._boto3_resources:
+                resource = self._get_boto3_session().resource(
+                    "s3", endpoint_url=endpoint_url, config=self._botocore_config()
+                )
+                self._configure_boto3_client(resource.meta.client)
+                self._boto3_resources[endpoint_url] = resource
+            return self._boto3_resources[endpoint_url]
+
+    def _get_boto3_session(self):
+        if self._boto3_session is None:
+            import boto3
+
+            self._boto3_session = boto3.session.Session()
+        return self._boto3_session
+
+    def _botocore_config(self):
+        from botocore.config import Config
+
+        return Config(
+            max_pool_connections=self.max_pool_connections,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+        )
+
+    def _configure_boto3_client(self, client):
+        # botocore has no setting to close connections, so the header is added to each request as it is sent
+        if not self.keep_alive:
+            client.meta.events.register("before-send.s3", _close_connection)
+        return client
+
+    def google_session(self, credentials=None):
+        """Gets the authorised session shared by Google Cloud storage providers using the same credentials.
+        If no credentials are given, the default credentials for the environment are used."""
+        with self._lock:
+            if id(credentials) not in self._google_sessions:
+                from google.auth.transport.requests import AuthorizedSession
+
+                session_credentials = credentials
+                if session_credentials is None:
+                    import google.auth
+                    from google.cloud.storage import Client
+
+                    session_credentials, _ = google.auth.default(scopes=Client.SCOPE)
+                # Keep a reference to the credentials, so their id is not reused while cached
+                self._google_sessions[id(credentials)] = (
+                    credentials,
+                    self._configure_requests_session(AuthorizedSession(session_credentials)),
+                )
+            return self._google_sessions[id(credentials)][1]
+
+
+def _close_connection(request, **kwargs) -> None:
+    request.headers["Connection"] = "close"
@@ -8,9 +8,16 @@ from azure.identity import DefaultAzureCredential
 from cloudmappings._storageproviders.awss3storage import AWSS3StorageProvider
 from cloudmappings._storageproviders.azureblobstorage import AzureBlobStorageProvider
 from cloudmappings._storageproviders.azuretablestorage import AzureTableStorageProvider
+from cloudmappings._storageproviders.cachedstorage import CachedStorageProvider
 from cloudmappings._storageproviders.googlecloudstorage import (
     GoogleCloudStorageProvider,
 )
+from cloudmappings._storageproviders.localfilesystemstorage import (
+    LocalFileSystemStorageProvider,
+)
+from cloudmappings._storageproviders.packedstorage import PackedStorageProvider
+from cloudmappings._storageproviders.replicatedstorage import ReplicatedStorageProvider
+from cloudmappings._storageproviders.simulatedstorage import SimulatedStorageProvider
 from cloudmappings.cloudmapping import CloudMapping
 from cloudmappings.cloudstorage import CloudStorage
 from cloudmappings.storageprovider import StorageProvider
@@ -68,6 +75,11 @@ def gcp_storage_project() -> str:
     return os.environ["GOOGLE_CLOUD_STORAGE_PROJECT"]
 
 
+@pytest.fixture(scope="session")
+def local_file_system_directory(tmp_path_factory, test_container_name) -> str:
+    return str(tmp_path_factory.getbasetemp() / test_container_name)
+
+
 @pytest.fixture(
     scope="session",
     params=[
@@ -76,43 +88,73 @@ def gcp_storage_project() -> str:
         "azure_table_storage",
         "google_cloud_storage",
         "aws_s3",
+        "local_file_system",
+        "simulated",
+        "replicated",
+        "cached",
+        "packed",
     ],
 )
-def storage_provider(
-    request,
-    test_container_name,
-    azure_blob_storage_account_url,
-    azure_blob_storage_hierarchical_account_url,
-    azure_table_storage_connection_string,
-    gcp_storage_project,
-) -> StorageProvider:
+def storage_provider(request, test_container_name) -> StorageProvider:
+    # Provider specific fixtures are requested lazily, so providers can be tested without
+    # configuring credentials for all others
     if request.param == "azure_blob_storage":
         return AzureBlobStorageProvider(
-            account_url=azure_blob_storage_account_url,
+            account_url=request.getfixturevalue("azure_blob_storage_account_url"),
             container_name=test_container_name,
             credential=DefaultAzureCredential(),
         )
     elif request.param == "azure_blob_storage_hierarchical":
         return AzureBlobStorageProvider(
-            account_url=azure_blob_storage_hierarchical_account_url,
+            account_url=request.getfixturevalue("azure_blob_storage_hierarchical_account_url"),
             container_name=test_container_name,
             credential=DefaultAzureCredential(),
         )
     elif request.param == "azure_table_storage":
         return AzureTableStorageProvider(
-            connection_string=azure_table_storage_connection_string,
+            connection_string=request.getfixturevalue("azure_table_storage_connection_string"),
             table_name=test_container_name,
             credential=DefaultAzureCredential(),
         )
     elif request.param == "google_cloud_storage":
         return GoogleCloudStorageProvider(
-            project=gcp_storage_project,
+            project=request.getfixturevalue("gcp_storage_project"),
             bucket_name=test_container_name,
         )
     elif request.param == "aws_s3":
         return AWSS3StorageProvider(
             bucket_name=test_container_name,
         )
+    elif request.param == "local_file_system":
+        return LocalFileSystemStorageProvider(
+            directory=request.getfixturevalue("local_file_system_directory"),
+        )
+    elif request.param == "simulated":
+        return SimulatedStorageProvider(
+            name=test_container_name,
+        )
+    elif request.param == "replicated":
+        # Replicas with different key encodings, so keys are re-encoded between them
+        return ReplicatedStorageProvider(
+            replicas=[
+                SimulatedStorageProvider(name=test_container_name),
+                LocalFileSystemStorageProvider(
+                    directory=request.getfixturevalue("local_file_system_directory") + "-replica",
+                ),
+            ],
+        )
+    elif request.param == "cached":
+        return CachedStorageProvider(
+            storage_provider=SimulatedStorageProvider(name=test_container_name),
+            directory=request.getfixturevalue("local_file_system_directory") + "-cache",
+        )
+    elif request.param == "packed":
+        # Small packs, so that batches are split across many packs
+        return PackedStorageProvider(
+            storage_provider=SimulatedStorageProvider(name=test_container_name),
+            pack_size=64,
+            index_shards=4,
+        )
     raise ValueError(f"Test requested unknown storage provider '{request.param}'")
 
 
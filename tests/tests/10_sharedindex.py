@@ -0,0 +1,141 @@
+import multiprocessing
+import pickle
+import time
+
+import pytest
+
+from cloudmappings.cloudstorage import LocalFileSystemStorage, SimulatedStorage
+from cloudmappings.sharedindex import SharedEtagIndex
+
+
+def _write_from_worker(directory: str, index: SharedEtagIndex, worker: int) -> None:
+    cm = LocalFileSystemStorage(directory=directory).create_mapping(shared_index=index)
+    cm[f"worker-{worker}"] = worker
+    # Each worker may overwrite the shared key without syncing, writes to it are serialised between processes
+    cm["shared"] = worker
+
+
+def _stripe_is_locked(path: str, stripe: int) -> None:
+    import fcntl
+
+    with open(path, "a+b") as f:
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, stripe)
+        except OSError:
+            raise SystemExit(1)
+
+
+class SharedEtagIndexTests:
+    def test_only_first_mapping_lists(self, tmp_path):
+        storage = SimulatedStorage()
+        storage.storage_provider.upload_data("existing", None, b"data")
+
+        # Separate index instances on the same path, as each process would have
+        cm_1 = storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+        cm_2 = storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+
+        assert storage.storage_provider.request_counts["list_keys_and_etags"] == 1
+        assert "existing" in cm_1
+        assert "existing" in cm_2
+
+    def test_reopened_index_lists_again_once_stale(self, tmp_path, monkeypatch):
+        storage = SimulatedStorage()
+        provider = storage.storage_provider
+        provider.create_if_not_exists()
+        provider.upload_data("deleted", None, b"data")
+        storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+
+        # A later run reusing the index, after the cloud has changed
+        provider.delete_data("deleted", provider.get_etag("deleted"))
+        provider.upload_data("added", None, b"data")
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 60)
+        cm = storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+        assert provider.request_counts["list_keys_and_etags"] == 1
+        assert sorted(cm) == ["deleted"]
+
+        monkeypatch.setattr(time, "time", lambda: now + 7200)
+        cm = storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+        assert provider.request_counts["list_keys_and_etags"] == 2
+        assert sorted(cm) == ["added"]
+
+    def test_reset_index_lists_again(self, tmp_path):
+        storage = SimulatedStorage()
+        provider = storage.storage_provider
+        provider.create_if_not_exists()
+        index = SharedEtagIndex(str(tmp_path / "index.db"), max_sync_age=None)
+        storage.create_mapping(shared_index=index)
+        provider.upload_data("added", None, b"data")
+
+        assert sorted(storage.create_mapping(shared_index=index)) == []
+        index.reset()
+        assert sorted(storage.create_mapping(shared_index=index)) == ["added"]
+        assert provider.request_counts["list_keys_and_etags"] == 2
+
+    def test_writes_are_shared(self, tmp_path):
+        storage = SimulatedStorage()
+        cm_1 = storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+        cm_2 = storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+
+        cm_1["key"] = "one"
+        assert cm_2["key"] == "one"
+        cm_2["key"] = "two"
+        assert cm_1["key"] == "two"
+        del cm_1["key"]
+        assert "key" not in cm_2
+
+    def test_namespaces_are_isolated(self, tmp_path):
+        storage = SimulatedStorage()
+        index = SharedEtagIndex(str(tmp_path / "index.db"))
+        cm_1 = storage.create_mapping(shared_index=index, key_prefix="one/")
+        cm_2 = storage.create_mapping(shared_index=index, key_prefix="two/")
+
+        cm_1["key"] = 1
+        assert len(cm_1) == 1
+        assert len(cm_2) == 0
+
+    def test_index_is_picklable(self, tmp_path):
+        index = SharedEtagIndex(str(tmp_path / "index.db"))
+        index.etags("namespace")["key"] = "etag"
+
+        unpickled = pickle.loads(pickle.dumps(index))
+        assert unpickled.etags("namespace")["key"] == "etag"
+
+    def test_worker_processes(self, tmp_path):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            pytest.skip("Requires fork")
+        directory = str(tmp_path / "storage")
+        index = SharedEtagIndex(str(tmp_path / "index.db"))
+        cm = LocalFileSystemStorage(directory=directory).create_mapping(shared_index=index)
+
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=_write_from_worker, args=(directory, index, w)) for w in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+        # Writes made by the workers are known to this process without syncing
+        assert sorted(cm) == ["shared", "worker-0", "worker-1", "worker-2", "worker-3"]
+        assert cm["shared"] in range(4)
+        assert cm.etags == LocalFileSystemStorage(directory=directory).create_mapping().etags
+
+    def test_key_locks_are_shared_by_mappings_in_a_process(self, tmp_path):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            pytest.skip("Requires fork")
+        storage = SimulatedStorage()
+        index = SharedEtagIndex(str(tmp_path / "index.db"))
+        cm_1 = storage.create_mapping(shared_index=index)
+        cm_2 = storage.create_mapping(shared_index=SharedEtagIndex(str(tmp_path / "index.db")))
+        stripe = cm_1._key_lock._stripe("key")
+
+        context = multiprocessing.get_context("fork")
+        with cm_1._key_lock("key"):
+            # Locking and unlocking the same stripe through another mapping must not unlock it for other processes
+            with cm_2._key_lock("key"):
+                pass
+            child = context.Process(target=_stripe_is_locked, args=(f"{index.path}.locks", stripe))
+            child.start()
+            child.join()
+            assert child.exitcode == 1
@@ -0,0 +1,117 @@
+import time
+
+import pytest
+
+from cloudmappings._storageproviders.replicatedstorage import ReplicatedStorageProvider
+from cloudmappings._storageproviders.simulatedstorage import SimulatedStorageProvider
+from cloudmappings.cloudstorage import CloudStorage
+from cloudmappings.errors import KeySyncError, PartialWriteError
+
+
+class ReplicatedStorageTests:
+    def test_writes_fan_out_with_per_replica_etags(self):
+        replicas = [SimulatedStorageProvider(name=str(i)) for i in range(2)]
+        provider = ReplicatedStorageProvider(replicas=replicas)
+
+        etag = provider.upload_data("key", None, b"data")
+        listed = [r.list_keys_and_etags("") for r in replicas]
+        assert provider.list_keys_and_etags("") == {"key": etag}
+        assert provider._split_etag("key", etag) == [listed[0]["key"], listed[1]["key"]]
+
+        # A change to any one replica is detected
+        replicas[1].upload_data("key", listed[1]["key"], b"changed")
+        with pytest.raises(KeySyncError):
+            provider.upload_data("key", etag, b"data")
+
+    def test_partial_writes_raise_the_etag_written(self):
+        replicas = [SimulatedStorageProvider(name=str(i), seed=0) for i in range(2)]
+        provider = ReplicatedStorageProvider(replicas=replicas)
+        etag = provider.upload_data("key", None, b"one")
+
+        replicas[1]._failure_rate = 1.0
+        with pytest.raises(PartialWriteError) as e:
+            provider.upload_data("key", etag, b"two")
+        assert list(e.value.errors) == [1] and isinstance(e.value.errors[1], ConnectionError)
+        assert provider._split_etag("key", e.value.etag) == [
+            replicas[0].get_etag("key"),
+            provider._split_etag("key", etag)[1],
+        ]
+
+        # A retry conditional on the etag raised repairs the replica that failed
+        replicas[1]._failure_rate = 0.0
+        etag = provider.upload_data("key", e.value.etag, b"three")
+        assert [r.download_data("key", None) for r in replicas] == [b"three", b"three"]
+
+        # When no replica is written, the error is raised as is
+        replicas[0]._failure_rate = replicas[1]._failure_rate = 1.0
+        with pytest.raises(ConnectionError):
+            provider.delete_data("key", etag)
+
+    def test_mapping_recovers_from_partial_writes(self):
+        replicas = [SimulatedStorageProvider(name=str(i), seed=0) for i in range(2)]
+        cm = CloudStorage(ReplicatedStorageProvider(replicas=replicas)).create_mapping()
+        cm["key"] = 1
+
+        replicas[0]._failure_rate = 1.0
+        with pytest.raises(PartialWriteError):
+            cm["key"] = 2
+        replicas[0]._failure_rate = 0.0
+        cm.sync_with_cloud()
+        cm["key"] = 3
+        assert cm["key"] == 3
+        assert [r.download_data("key", None) for r in replicas][0] == replicas[1].download_data("key", None)
+
+    def test_listing_merges_partially_replicated_keys(self):
+        replicas = [SimulatedStorageProvider(name=str(i)) for i in range(2)]
+        provider = ReplicatedStorageProvider(replicas=replicas)
+        replica_etag = replicas[1].upload_data("only-in-second", None, b"data")
+
+        etag = provider.list_keys_and_etags("")["only-in-second"]
+        assert provider._split_etag("only-in-second", etag) == [None, replica_etag]
+        assert provider.download_data("only-in-second", etag) == b"data"
+
+        # Writing the key repairs the replica missing it
+        provider.upload_data("only-in-second", etag, b"repaired")
+        assert replicas[0].download_data("only-in-second", None) == b"repaired"
+
+    def test_slow_reads_are_hedged(self):
+        slow = SimulatedStorageProvider(name="slow", latency=0.5)
+        fast = SimulatedStorageProvider(name="fast")
+        provider = ReplicatedStorageProvider(replicas=[slow, fast], initial_hedge_delay=0.01)
+        etag = provider.upload_data("key", None, b"data")
+
+        start = time.perf_counter()
+        assert provider.download_data("key", etag) == b"data"
+        assert time.perf_counter() - start < 0.4
+        assert provider.hedged_requests == 1
+        assert slow.request_counts["download_data"] == 1
+        assert fast.request_counts["download_data"] == 1
+
+    def test_reads_prefer_fastest_replica(self):
+        slow = SimulatedStorageProvider(name="slow", latency=0.05)
+        fast = SimulatedStorageProvider(name="fast", latency=0.005)
+        provider = ReplicatedStorageProvider(
+            replicas=[slow, fast], hedge_percentile=100, initial_hedge_delay=0.001, min_latency_samples=10
+        )
+        etag = provider.upload_data("key", None, b"data")
+
+        # Initially the first replica is read from, and hedged, until latencies are learnt
+        for _ in range(20):
+            provider.download_data("key", etag)
+        time.sleep(0.2)  # Let the hedged requests that lost complete, so their latencies are recorded
+        assert provider.latency_percentile(1, 50) < provider.latency_percentile(0, 50)
+
+        reads_from_slow = slow.request_counts["download_data"]
+        for _ in range(20):
+            provider.download_data("key", etag)
+        assert slow.request_counts["download_data"] - reads_from_slow < 10
+
+    def test_failed_reads_fall_back(self):
+        class FailingReads(SimulatedStorageProvider):
+            def download_data(self, key: str, etag: str) -> bytes:
+                raise ConnectionError("Simulated request failure")
+
+        provider = ReplicatedStorageProvider(replicas=[FailingReads(name="failing"), SimulatedStorageProvider()])
+        etag = provider.upload_data("key", None, b"data")
+
+        assert provider.download_data("key", etag) == b"data"
@@ -0,0 +1,215 @@
+import threading
+from typing import List
+
+import pytest
+from azure.core.exceptions import HttpResponseError, ResourceModifiedError
+from botocore.exceptions import ClientError
+from google.api_core.exceptions import NotFound, TooManyRequests
+
+from cloudmappings import SimulatedStorage
+from cloudmappings._storageproviders.awss3storage import AWSS3StorageProvider
+from cloudmappings._storageproviders.azureblobstorage import AzureBlobStorageProvider
+from cloudmappings._storageproviders.googlecloudstorage import (
+    GoogleCloudStorageProvider,
+)
+from cloudmappings._storageproviders.simulatedstorage import SimulatedStorageProvider
+from cloudmappings.errors import KeySyncError, ThrottlingError
+from cloudmappings.instrumentation import Instrumentation, OperationRecord
+from cloudmappings.retry import AdaptiveConcurrencyLimit, RetryingStorageProvider, RetryPolicy
+
+
+class _Response:
+    def __init__(self, status_code: int) -> None:
+        self.status_code = status_code
+        self.reason = None
+        self.headers = {}
+
+    def text(self) -> str:
+        return ""
+
+
+class RetryTests:
+    def test_throttled_requests_are_retried(self):
+        sleeps = []
+        storage = SimulatedStorage(failure_rate=0.5, seed=0)
+        records: List[OperationRecord] = []
+        cm = storage.create_mapping(
+            retry_policy=RetryPolicy(max_attempts=20, seed=0, sleep=sleeps.append),
+            instrumentation=Instrumentation(callback=records.append),
+        )
+
+        for i in range(20):
+            cm[f"key-{i}"] = i
+        for i in range(20):
+            assert cm[f"key-{i}"] == i
+
+        assert len(sleeps) == sum(r.retries for r in records) > 0
+        assert storage.storage_provider.request_counts["upload_data"] > 20
+
+    def test_errors_are_raised_after_max_attempts(self):
+        sleeps = []
+        storage = SimulatedStorage(failure_rate=1.0)
+        with pytest.raises(ConnectionError):
+            storage.create_mapping(retry_policy=RetryPolicy(max_attempts=3, sleep=sleeps.append))
+        assert len(sleeps) == 2
+        assert storage.storage_provider.request_counts["create_if_not_exists"] == 3
+
+    def test_non_retryable_errors_are_not_retried(self):
+        sleeps = []
+        storage = SimulatedStorage()
+        cm_1 = storage.create_mapping(retry_policy=RetryPolicy(sleep=sleeps.append))
+        cm_2 = storage.create_mapping(retry_policy=RetryPolicy(sleep=sleeps.append))
+        cm_1["key"] = 1
+        with pytest.raises(KeySyncError):
+            cm_2["key"] = 2
+        assert sleeps == []
+
+    def test_backoff_is_exponential_with_jitter(self):
+        policy = RetryPolicy(initial_backoff=1, max_backoff=5, backoff_multiplier=2, seed=0)
+        for retry, ceiling in [(1, 1), (2, 2), (3, 4), (4, 5), (10, 5)]:
+            backoffs = [policy.backoff(retry) for _ in range(100)]
+            assert all(0 <= b <= ceiling for b in backoffs)
+            assert max(backoffs) > ceiling / 2
+
+    def test_concurrency_limit_aimd(self):
+        limit = AdaptiveConcurrencyLimit(initial=10, minimum=2, maximum=12)
+
+        # Requests in flight when the limit is decreased only decrease it once
+        tokens = [limit.acquire() for _ in range(10)]
+        for token in tokens[:5]:
+            limit.release(token, throttled=True)
+        assert limit.limit == 5
+        for token in tokens[5:]:
+            limit.release(token, throttled=False)
+
+        limit.release(limit.acquire(), throttled=True)
+        assert limit.limit == 2
+
+        # Increases by one for each limit's worth of successful requests
+        for _ in range(2 + 3):
+            limit.release(limit.acquire(), throttled=False)
+        assert limit.limit == 4
+        for _ in range(100):
+            limit.release(limit.acquire(), throttled=False)
+        assert limit.limit == 12
+
+    def test_concurrency_is_limited(self):
+        limit = AdaptiveConcurrencyLimit(initial=2)
+        tokens = [limit.acquire() for _ in range(2)]
+        acquired = threading.Event()
+
+        def acquire() -> None:
+            limit.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not acquired.wait(0.1)
+        limit.release(tokens[0], throttled=False)
+        assert acquired.wait(1)
+        thread.join()
+
+    def test_concurrency_converges_under_throttling(self):
+        storage = SimulatedStorage(requests_per_second=200, burst=8, latency=0.005)
+        policy = RetryPolicy(
+            max_attempts=50,
+            initial_backoff=0.001,
+            max_backoff=0.05,
+            concurrency_limit=AdaptiveConcurrencyLimit(initial=32),
+        )
+        cm = storage.create_mapping(retry_policy=policy)
+
+        def write(i: int) -> None:
+            cm[f"key-{i}"] = i
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(64)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(cm) == 64
+        assert policy.concurrency_limit.limit < 32
+
+    def test_requests_for_many_keys_are_each_limited_and_retried(self):
+        acquired = []
+
+        class CountingLimit(AdaptiveConcurrencyLimit):
+            def acquire(self) -> int:
+                acquired.append(None)
+                return super().acquire()
+
+        sleeps = []
+        simulated = SimulatedStorageProvider(failure_rate=0.5, seed=0)
+        provider = RetryingStorageProvider(
+            simulated, RetryPolicy(max_attempts=20, seed=0, sleep=sleeps.append, concurrency_limit=CountingLimit())
+        )
+        provider.create_if_not_exists()
+        acquired.clear()
+        sleeps.clear()
+
+        etags, errors = provider.upload_many({f"key-{i}": (None, bytes([i])) for i in range(20)})
+        assert errors == {}
+        downloaded = provider.download_many(etags)
+        assert downloaded == {f"key-{i}": bytes([i]) for i in range(20)}
+
+        # Each request for a key takes its own token from the concurrency limit, and only failed keys are retried
+        requests = simulated.request_counts["upload_data"] + simulated.request_counts["download_data"]
+        assert len(acquired) == requests
+        assert len(sleeps) == requests - 40 > 0
+
+    def test_only_failed_keys_of_a_batch_are_retried(self):
+        sleeps = []
+        policy = RetryPolicy(sleep=sleeps.append, concurrency_limit=AdaptiveConcurrencyLimit(initial=8))
+        batches = []
+
+        def request(keys):
+            batches.append(keys)
+            errors = {}
+            if len(batches) == 1:
+                errors = {"b": ConnectionError(), "c": KeySyncError(storage_provider_name="test", key="c", etag=None)}
+            return {k: k.upper() for k in keys if k not in errors}, errors
+
+        results, errors = policy.call_many(request, ["a", "b", "c"], lambda e: isinstance(e, ConnectionError))
+
+        assert results == {"a": "A", "b": "B"}
+        assert list(errors) == ["c"]
+        assert batches == [["a", "b", "c"], ["b"]]
+        assert len(sleeps) == 1
+        # The batch with a retryable failure is throttled
+        assert policy.concurrency_limit.limit == 4
+
+    def test_only_failed_keys_of_a_delete_batch_are_retried(self):
+        sleeps = []
+        simulated = SimulatedStorageProvider(seed=1)
+        provider = RetryingStorageProvider(simulated, RetryPolicy(max_attempts=20, seed=0, sleep=sleeps.append))
+        provider.create_if_not_exists()
+        etags, _ = provider.upload_many({f"key-{i}": (None, b"data") for i in range(20)})
+        etags["key-0"] = "stale"
+
+        simulated._failure_rate = 0.5
+        errors = provider.delete_many(etags)
+
+        # Deletes are retried as batches, without retrying the key that failed with a non-retryable error
+        assert list(errors) == ["key-0"] and isinstance(errors["key-0"], KeySyncError)
+        assert simulated.request_counts["delete_data"] == 0
+        assert len(sleeps) == simulated.request_counts["delete_many"] - 1 > 0
+        assert simulated.list_keys_and_etags(None).keys() == {"key-0"}
+
+    def test_provider_error_classification(self):
+        # Only is_retryable_error is called, so the providers don't need to be initialised
+        s3 = object.__new__(AWSS3StorageProvider)
+        assert s3.is_retryable_error(ClientError({"Error": {"Code": "SlowDown"}}, "PutObject"))
+        assert not s3.is_retryable_error(ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject"))
+
+        azure = object.__new__(AzureBlobStorageProvider)
+        assert azure.is_retryable_error(HttpResponseError(response=_Response(503)))
+        assert not azure.is_retryable_error(ResourceModifiedError(response=_Response(412)))
+
+        gcs = object.__new__(GoogleCloudStorageProvider)
+        assert gcs.is_retryable_error(TooManyRequests("Rate limit exceeded"))
+        assert not gcs.is_retryable_error(NotFound("Not found"))
+
+        for provider in [s3, azure, gcs]:
+            assert provider.is_retryable_error(ThrottlingError(storage_provider_name="test"))
+            assert not provider.is_retryable_error(KeySyncError(storage_provider_name="test", key="key", etag="etag"))
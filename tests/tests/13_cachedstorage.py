@@ -0,0 +1,139 @@
+import mmap
+import os
+
+import pytest
+
+from cloudmappings import CachedStorage, SimulatedStorage
+from cloudmappings._storageproviders.cachedstorage import CachedStorageProvider
+from cloudmappings._storageproviders.simulatedstorage import SimulatedStorageProvider
+from cloudmappings.errors import KeySyncError
+from cloudmappings.serialisers.core import none
+
+
+class CachedStorageTests:
+    def test_reads_are_only_downloaded_when_changed(self, tmp_path):
+        remote = SimulatedStorageProvider(name="remote")
+        provider = CachedStorageProvider(storage_provider=remote, directory=str(tmp_path))
+        other = CachedStorageProvider(storage_provider=remote, directory=str(tmp_path / "other"))
+
+        etag = provider.upload_data("key", None, b"data")
+        for _ in range(3):
+            assert provider.download_data("key", etag) == b"data"
+        # Written through to the cache, so only revalidated
+        assert remote.request_counts["download_data"] == 0
+        assert remote.request_counts["download_data_if_changed"] == 3
+
+        etag = other.upload_data("key", etag, b"changed")
+        with pytest.raises(KeySyncError):
+            provider.download_data("key", "stale-etag")
+        assert provider.download_data("key", etag) == b"changed"
+        assert provider.download_data("key", None) == b"changed"
+
+        other.delete_data("key", etag)
+        assert provider.download_data("key", None) is None
+        assert list(provider._cached_etags("key")) == []
+
+    def test_without_revalidation_cached_reads_make_no_requests(self, tmp_path):
+        remote = SimulatedStorageProvider(name="remote")
+        provider = CachedStorageProvider(storage_provider=remote, directory=str(tmp_path), revalidate=False)
+
+        etag = provider.upload_data("key", None, b"data")
+        remote.request_counts.clear()
+        assert provider.download_data("key", etag) == b"data"
+        assert bytes(provider.download_buffer("key", etag)) == b"data"
+        assert sum(remote.request_counts.values()) == 0
+
+    def test_buffer_is_read_only_memory_map(self, tmp_path):
+        provider = CachedStorageProvider(
+            storage_provider=SimulatedStorageProvider(name="remote"), directory=str(tmp_path)
+        )
+        data = os.urandom(64 * 1024)
+        etag = provider.upload_data("key", None, data)
+
+        buffer = provider.download_buffer("key", etag)
+        assert buffer.readonly
+        assert isinstance(buffer.obj, mmap.mmap)
+        assert buffer == data
+        with pytest.raises(TypeError):
+            buffer[0] = 0
+
+        # Replacing the cached value leaves existing views unchanged
+        provider.upload_data("key", etag, b"changed")
+        assert buffer == data
+
+    def test_least_recently_used_values_are_evicted(self, tmp_path):
+        remote = SimulatedStorageProvider(name="remote")
+        provider = CachedStorageProvider(storage_provider=remote, directory=str(tmp_path), max_size=250)
+
+        etags = {}
+        for key in ["a", "b"]:
+            etags[key] = provider.upload_data(key, None, bytes(100))
+        os.utime(provider._path("b", etags["b"]), ns=(0, 0))
+        etags["c"] = provider.upload_data("c", None, bytes(100))
+
+        assert list(provider._cached_etags("a")) == [etags["a"]]
+        assert list(provider._cached_etags("b")) == []
+        assert list(provider._cached_etags("c")) == [etags["c"]]
+        # Evicted values are downloaded again
+        assert provider.download_data("b", etags["b"]) == bytes(100)
+        assert remote.request_counts["download_data_if_changed"] == 1
+
+    def test_eviction_scans_are_amortised_over_writes(self, tmp_path, monkeypatch):
+        provider = CachedStorageProvider(
+            storage_provider=SimulatedStorageProvider(name="remote"), directory=str(tmp_path), max_size=10_000
+        )
+        evict_to_max_size = provider._evict_to_max_size
+        scans = []
+
+        def counted_evict_to_max_size(keep_path):
+            scans.append(keep_path)
+            evict_to_max_size(keep_path)
+
+        monkeypatch.setattr(provider, "_evict_to_max_size", counted_evict_to_max_size)
+        for i in range(150):
+            provider.upload_data(f"key-{i}", None, bytes(100))
+
+        assert len(scans) < 10
+        cached_size = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for directory, _, names in os.walk(tmp_path)
+            for name in names
+        )
+        assert cached_size <= 10_000
+        assert provider._cached_size == cached_size
+
+    def test_stale_etags_are_revalidated_against_the_cached_version(self, tmp_path, monkeypatch):
+        remote = SimulatedStorageProvider(name="remote")
+        provider = CachedStorageProvider(storage_provider=remote, directory=str(tmp_path))
+        etag = provider.upload_data("key", None, b"data")
+
+        download_data_if_changed = remote.download_data_if_changed
+        revalidated_etags = []
+
+        def recorded_download_data_if_changed(key, etag):
+            revalidated_etags.append(etag)
+            return download_data_if_changed(key=key, etag=etag)
+
+        monkeypatch.setattr(remote, "download_data_if_changed", recorded_download_data_if_changed)
+        with pytest.raises(KeySyncError):
+            provider.download_data("key", "stale-etag")
+        # The cached version is still the latest, so the data is not downloaded again
+        assert revalidated_etags == [etag]
+        assert list(provider._cached_etags("key")) == [etag]
+
+    def test_values_larger_than_the_cache_can_be_read(self, tmp_path):
+        provider = CachedStorageProvider(
+            storage_provider=SimulatedStorageProvider(name="remote"), directory=str(tmp_path), max_size=10
+        )
+        etag = provider.upload_data("key", None, bytes(100))
+        assert provider.download_data("key", etag) == bytes(100)
+
+    def test_mapping_get_buffer_is_zero_copy(self, tmp_path):
+        storage = CachedStorage(SimulatedStorage(), directory=str(tmp_path))
+        cm = storage.create_mapping(serialisation=none())
+        cm["key"] = b"data"
+
+        buffer = cm.get_buffer("key")
+        assert buffer.readonly
+        assert isinstance(buffer.obj, mmap.mmap)
+        assert buffer == b"data"
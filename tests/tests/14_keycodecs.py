@@ -0,0 +1,49 @@
+import pytest
+
+from cloudmappings import SimulatedStorage
+from cloudmappings.keycodecs import HashedShardKeyCodec, IdentityKeyCodec
+
+
+class KeyCodecTests:
+    def test_identity_key_codec(self):
+        codec = IdentityKeyCodec()
+        assert codec.encode("a/b") == "a/b"
+        assert codec.decode("a/b") == "a/b"
+        assert codec.listing_prefixes("a/") == ["a/"]
+
+    def test_hashed_shard_key_codec_round_trips(self):
+        codec = HashedShardKeyCodec(shards=256)
+        for key in ["", "key", "2024-01-01T00:00:00/run-1", "ключ"]:
+            stored_key = codec.encode(key)
+            assert stored_key == f"{codec.shard(key):02x}/{key}"
+            assert codec.decode(stored_key) == key
+        # Names not stored in their own shard were not encoded by the codec
+        assert codec.decode("unsharded") is None
+        assert codec.decode("zz/key") is None
+
+    def test_sequential_keys_are_spread_across_shards(self):
+        codec = HashedShardKeyCodec(shards=16)
+        shards = [codec.shard(f"2024-01-01T00:00:{i:05d}") for i in range(1600)]
+        assert min(shards.count(s) for s in range(16)) > 50
+
+    def test_listing_prefixes_cover_every_shard(self):
+        codec = HashedShardKeyCodec(shards=20, separator="-")
+        prefixes = codec.listing_prefixes("run/")
+        assert len(prefixes) == 20
+        assert prefixes[0] == "00-run/" and prefixes[-1] == "13-run/"
+        assert any(codec.encode("run/1").startswith(p) for p in prefixes)
+
+    def test_invalid_shards(self):
+        with pytest.raises(ValueError):
+            HashedShardKeyCodec(shards=0)
+
+    def test_sync_lists_each_shard_once(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping(key_codec=HashedShardKeyCodec(shards=8), sync_initially=False)
+        for i in range(20):
+            cm[f"key-{i}"] = i
+        storage.storage_provider.request_counts.clear()
+
+        cm_2 = storage.create_mapping(key_codec=HashedShardKeyCodec(shards=8))
+        assert cm_2.etags == cm.etags
+        assert storage.storage_provider.request_counts["list_keys_and_etags"] == 8
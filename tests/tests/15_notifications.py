@@ -0,0 +1,184 @@
+import base64
+import json
+import time
+
+import pytest
+
+from cloudmappings import SimulatedStorage, notifications
+from cloudmappings.errors import KeySyncError
+from cloudmappings.notifications import (
+    ChangeEvent,
+    ChangeSubscriber,
+    QueueChangeSource,
+    _parse_event_grid_events,
+    _parse_gcs_event,
+    _parse_s3_events,
+)
+
+
+class NotificationTests:
+    def test_parse_s3_events(self):
+        body = json.dumps(
+            {
+                "Records": [
+                    {
+                        "eventName": "ObjectCreated:Put",
+                        "s3": {"bucket": {"name": "bucket"}, "object": {"key": "a/my+key%3F", "sequencer": "0A1"}},
+                    },
+                    {
+                        "eventName": "ObjectRemoved:Delete",
+                        "s3": {"bucket": {"name": "other"}, "object": {"key": "b", "sequencer": "0A2"}},
+                    },
+                ]
+            }
+        )
+        assert _parse_s3_events(body) == [
+            ChangeEvent(key="a/my key?", deleted=False, etag=None, sequencer="0A1"),
+            ChangeEvent(key="b", deleted=True, etag=None, sequencer="0A2"),
+        ]
+        assert len(_parse_s3_events(body, bucket_name="bucket")) == 1
+        # Wrapped by SNS, and test events sent when notifications are configured
+        assert _parse_s3_events(json.dumps({"Type": "Notification", "Message": body})) == _parse_s3_events(body)
+        assert _parse_s3_events(json.dumps({"Event": "s3:TestEvent"})) == []
+
+    def test_parse_event_grid_events(self):
+        events = [
+            {
+                "eventType": "Microsoft.Storage.BlobCreated",
+                "subject": "/blobServices/default/containers/container/blobs/a/b",
+                "data": {"eTag": '"0x8D"', "sequencer": "00000001"},
+            },
+            {
+                "eventType": "Microsoft.Storage.BlobDeleted",
+                "subject": "/blobServices/default/containers/other/blobs/c",
+                "data": {"sequencer": "00000002"},
+            },
+        ]
+        expected = [
+            ChangeEvent(key="a/b", deleted=False, etag="0x8D", sequencer="00000001"),
+            ChangeEvent(key="c", deleted=True, etag=None, sequencer="00000002"),
+        ]
+        assert _parse_event_grid_events(json.dumps(events)) == expected
+        assert _parse_event_grid_events(base64.b64encode(json.dumps(events[0]).encode()).decode()) == expected[:1]
+        assert _parse_event_grid_events(json.dumps(events), container_name="container") == expected[:1]
+
+    def test_parse_gcs_event(self):
+        data = json.dumps({"generation": "17", "metageneration": "1"}).encode()
+        assert _parse_gcs_event({"eventType": "OBJECT_FINALIZE", "objectId": "a/b"}, data) == ChangeEvent(
+            key="a/b", deleted=False, etag="171", sequencer=f"{17:020d}{1:020d}"
+        )
+        assert _parse_gcs_event({"eventType": "OBJECT_DELETE", "objectId": "a/b"}, data).deleted
+        # Overwriting deletes the previous generation, but the key still exists
+        attributes = {"eventType": "OBJECT_DELETE", "objectId": "a/b", "overwrittenByGeneration": "18"}
+        assert _parse_gcs_event(attributes, data) is None
+
+    def test_subscriber_keeps_mapping_in_sync_without_listing(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping(key_prefix="prefix/")
+        cm_2 = storage.create_mapping(key_prefix="prefix/")
+        subscriber = ChangeSubscriber(cm_2, storage.storage_provider.subscribe())
+        storage.storage_provider.request_counts.clear()
+
+        cm["key"] = "value"
+        storage.create_mapping(key_prefix="other/", sync_initially=False)["key"] = "other"
+        assert subscriber.poll() == 1
+        assert cm_2.etags == cm.etags
+        assert cm_2["key"] == "value"
+
+        cm["key"] = "changed"
+        subscriber.poll()
+        assert cm_2["key"] == "changed"
+        del cm["key"]
+        subscriber.poll()
+        assert "key" not in cm_2
+        assert storage.storage_provider.request_counts["list_keys_and_etags"] == 0
+
+    def test_subscriber_ignores_changes_received_out_of_order(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        subscriber = ChangeSubscriber(cm, QueueChangeSource())
+
+        subscriber.apply([ChangeEvent(key="key", deleted=False, etag="new", sequencer="0F")])
+        subscriber.apply([ChangeEvent(key="key", deleted=True, sequencer="0E")])
+        assert cm.etags == {"key": "new"}
+        # Sequencers of different lengths are compared once padded
+        subscriber.apply([ChangeEvent(key="key", deleted=True, sequencer="100")])
+        assert cm.etags == {}
+
+    def test_subscriber_keeps_sequencers_of_recently_changed_keys(self, monkeypatch):
+        monkeypatch.setattr(notifications, "_sequencers_max_size", 2)
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        subscriber = ChangeSubscriber(cm, QueueChangeSource())
+
+        for sequencer, key in enumerate(["a", "b", "a", "c"], start=1):
+            subscriber.apply([ChangeEvent(key=key, deleted=False, etag="new", sequencer=str(sequencer))])
+        assert list(subscriber._sequencers) == ["a", "c"]
+        # Changes to recently changed keys are still ordered
+        subscriber.apply([ChangeEvent(key="c", deleted=True, sequencer="00")])
+        assert cm.etags == {"a": "new", "b": "new", "c": "new"}
+
+    def test_subscriber_gets_etags_missing_from_notifications(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        cm_2 = storage.create_mapping()
+        cm["key"] = "value"
+
+        ChangeSubscriber(cm_2, QueueChangeSource()).apply([ChangeEvent(key="key", deleted=False)])
+        assert cm_2.etags == cm.etags
+        assert storage.storage_provider.request_counts["get_etag"] == 1
+
+    def test_subscriber_ignores_late_notifications_of_own_writes(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        source = QueueChangeSource()
+        subscriber = ChangeSubscriber(cm, source)
+        changes = storage.storage_provider.subscribe()
+
+        cm["key"] = "first"
+        first = changes.receive(0)
+        cm["key"] = "second"
+        # The notification of the first write arrives after the second write
+        subscriber.apply(first)
+        assert cm.etags == {"key": storage.storage_provider.get_etag("key")}
+        cm["key"] = "third"
+
+        del cm["key"]
+        cm["key"] = "recreated"
+        # The notification of the delete arrives after the key was written again
+        subscriber.apply([ChangeEvent(key="key", deleted=True)])
+        assert cm["key"] == "recreated"
+        cm["key"] = "overwritten"
+
+    def test_failed_changes_are_received_again(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        cm_2 = storage.create_mapping()
+        source = QueueChangeSource()
+        subscriber = ChangeSubscriber(cm_2, source)
+        cm["key"] = "value"
+        source.put(ChangeEvent(key="key", deleted=False, sequencer="1"))
+
+        storage.storage_provider._failure_rate = 1.0
+        with pytest.raises(ConnectionError):
+            subscriber.poll()
+        storage.storage_provider._failure_rate = 0.0
+        # The change is received again, and applied as its sequencer was not recorded
+        assert subscriber.poll() == 1
+        assert cm_2.etags == cm.etags
+
+    def test_subscriber_in_background(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        cm_2 = storage.create_mapping()
+
+        with ChangeSubscriber(cm_2, storage.storage_provider.subscribe(), wait=0.05):
+            cm["key"] = "value"
+            deadline = time.monotonic() + 5
+            while "key" not in cm_2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert cm_2["key"] == "value"
+        # Changes after stopping are not applied
+        cm["key"] = "changed"
+        with pytest.raises(KeySyncError):
+            cm_2["key"] = "stale"
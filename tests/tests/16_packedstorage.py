@@ -0,0 +1,112 @@
+import threading
+from collections import Counter
+
+import pytest
+
+from cloudmappings import PackedStorage, SimulatedStorage
+from cloudmappings._storageproviders.packedstorage import PackedStorageProvider
+from cloudmappings._storageproviders.simulatedstorage import SimulatedStorageProvider
+from cloudmappings.errors import KeySyncError
+from cloudmappings.serialisers.core import none
+
+
+class PackedStorageTests:
+    def test_bulk_writes_and_reads_are_packed(self):
+        remote = SimulatedStorageProvider()
+        provider = PackedStorageProvider(storage_provider=remote, index_shards=4)
+
+        etags, errors = provider.upload_many({f"key{i}": (None, f"value{i}".encode()) for i in range(100)})
+        assert errors == {}
+        # One pack, and each shard of the index read and written once
+        assert remote.request_counts == Counter({"upload_data": 5, "download_data_if_changed": 4})
+        assert len(remote.list_keys_and_etags("packed/packs/")) == 1
+
+        remote.request_counts.clear()
+        values = provider.download_many(etags)
+        assert values == {f"key{i}": f"value{i}".encode() for i in range(100)}
+        # The values are adjacent in the pack, so are read with one range
+        assert remote.request_counts == Counter({"download_data_if_changed": 4, "download_range": 1})
+
+    def test_large_batches_are_split_into_packs(self):
+        remote = SimulatedStorageProvider()
+        provider = PackedStorageProvider(storage_provider=remote, pack_size=100, index_shards=1)
+
+        provider.upload_many({f"key{i}": (None, bytes(30)) for i in range(10)})
+        assert len(remote.list_keys_and_etags("packed/packs/")) == 4
+
+    def test_concurrent_writes_are_batched(self):
+        remote = SimulatedStorageProvider(latency=0.05)
+        provider = PackedStorageProvider(storage_provider=remote, index_shards=1)
+
+        etags = {}
+        threads = [
+            threading.Thread(target=lambda i=i: etags.update({i: provider.upload_data(f"key{i}", None, b"value")}))
+            for i in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(etags) == 20
+        # The first write is uploaded alone, and the others are batched while it is uploaded
+        assert len(remote.list_keys_and_etags("packed/packs/")) < 20
+        assert provider.list_keys_and_etags(None) == {f"key{i}": etags[i] for i in range(20)}
+
+    def test_etags_are_enforced_per_key(self):
+        provider = PackedStorageProvider(storage_provider=SimulatedStorageProvider(), index_shards=1)
+
+        etag = provider.upload_data("key", None, b"value")
+        with pytest.raises(KeySyncError):
+            provider.upload_data("key", None, b"other")
+        etags, errors = provider.upload_many({"key": (etag, b"changed"), "other": ("bad", b"other")})
+        assert list(etags) == ["key"] and list(errors) == ["other"]
+        assert isinstance(errors["other"], KeySyncError)
+        with pytest.raises(KeySyncError):
+            provider.download_data("key", etag)
+        assert provider.download_data("key", etags["key"]) == b"changed"
+        assert provider.download_range("key", etags["key"], 2, -1).data == b"ange"
+
+    def test_index_is_shared_between_clients(self):
+        remote = SimulatedStorageProvider()
+        provider = PackedStorageProvider(storage_provider=remote, index_shards=2)
+        provider_2 = PackedStorageProvider(storage_provider=remote, index_shards=2)
+
+        etag = provider.upload_data("key", None, b"value")
+        assert provider_2.download_data("key", etag) == b"value"
+        etag_2 = provider_2.upload_data("key", etag, b"changed")
+        # The cached index is stale, but is revalidated for each read
+        assert provider.download_data("key", etag_2) == b"changed"
+        with pytest.raises(KeySyncError):
+            provider.delete_data("key", etag)
+
+    def test_compaction_reclaims_overwritten_values(self):
+        storage = PackedStorage(SimulatedStorage(), index_shards=2)
+        remote = storage.storage_provider.wrapped_storage_provider
+        cm = storage.create_mapping(serialisation=none())
+        cm.update({f"key{i}": b"value" for i in range(10)})
+        cm.update({f"key{i}": b"changed" for i in range(8)})
+        etags = dict(cm.etags)
+        assert len(remote.list_keys_and_etags("packed/packs/")) == 2
+
+        # Packs are left alone during the grace period
+        assert storage.compact() == 0
+        assert storage.compact(grace=0) == 1
+        assert len(remote.list_keys_and_etags("packed/packs/")) == 2
+        # Values keep their etags, so the mapping remains in sync
+        assert dict(cm.items()) == {f"key{i}": b"changed" if i < 8 else b"value" for i in range(10)}
+        assert cm.etags == etags
+
+    def test_reads_survive_compaction(self):
+        remote = SimulatedStorageProvider()
+        provider = PackedStorageProvider(storage_provider=remote, index_shards=1, revalidate=False)
+        compactor = PackedStorageProvider(storage_provider=remote, index_shards=1)
+
+        etag = provider.upload_data("key", None, b"value")
+        provider.upload_data("other", None, b"other")
+        compactor.delete_data("other", compactor.get_etag("other"))
+        assert compactor.compact(min_garbage_ratio=0, grace=0) == 2
+
+        # The cached index refers to a deleted pack, so is read again
+        assert provider.download_data("key", etag) == b"value"
+        assert provider.download_many({"key": etag}) == {"key": b"value"}
+        assert provider.list_keys_and_etags(None) == {"key": etag}
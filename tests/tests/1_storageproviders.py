@@ -1,5 +1,8 @@
+from datetime import datetime, timedelta, timezone
+
 import pytest
 
+from cloudmappings._storageproviders.localfilesystemstorage import LocalFileSystemStorageProvider
 from cloudmappings.errors import KeySyncError
 from cloudmappings.storageprovider import StorageProvider
 
@@ -17,10 +20,34 @@ class StorageProviderTests:
         alphanumeric = "simplekey0"
         forwardslash = "/here/are/forward/slashes"
         othercharacters = "/how.about_some ˆøœ¨åß∆∫ı˜unusual!@#$%^*characters"
+        emptysegments = ["", "/", "a//b", "a/", "//a//", "%", "a/%/b"]
 
         assert alphanumeric == storage_provider.decode_key(storage_provider.encode_key(alphanumeric))
         assert forwardslash == storage_provider.decode_key(storage_provider.encode_key(forwardslash))
         assert othercharacters == storage_provider.decode_key(storage_provider.encode_key(othercharacters))
+        for key in emptysegments:
+            assert key == storage_provider.decode_key(storage_provider.encode_key(key))
+
+    def test_local_file_system_keys_with_empty_segments_are_distinct(self, tmp_path):
+        storage_provider = LocalFileSystemStorageProvider(directory=str(tmp_path))
+        # A key "k" can't also have keys beneath "k/", as with any file system
+        keys = ["a/", "a/b", "a/%", "b//c", "b/c", "/e", "//d", "%"]
+        encoded_keys = {storage_provider.encode_key(key): key for key in keys}
+        for encoded_key, key in encoded_keys.items():
+            storage_provider.upload_data(encoded_key, None, key.encode())
+
+        for encoded_key, key in encoded_keys.items():
+            assert storage_provider.download_data(encoded_key, None) == key.encode()
+        assert sorted(storage_provider.list_keys_and_etags("")) == sorted(encoded_keys)
+        assert sorted(storage_provider.list_keys_and_etags("a/")) == ["a/", "a/%25", "a/b"]
+        assert sorted(storage_provider.list_keys_and_etags("/")) == ["//d", "/e"]
+        keys_and_etags, prefixes = storage_provider.list_keys_and_etags_delimited("b/")
+        assert list(keys_and_etags) == ["b/c"]
+        assert prefixes == ["b//"]
+
+        for encoded_key in encoded_keys:
+            storage_provider.delete_data(encoded_key, storage_provider.get_etag(encoded_key))
+        assert storage_provider.list_keys_and_etags("") == {}
 
     def test_data_is_stored(self, storage_provider: StorageProvider, test_id: str):
         key = test_id + "-data-store-test"
@@ -108,6 +135,57 @@ class StorageProviderTests:
         cloud_key_list = storage_provider.list_keys_and_etags(encoded_key)
         assert encoded_key not in cloud_key_list
 
+    def test_delete_many(self, storage_provider: StorageProvider, test_id: str):
+        keys = [storage_provider.encode_key(f"{test_id}-delete-many/{i}") for i in range(5)]
+        keys_and_etags = {key: storage_provider.upload_data(key, None, b"data") for key in keys}
+        keys_and_etags[keys[0]] = "bad-etag"
+
+        errors = storage_provider.delete_many(keys_and_etags)
+
+        assert list(errors) == [keys[0]]
+        assert isinstance(errors[keys[0]], KeySyncError)
+        assert storage_provider.exists_many(keys) == {key: key == keys[0] for key in keys}
+
+    def test_copy_data(self, storage_provider: StorageProvider, test_id: str):
+        source_key = storage_provider.encode_key(f"{test_id}-copy-source")
+        key = storage_provider.encode_key(f"{test_id}-copy-destination")
+        source_etag = storage_provider.upload_data(source_key, None, b"data")
+
+        etag = storage_provider.copy_data(source_key, source_etag, key, None)
+        assert storage_provider.download_data(key, etag) == b"data"
+        assert storage_provider.download_data(source_key, source_etag) == b"data"
+
+        with pytest.raises(KeySyncError):
+            storage_provider.copy_data(source_key, "bad-etag", key, etag)
+        with pytest.raises(KeySyncError):
+            # No etag, not expecting data to overwrite
+            storage_provider.copy_data(source_key, source_etag, key, None)
+        with pytest.raises(KeySyncError):
+            storage_provider.copy_data(storage_provider.encode_key(f"{test_id}-copy-missing"), None, key, etag)
+
+        storage_provider.upload_data(source_key, source_etag, b"new-data")
+        etag = storage_provider.copy_data(source_key, None, key, etag)
+        assert storage_provider.download_data(key, etag) == b"new-data"
+
+    def test_append_data(self, storage_provider: StorageProvider, test_id: str):
+        key = storage_provider.encode_key(f"{test_id}-append")
+
+        etag = storage_provider.append_data(key, None, b"first")
+        assert storage_provider.download_data(key, etag) == b"first"
+        etag = storage_provider.append_data(key, etag, b",second")
+        assert storage_provider.download_data(key, etag) == b"first,second"
+
+        with pytest.raises(KeySyncError):
+            storage_provider.append_data(key, "bad-etag", b",third")
+        with pytest.raises(KeySyncError):
+            # No etag, not expecting data to append to
+            storage_provider.append_data(key, None, b",third")
+
+        # Values uploaded whole may be appended to
+        etag = storage_provider.upload_data(key, etag, b"new")
+        etag = storage_provider.append_data(key, etag, b",appended")
+        assert storage_provider.download_data(key, etag) == b"new,appended"
+
     def test_etags_are_enforced(self, storage_provider: StorageProvider, test_id: str):
         key = test_id + "etags-enforced-test"
         encoded_key = storage_provider.encode_key(key)
@@ -146,3 +224,119 @@ class StorageProviderTests:
         # Assert returns latest if value
         storage_provider.upload_data(encoded_key, None, b"data")
         assert storage_provider.download_data(encoded_key, None) == b"data"
+
+    def test_download_if_changed(self, storage_provider: StorageProvider, test_id: str):
+        key = test_id + "-download-if-changed"
+        encoded_key = storage_provider.encode_key(key)
+
+        assert storage_provider.download_data_if_changed(encoded_key, None) == (None, None)
+        etag_1 = storage_provider.upload_data(encoded_key, None, b"data")
+        assert storage_provider.download_data_if_changed(encoded_key, None) == (b"data", etag_1)
+        assert storage_provider.download_data_if_changed(encoded_key, etag_1) == (None, etag_1)
+
+        etag_2 = storage_provider.upload_data(encoded_key, etag_1, b"changed")
+        assert storage_provider.download_data_if_changed(encoded_key, etag_1) == (b"changed", etag_2)
+
+        storage_provider.delete_data(encoded_key, etag_2)
+        assert storage_provider.download_data_if_changed(encoded_key, etag_2) == (None, None)
+
+    def test_exists(self, storage_provider: StorageProvider, test_id: str):
+        encoded_key = storage_provider.encode_key(test_id + "-exists")
+        encoded_longer_key = storage_provider.encode_key(test_id + "-exists-longer")
+
+        assert not storage_provider.exists(encoded_key)
+        storage_provider.upload_data(encoded_longer_key, None, b"data")
+        assert not storage_provider.exists(encoded_key)
+        etag = storage_provider.upload_data(encoded_key, None, b"data")
+        assert storage_provider.exists(encoded_key)
+        storage_provider.delete_data(encoded_key, etag)
+        assert not storage_provider.exists(encoded_key)
+
+    def test_exists_many(self, storage_provider: StorageProvider, test_id: str):
+        encoded_keys = [storage_provider.encode_key(f"{test_id}-exists-many/{i}") for i in range(4)]
+        for encoded_key in encoded_keys[:2]:
+            storage_provider.upload_data(encoded_key, None, b"data")
+
+        expected = {k: i < 2 for i, k in enumerate(encoded_keys)}
+        assert storage_provider.exists_many(encoded_keys, use_listing=False) == expected
+        assert storage_provider.exists_many(encoded_keys, use_listing=True) == expected
+        assert storage_provider.exists_many([]) == {}
+
+    def test_list_keys_and_etags_delimited(self, storage_provider: StorageProvider, test_id: str):
+        keys = [f"{test_id}-delimited/{k}" for k in ["a", "b/c", "b/d/e", "bb/f"]]
+        etags = {}
+        for key in keys:
+            encoded_key = storage_provider.encode_key(key)
+            etags[encoded_key] = storage_provider.upload_data(encoded_key, None, b"data")
+
+        prefix = storage_provider.encode_key(f"{test_id}-delimited/")
+        keys_and_etags, prefixes = storage_provider.list_keys_and_etags_delimited(prefix)
+        # Providers that can't list by delimiter list every key beneath the prefix
+        assert prefixes == [] or sorted(prefixes) == [prefix + "b/", prefix + "bb/"]
+        assert all(keys_and_etags[k] == e for k, e in keys_and_etags.items())
+        assert set(keys_and_etags) | {k for k in etags if any(k.startswith(p) for p in prefixes)} == set(etags)
+
+        assert storage_provider.list_keys_and_etags_many([prefix], max_workers=4, partition=True) == etags
+
+    def test_list_keys_and_stats(self, storage_provider: StorageProvider, test_id: str):
+        before = datetime.now(timezone.utc) - timedelta(minutes=5)
+        etags = {}
+        for key, data in [("a", b"data"), ("b/c", b"longer data")]:
+            encoded_key = storage_provider.encode_key(f"{test_id}-stats/{key}")
+            etags[encoded_key] = storage_provider.upload_data(encoded_key, None, data)
+
+        prefix = storage_provider.encode_key(f"{test_id}-stats/")
+        keys_and_stats = storage_provider.list_keys_and_stats(prefix)
+        assert {k: stat.etag for k, stat in keys_and_stats.items()} == etags
+        # Providers that don't list sizes and modification times leave them unknown
+        sizes = [keys_and_stats[k].size for k in etags]
+        assert sizes == [4, 11] or sizes == [None, None]
+        assert all(stat.last_modified is None or stat.last_modified > before for stat in keys_and_stats.values())
+
+        keys_and_stats_many = storage_provider.list_keys_and_stats_many([prefix], max_workers=4, partition=True)
+        assert keys_and_stats_many == keys_and_stats
+
+    def test_get_etag(self, storage_provider: StorageProvider, test_id: str):
+        key = test_id + "-get-etag"
+        encoded_key = storage_provider.encode_key(key)
+
+        assert storage_provider.get_etag(encoded_key) is None
+        etag = storage_provider.upload_data(encoded_key, None, b"data")
+        assert storage_provider.get_etag(encoded_key) == etag
+        assert storage_provider.list_keys_and_etags(encoded_key)[encoded_key] == etag
+        storage_provider.delete_data(encoded_key, etag)
+        assert storage_provider.get_etag(encoded_key) is None
+
+    def test_download_buffer(self, storage_provider: StorageProvider, test_id: str):
+        key = test_id + "-download-buffer"
+        encoded_key = storage_provider.encode_key(key)
+
+        assert storage_provider.download_buffer(encoded_key, None) is None
+        etag = storage_provider.upload_data(encoded_key, None, b"data")
+        buffer = storage_provider.download_buffer(encoded_key, etag)
+        assert buffer.readonly
+        assert buffer == b"data"
+
+        empty_etag = storage_provider.upload_data(encoded_key, etag, b"")
+        assert storage_provider.download_buffer(encoded_key, empty_etag) == b""
+        with pytest.raises(KeySyncError):
+            storage_provider.download_buffer(encoded_key, etag)
+
+    def test_download_range(self, storage_provider: StorageProvider, test_id: str):
+        key = test_id + "-download-range"
+        encoded_key = storage_provider.encode_key(key)
+        data = bytes(range(100))
+
+        assert storage_provider.download_range(encoded_key, None, 0, 10) is None
+        etag = storage_provider.upload_data(encoded_key, None, data)
+
+        for start, end in [(0, 10), (10, None), (-10, None), (90, 200), (200, None), (50, 50), (-20, -10), (0, -90)]:
+            downloaded = storage_provider.download_range(encoded_key, etag, start, end)
+            assert downloaded.data == data[start:end]
+            assert downloaded.size == len(data)
+            assert downloaded.etag == etag
+        assert storage_provider.download_range(encoded_key, None, -10, None).etag == etag
+
+        storage_provider.upload_data(encoded_key, etag, b"changed")
+        with pytest.raises(KeySyncError):
+            storage_provider.download_range(encoded_key, etag, 0, 10)
@@ -1,3 +1,6 @@
+import os
+
+import pytest
 from azure.identity import DefaultAzureCredential
 
 from cloudmappings import (
@@ -5,6 +8,9 @@ from cloudmappings import (
     AzureBlobStorage,
     AzureTableStorage,
     GoogleCloudStorage,
+    LocalFileSystemStorage,
+    ReplicatedStorage,
+    SimulatedStorage,
 )
 from cloudmappings._storageproviders.awss3storage import AWSS3StorageProvider
 from cloudmappings._storageproviders.azureblobstorage import AzureBlobStorageProvider
@@ -12,8 +18,14 @@ from cloudmappings._storageproviders.azuretablestorage import AzureTableStorageP
 from cloudmappings._storageproviders.googlecloudstorage import (
     GoogleCloudStorageProvider,
 )
+from cloudmappings._storageproviders.localfilesystemstorage import (
+    LocalFileSystemStorageProvider,
+)
+from cloudmappings._storageproviders.replicatedstorage import ReplicatedStorageProvider
+from cloudmappings._storageproviders.simulatedstorage import SimulatedStorageProvider
 from cloudmappings.cloudstorage import CloudStorage
 from cloudmappings.serialisers.core import pickle
+from cloudmappings.transport import SharedTransport
 
 
 class CloudStorageTests:
@@ -46,6 +58,61 @@ class CloudStorageTests:
         )
         assert isinstance(storage.storage_provider, AWSS3StorageProvider)
 
+    def test_local_file_system_storage(self, local_file_system_directory):
+        storage = LocalFileSystemStorage(
+            directory=local_file_system_directory,
+        )
+        assert isinstance(storage.storage_provider, LocalFileSystemStorageProvider)
+
+    def test_simulated_storage(self, test_container_name):
+        storage = SimulatedStorage(
+            name=test_container_name,
+        )
+        assert isinstance(storage.storage_provider, SimulatedStorageProvider)
+
+    def test_replicated_storage(self, test_container_name):
+        replicas = [SimulatedStorage(name=f"{test_container_name}-{i}") for i in range(2)]
+        storage = ReplicatedStorage(replicas=replicas)
+        assert isinstance(storage.storage_provider, ReplicatedStorageProvider)
+        assert storage.storage_provider.replicas == [r.storage_provider for r in replicas]
+
+    def test_shared_transport(self, test_container_name):
+        transport = SharedTransport(max_pool_connections=32)
+
+        # Clients are created without making requests, so no credentials are needed
+        s3_storages = [AWSS3Storage(bucket_name=test_container_name, transport=transport) for _ in range(2)]
+        assert s3_storages[0].storage_provider._client is s3_storages[1].storage_provider._client
+        assert s3_storages[0].storage_provider._client.meta.config.max_pool_connections == 32
+
+    def test_shared_transport_keep_alive(self):
+        class Request:
+            def __init__(self) -> None:
+                self.headers = {}
+
+        for keep_alive in [True, False]:
+            transport = SharedTransport(keep_alive=keep_alive)
+            # Connections are closed after each request in the same way by every cloud sdk
+            request = Request()
+            transport.boto3_client().meta.events.emit("before-send.s3.GetObject", request=request)
+            closed = request.headers.get("Connection") == "close"
+            assert closed == (transport.requests_session().headers["Connection"] == "close") == (not keep_alive)
+
+    def test_shared_transport_azure_blob_storage(self, request, test_container_name):
+        if "AZURE_BLOB_STORAGE_ACCOUNT_URL" not in os.environ:
+            pytest.skip("Requires AZURE_BLOB_STORAGE_ACCOUNT_URL")
+        transport = SharedTransport(max_pool_connections=32)
+        blob_storages = [
+            AzureBlobStorage(
+                account_url=request.getfixturevalue("azure_blob_storage_account_url"),
+                container_name=test_container_name,
+                credential=DefaultAzureCredential(),
+                transport=transport,
+            )
+            for _ in range(2)
+        ]
+        sessions = [s.storage_provider._container_client._pipeline._transport.session for s in blob_storages]
+        assert sessions[0] is sessions[1] is transport.requests_session()
+
     def test_creation_defaults(self, cloud_storage: CloudStorage):
         cm = cloud_storage.create_mapping()
 
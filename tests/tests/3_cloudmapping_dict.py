@@ -30,6 +30,74 @@ class CloudMappingDictTests:
         with pytest.raises(KeyError):
             cloud_mapping[key]
 
+    def test_pop(self, cloud_mapping: CloudMapping):
+        key = "pop"
+
+        cloud_mapping[key] = b"popped"
+        assert cloud_mapping.pop(key) == b"popped"
+        assert key not in cloud_mapping
+        assert cloud_mapping.pop(key, None) is None
+        with pytest.raises(KeyError):
+            cloud_mapping.pop(key)
+
+    def test_popitem(self, cloud_mapping: CloudMapping):
+        cloud_mapping["popitem"] = b"item"
+
+        assert cloud_mapping.popitem() == ("popitem", b"item")
+        assert len(cloud_mapping) == 0
+        with pytest.raises(KeyError):
+            cloud_mapping.popitem()
+
+    def test_clear(self, cloud_mapping: CloudMapping):
+        for i in range(5):
+            cloud_mapping[f"clear/{i}"] = b"data"
+
+        cloud_mapping.clear()
+        assert len(cloud_mapping) == 0
+        cloud_mapping.sync_with_cloud()
+        assert len(cloud_mapping) == 0
+
+    def test_get(self, cloud_mapping: CloudMapping):
+        cloud_mapping["get"] = b"value"
+
+        assert cloud_mapping.get("get") == b"value"
+        assert cloud_mapping.get("get-missing") is None
+        assert cloud_mapping.get("get-missing", b"default") == b"default"
+
+    def test_setdefault(self, cloud_mapping: CloudMapping):
+        assert cloud_mapping.setdefault("setdefault", b"first") == b"first"
+        assert cloud_mapping.setdefault("setdefault", b"second") == b"first"
+        assert cloud_mapping["setdefault"] == b"first"
+
+    def test_update(self, cloud_mapping: CloudMapping):
+        cloud_mapping["update/0"] = b"old"
+
+        cloud_mapping.update({f"update/{i}": str(i).encode() for i in range(5)}, **{"update-kwarg": b"kwarg"})
+        cloud_mapping.update([("update/5", b"5")])
+
+        assert len(cloud_mapping) == 7
+        assert cloud_mapping["update/0"] == b"0"
+        assert cloud_mapping["update/5"] == b"5"
+        assert cloud_mapping["update-kwarg"] == b"kwarg"
+
+    def test_values_and_items(self, cloud_mapping: CloudMapping):
+        expected = {f"values/{i}": str(i).encode() for i in range(40)}
+        cloud_mapping.update(expected)
+
+        assert sorted(cloud_mapping.values()) == sorted(expected.values())
+        assert dict(cloud_mapping.items()) == expected
+        assert list(cloud_mapping.values()) == [cloud_mapping[k] for k in cloud_mapping]
+        assert ("values/1", b"1") in cloud_mapping.items()
+
+    def test_equality(self, cloud_mapping: CloudMapping):
+        expected = {"eq/a": b"a", "eq/b": b"b"}
+        cloud_mapping.update(expected)
+
+        assert cloud_mapping == expected
+        assert cloud_mapping != {"eq/a": b"a", "eq/b": b"different"}
+        assert cloud_mapping != {"eq/a": b"a"}
+        assert cloud_mapping != ["eq/a", "eq/b"]
+
     def test_contains(self, cloud_mapping: CloudMapping):
         key = "contains"
 
@@ -1,8 +1,24 @@
+import io
+import pickle
+
 import pytest
 
+from cloudmappings._storageproviders.localfilesystemstorage import (
+    LocalFileSystemStorageProvider,
+)
 from cloudmappings.cloudmapping import CloudMapping
 from cloudmappings.cloudstorage import CloudStorage
 from cloudmappings.errors import KeySyncError
+from cloudmappings.keycodecs import HashedShardKeyCodec
+from cloudmappings.serialisers.core import json, none
+from cloudmappings.transport import SharedTransport
+
+
+class TransportLocalFileSystemStorageProvider(LocalFileSystemStorageProvider):
+    # Constructed with a transport, as the cloud providers are, which holds locks and sessions
+    def __init__(self, directory: str, transport: SharedTransport) -> None:
+        super().__init__(directory)
+        self._session = transport.requests_session()
 
 
 class CloudMappingUtilsTests:
@@ -125,7 +141,9 @@ class CloudMappingUtilsTests:
 
         assert _repr.startswith("cloudmapping<CloudStorageProvider=")
 
-        if "AzureBlob" in _repr:
+        if "Replicated" in _repr:
+            assert "Replicas=" in _repr
+        elif "AzureBlob" in _repr:
             assert "StorageAccountName=" in _repr
             assert "ContainerName=" in _repr
         elif "AzureTable" in _repr:
@@ -136,6 +154,10 @@ class CloudMappingUtilsTests:
             assert "BucketName=" in _repr
         elif "AWSS3" in _repr:
             assert "BucketName=" in _repr
+        elif "LocalFileSystem" in _repr:
+            assert "Directory=" in _repr
+        elif "Simulated" in _repr:
+            assert "Name=" in _repr
         else:
             pytest.fail("Unknown provider repr")
 
@@ -168,3 +190,259 @@ class CloudMappingUtilsTests:
         cloud_mapping.read_blindly_error = False
         cloud_mapping.read_blindly_default = 100
         assert cloud_mapping["doesn't-exist"] == 100
+
+    def test_get_fresh(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm_1 = cloud_storage.create_mapping(sync_initially=False, key_prefix=f"{test_prefix}/")
+        cm_2 = cloud_storage.create_mapping(sync_initially=False, key_prefix=f"{test_prefix}/")
+
+        with pytest.raises(KeyError):
+            cm_2.get_fresh("key")
+        cm_1["key"] = "one"
+        assert cm_2.get_fresh("key") == "one"
+        assert cm_2.get_fresh("key") == "one"
+        cm_1["key"] = "two"
+        assert cm_2.get_fresh("key") == "two"
+
+        # The key is synced, so may be written without a KeySyncError
+        cm_2["key"] = "three"
+        assert cm_1.get_fresh("key") == "three"
+        del cm_1["key"]
+        with pytest.raises(KeyError):
+            cm_2.get_fresh("key")
+        assert "key" not in cm_2
+
+    def test_read_range(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=none(), key_prefix=f"{test_prefix}/")
+        data = bytes(range(256)) * 4
+
+        with pytest.raises(KeyError):
+            cm.read_range("key", 0, 10)
+        cm["key"] = data
+        assert cm.read_range("key", 0, 10) == data[:10]
+        assert cm.read_range("key", -8) == data[-8:]
+        assert cm.read_range("key", 1000, 2000) == data[1000:]
+
+        cm_2 = cloud_storage.create_mapping(sync_initially=False, serialisation=none(), key_prefix=f"{test_prefix}/")
+        cm_2.sync_with_cloud()
+        cm_2["key"] = data[::-1]
+        # The original mapping's etag is now out of date, so can't read a range of a different version
+        with pytest.raises(KeySyncError):
+            cm.read_range("key", 0, 10)
+        assert cm_2.read_range("key", 0, 10) == data[::-1][:10]
+
+    def test_sync_with_cloud_partitioned(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(sync_initially=False, key_prefix=f"{test_prefix}/")
+        for i in range(12):
+            cm[f"{i % 3}/{i % 2}/{i}"] = i
+        cm["top"] = "top"
+
+        cm_2 = cloud_storage.create_mapping(sync_initially=False, key_prefix=f"{test_prefix}/")
+        cm_2.sync_with_cloud(max_workers=4, partition=True)
+        assert cm_2.etags == cm.etags
+        cm_3 = cloud_storage.create_mapping(sync_initially=False, key_prefix=f"{test_prefix}/")
+        cm_3.sync_with_cloud("1/", partition=True)
+        assert sorted(cm_3.keys()) == sorted(k for k in cm.keys() if k.startswith("1/"))
+
+    def test_hashed_shard_key_codec(self, cloud_storage: CloudStorage, test_prefix: str):
+        codec = HashedShardKeyCodec(shards=4)
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/sharded/", key_codec=codec)
+        keys = [f"run-{i}" for i in range(8)]
+        for key in keys:
+            cm[key] = key
+
+        # Stored under their shard, but the keys of the mapping are unchanged
+        storage_provider = cloud_storage.storage_provider
+        for key in keys:
+            stored_key = codec.encode(f"{test_prefix}/sharded/{key}")
+            assert storage_provider.download_data(storage_provider.encode_key(stored_key), cm.etags[key]) is not None
+
+        cm_2 = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/sharded/", key_codec=codec)
+        assert sorted(cm_2.keys()) == keys
+        assert cm_2["run-3"] == "run-3"
+        cm_2.sync_with_cloud("run-1")
+        assert cm_2.etags == cm.etags
+
+    def test_get_buffer(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=none(), key_prefix=f"{test_prefix}/")
+
+        with pytest.raises(KeyError):
+            cm.get_buffer("key")
+        cm["key"] = b"data"
+        buffer = cm.get_buffer("key")
+        assert buffer.readonly
+        assert buffer == b"data"
+
+    def test_open(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(sync_initially=False, serialisation=none(), key_prefix=f"{test_prefix}/")
+        data = bytes(range(256)) * 4
+        cm["key"] = data
+
+        with cm.open("key", buffer_size=16) as f:
+            assert f.seekable()
+            assert f.read(4) == data[:4]
+            assert f.seek(-8, io.SEEK_END) == len(data) - 8
+            assert f.read() == data[-8:]
+            f.seek(100)
+            assert f.read(50) == data[100:150]
+            assert f.tell() == 150
+            assert f.read(-1) == data[150:]
+
+    def test_copy_and_move(self, cloud_mapping: CloudMapping):
+        cloud_mapping["copy/source"] = b"data"
+
+        cloud_mapping.copy("copy/source", "copy/destination")
+        assert cloud_mapping["copy/destination"] == b"data"
+        assert cloud_mapping["copy/source"] == b"data"
+
+        cloud_mapping.move("copy/source", "copy/moved")
+        assert "copy/source" not in cloud_mapping
+        assert cloud_mapping["copy/moved"] == b"data"
+
+        with pytest.raises(KeyError):
+            cloud_mapping.copy("copy/source", "copy/destination")
+        with pytest.raises(KeyError):
+            cloud_mapping.move("copy/source", "copy/destination")
+
+    def test_copy_out_of_sync_errors(self, cloud_mapping: CloudMapping, cloud_mapping_two: CloudMapping):
+        cloud_mapping["copy/source"] = b"data"
+        cloud_mapping_two.sync_with_cloud()
+        cloud_mapping_two["copy/source"] = b"changed"
+
+        with pytest.raises(KeySyncError):
+            cloud_mapping.copy("copy/source", "copy/destination")
+        with pytest.raises(KeySyncError):
+            cloud_mapping.move("copy/source", "copy/destination")
+        assert "copy/destination" not in cloud_mapping
+
+    def test_copy_prefix(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/")
+        cm.update({f"v1/{i}": i for i in range(20)})
+        cm["other"] = -1
+
+        cm.copy_prefix("v1/", "v2/")
+        assert {k: cm[k] for k in cm if k.startswith("v2/")} == {f"v2/{i}": i for i in range(20)}
+
+        # Copies are synchronised, and copy to other mappings of the same storage
+        versions = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/versions/")
+        cm.copy_prefix("v1/", "v3/", destination=versions)
+        assert dict(versions.items()) == {f"v3/{i}": i for i in range(20)}
+        cm.sync_with_cloud()
+        assert len(cm) == 61
+
+    def test_stat_and_total_size(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/stat/", serialisation=none())
+        cm["a"] = b"data"
+        cm.update({"b/c": b"longer data", "b/d": b""})
+
+        stat = cm.stat("a")
+        assert stat.etag == cm.etags["a"]
+        assert stat.size == 4
+        assert stat.last_modified is not None
+        assert cm.total_size() == 15
+        assert cm.total_size("b/") == 11
+        with pytest.raises(KeyError):
+            cm.stat("unknown")
+
+        cm_2 = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/stat/", serialisation=none())
+        cm_2.sync_with_cloud()
+        # Storages that don't list sizes leave them unknown
+        assert cm_2.stat("b/c").etag == cm.etags["b/c"]
+        assert cm_2.stat("b/c").size in (11, None)
+        # Sizes that weren't listed are requested
+        assert cm_2.total_size() == 15
+        assert cm_2.stat("b/c").size == 11
+
+        del cm["a"]
+        assert cm.total_size() == 11
+        cm_2["b/c"] = b"changed"
+        cm.get_fresh("b/c")
+        assert cm.stat("b/c").size == 7
+
+    def test_sync_in_background(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/background/")
+        cm.update({"a": 1, "b": 2})
+
+        cm_2 = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/background/", sync_in_background=True)
+        assert cm_2["a"] == 1
+        assert cm_2.get("missing") is None
+        cm_2["b"] = 3
+        assert cm_2.wait_for_sync()
+        assert dict(cm_2) == {"a": 1, "b": 3}
+        with pytest.raises(KeySyncError):
+            cm["b"] = 4
+
+    def test_transform(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/transform/")
+        cm_2 = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/transform/")
+
+        with pytest.raises(KeyError):
+            cm.transform("counter", lambda n: n + 1)
+        assert cm.transform("counter", lambda n: n + 1, default=0) == 1
+        # The latest value is read, so a mapping out of sync does not need to sync first
+        assert cm_2.transform("counter", lambda n: n + 1) == 2
+        assert cm.transform("counter", lambda n: n * 10) == 20
+        assert cm["counter"] == 20
+
+    def test_append(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/append/", serialisation=none())
+        cm.append("log", b"a")
+        cm.append("log", b"bc")
+        assert cm["log"] == b"abc"
+        assert cm.stat("log").size == 3
+
+        cm_2 = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/append/", serialisation=none())
+        cm_2.append("log", b"d")
+        # The original mapping's etag is now out of date, so can't append to a different version
+        with pytest.raises(KeySyncError):
+            cm.append("log", b"e")
+        assert cm_2["log"] == b"abcd"
+
+    def test_map_values(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/map/in/", serialisation=json())
+        out = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/map/out/", serialisation=json())
+        cm.update({"a/1": -1, "a/2": -2, "b/3": -3, "a/bad": "not a number"})
+
+        results = {r.key: r for r in cm.map_values(abs, prefix="a/", processes=0)}
+        assert {k: r.value for k, r in results.items() if r.error is None} == {"a/1": 1, "a/2": 2}
+        assert isinstance(results["a/bad"].error, TypeError)
+
+        results = list(cm.map_values(abs, keys=["b/3", "missing"], out=out, processes=0))
+        assert [(r.key, r.value) for r in results] == [("b/3", None), ("missing", None)]
+        assert isinstance(results[1].error, KeyError)
+        assert dict(out) == {"b/3": 3}
+
+    def test_map_values_on_local_storage_with_shared_transport(self, local_file_system_directory, test_prefix: str):
+        transport = SharedTransport(max_pool_connections=4)
+        storage = CloudStorage(TransportLocalFileSystemStorageProvider(local_file_system_directory, transport))
+        cm = storage.create_mapping(key_prefix=f"{test_prefix}/transport/", serialisation=json())
+        cm.update({str(i): -i for i in range(10)})
+
+        unpickled = pickle.loads(pickle.dumps(transport))
+        assert unpickled.max_pool_connections == 4 and unpickled is not transport
+        results = list(cm.map_values(abs, processes=2))
+        assert {r.key: r.value for r in results} == {str(i): i for i in range(10)}
+
+    def test_map_values_in_processes(self, cloud_storage: CloudStorage, test_prefix: str):
+        cm = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/map/in/", serialisation=json())
+        out = cloud_storage.create_mapping(key_prefix=f"{test_prefix}/map/out/", serialisation=json())
+        cm.update({str(i): -i for i in range(100)})
+        cm["bad"] = "not a number"
+        out["0"] = "existing"
+
+        try:
+            pickle.dumps(cloud_storage.storage_provider)
+        except TypeError:
+            # Storages held in memory can't be used by other processes
+            with pytest.raises(TypeError):
+                cm.map_values(abs, out=out, processes=2)
+            return
+
+        results = list(cm.map_values(abs, out=out, processes=2, threads_per_process=4))
+        assert [r.key for r in results] == list(cm.keys())
+        assert {r.key: type(r.error) for r in results if r.error is not None} == {"bad": TypeError}
+        # The workers' writes are synchronised with the output mapping
+        assert dict(out) == {str(i): i for i in range(100)}
+        out["0"] = "overwritten"
+
+        results = list(cm.map_values(abs, keys=["1", "2"], processes=2))
+        assert [(r.key, r.value, r.error) for r in results] == [("1", 1, None), ("2", 2, None)]
@@ -0,0 +1,411 @@
+import threading
+import time
+from itertools import count
+from typing import Dict, Optional, Tuple
+from uuid import uuid4
+
+import pytest
+from google.api_core.exceptions import BadRequest, PreconditionFailed
+
+from cloudmappings import SimulatedStorage, _cloudmappinginternal
+from cloudmappings._storageproviders.googlecloudstorage import (
+    GoogleCloudStorageProvider,
+)
+from cloudmappings._storageproviders.simulatedstorage import SimulatedStorageProvider
+from cloudmappings.errors import KeySyncError, ThrottlingError
+from cloudmappings.serialisers.core import none
+
+
+class FakeTime:
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def clock(self) -> float:
+        return self.now
+
+
+class FakeGoogleBlob:
+    # The parts of google.cloud.storage.Blob used by GoogleCloudStorageProvider to append, as the service behaves
+    def __init__(self, bucket: "FakeGoogleBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.metageneration = None
+        self.component_count = None
+
+    def _write(self, data: bytes, component_count: Optional[int], if_generation_match: Optional[int]) -> None:
+        existing = self.bucket.objects.get(self.name)
+        if if_generation_match is not None and if_generation_match != (0 if existing is None else existing[1]):
+            raise PreconditionFailed("Generation mismatch")
+        self.generation = next(self.bucket.generations)
+        self.metageneration = 1
+        self.component_count = component_count
+        self.bucket.objects[self.name] = (data, self.generation, component_count)
+
+    def upload_from_string(self, data: bytes, if_generation_match: Optional[int] = None) -> None:
+        self._write(data, None, if_generation_match)
+
+    def compose(self, sources, if_generation_match: int, if_source_generation_match) -> None:
+        component_count = sum(source.component_count or 1 for source in sources)
+        if component_count > 1024:
+            raise BadRequest("The number of source components exceeds the limit")
+        data = b"".join(self.bucket.objects[source.name][0] for source in sources)
+        self._write(data, component_count, if_generation_match)
+
+    def download_as_bytes(self, if_generation_match: int) -> bytes:
+        data, generation, _ = self.bucket.objects[self.name]
+        if generation != if_generation_match:
+            raise PreconditionFailed("Generation mismatch")
+        return data
+
+    def delete(self) -> None:
+        del self.bucket.objects[self.name]
+
+
+class FakeGoogleBucket:
+    def __init__(self) -> None:
+        self.objects: Dict[str, Tuple[bytes, int, Optional[int]]] = {}
+        self.generations = count(1)
+
+    def blob(self, blob_name: str) -> FakeGoogleBlob:
+        return FakeGoogleBlob(self, blob_name)
+
+    def get_blob(self, blob_name: str) -> Optional[FakeGoogleBlob]:
+        if blob_name not in self.objects:
+            return None
+        b = FakeGoogleBlob(self, blob_name)
+        _, b.generation, b.component_count = self.objects[blob_name]
+        b.metageneration = 1
+        return b
+
+
+class SimulatedStorageTests:
+    def test_latency_and_bandwidth(self):
+        fake_time = FakeTime()
+        provider = SimulatedStorageProvider(latency=0.01, bandwidth=1000, sleep=fake_time.sleep)
+
+        provider.upload_data("key", None, b"0" * 500)
+        assert fake_time.sleeps == [pytest.approx(0.51)]
+
+    def test_latency_distribution_is_deterministic(self):
+        sleeps = []
+        for _ in range(2):
+            fake_time = FakeTime()
+            provider = SimulatedStorageProvider(latency=lambda r: r.uniform(0, 1), seed=7, sleep=fake_time.sleep)
+            etag = provider.upload_data("key", None, b"data")
+            provider.download_data("key", etag)
+            sleeps.append(fake_time.sleeps)
+        assert sleeps[0] == sleeps[1]
+
+    def test_requests_are_throttled(self):
+        fake_time = FakeTime()
+        provider = SimulatedStorageProvider(requests_per_second=10, burst=2, clock=fake_time.clock)
+
+        provider.download_data("key", None)
+        provider.download_data("key", None)
+        with pytest.raises(ThrottlingError):
+            provider.download_data("key", None)
+
+        fake_time.now += 0.1
+        provider.download_data("key", None)
+        assert provider.request_counts["download_data"] == 4
+
+    def test_failures_are_injected(self):
+        provider = SimulatedStorageProvider(failure_rate=1.0)
+
+        with pytest.raises(ConnectionError):
+            provider.upload_data("key", None, b"data")
+        with pytest.raises(ConnectionError):
+            provider.list_keys_and_etags(None)
+        assert provider.request_counts == {"upload_data": 1, "list_keys_and_etags": 1}
+
+    def test_listing_is_paginated(self):
+        provider = SimulatedStorageProvider(list_page_size=10)
+        for i in range(25):
+            provider.upload_data(f"key-{i}", None, b"data")
+
+        assert len(provider.list_keys_and_etags("key-")) == 25
+        assert provider.request_counts["list_keys_and_etags"] == 3
+
+    def test_partitioned_listing_lists_pages_concurrently(self):
+        latency = [0.0]
+        provider = SimulatedStorageProvider(list_page_size=10, latency=lambda _: latency[0])
+        for i in range(100):
+            provider.upload_data(f"data/{i % 10}/{i}", None, b"data")
+        listed = provider.list_keys_and_etags("data/")
+
+        latency[0] = 0.05
+        provider.request_counts.clear()
+        start = time.perf_counter()
+        assert provider.list_keys_and_etags_many(["data/"], max_workers=10, partition=True) == listed
+        # One delimiter listing of the partitions, then a page of each listed concurrently
+        assert time.perf_counter() - start < 10 * 0.05
+        assert provider.request_counts == {"list_keys_and_etags_delimited": 1, "list_keys_and_etags": 10}
+
+    def test_etags_are_enforced_with_latency(self):
+        fake_time = FakeTime()
+        provider = SimulatedStorageProvider(latency=0.1, sleep=fake_time.sleep)
+
+        etag = provider.upload_data("key", None, b"data")
+        with pytest.raises(KeySyncError):
+            provider.upload_data("key", None, b"data")
+        provider.delete_data("key", etag)
+        with pytest.raises(KeySyncError):
+            provider.delete_data("key", etag)
+
+    def test_unchanged_data_is_not_transferred(self):
+        fake_time = FakeTime()
+        provider = SimulatedStorageProvider(bandwidth=1000, sleep=fake_time.sleep)
+        etag = provider.upload_data("key", None, b"0" * 500)
+
+        fake_time.sleeps.clear()
+        assert provider.download_data_if_changed("key", etag) == (None, etag)
+        assert provider.download_data_if_changed("key", "other") == (b"0" * 500, etag)
+        assert fake_time.sleeps == [pytest.approx(0.5)]
+
+    def test_read_blindly_contains_checks_single_key(self):
+        storage = SimulatedStorage(list_page_size=10)
+        for i in range(100):
+            storage.storage_provider.upload_data(f"a{i}", None, b"data")
+        cm = storage.create_mapping(sync_initially=False, read_blindly=True)
+
+        assert "a" not in cm
+        assert "a1" in cm
+        assert storage.storage_provider.request_counts["exists"] == 2
+        assert storage.storage_provider.request_counts["list_keys_and_etags"] == 0
+
+    def test_exists_many_lists_only_when_asked(self):
+        provider = SimulatedStorageProvider(list_page_size=10)
+        for i in range(1000):
+            provider.upload_data(f"sparse/{i}", None, b"data")
+        keys = [f"sparse/{i}" for i in range(990, 1010)]
+
+        # Listing the prefix would take 100 requests, rather than one for each key
+        assert provider.exists_many(keys) == {k: i < 10 for i, k in enumerate(keys)}
+        assert provider.request_counts["exists"] == 20
+        assert provider.request_counts["list_keys_and_etags"] == 0
+
+        provider.request_counts.clear()
+        keys = [f"dense/{i}" for i in range(100)]
+        for key in keys[::2]:
+            provider.upload_data(key, None, b"data")
+        assert provider.exists_many(keys, use_listing=True) == {k: i % 2 == 0 for i, k in enumerate(keys)}
+        assert provider.request_counts["exists"] == 0
+        assert provider.request_counts["list_keys_and_etags"] == 5
+
+    def test_mapping_methods_make_minimal_requests(self):
+        storage = SimulatedStorage()
+        provider = storage.storage_provider
+        cm = storage.create_mapping()
+
+        def requests(call) -> dict:
+            provider.request_counts.clear()
+            call()
+            return dict(provider.request_counts)
+
+        assert requests(lambda: cm.update({f"k{i}": i for i in range(10)})) == {"upload_data": 10}
+        assert requests(lambda: cm.get("missing")) == {}
+        assert requests(lambda: cm.get("k0")) == {"download_data": 1}
+        assert requests(lambda: cm.setdefault("k0", -1)) == {"download_data": 1}
+        assert requests(lambda: cm.setdefault("new", -1)) == {"upload_data": 1}
+        assert requests(lambda: cm.pop("missing", None)) == {}
+        assert requests(lambda: cm.pop("new")) == {"download_data": 1, "delete_data": 1}
+        assert requests(lambda: list(cm.values())) == {"download_data": 10}
+
+        # Mappings of the same storage compare etags, and only download values that differ
+        other = storage.create_mapping()
+        assert requests(lambda: cm == other) == {}
+        assert requests(lambda: cm.__eq__(dict(other.items()))) == {"download_data": 20}
+        cm["k0"] = 0
+        other.read_blindly = True
+        assert requests(lambda: cm == other) == {"download_data": 2}
+        assert requests(lambda: cm == {"k0": 0}) == {}
+
+        cm.read_blindly = True
+        assert requests(lambda: cm.get("missing")) == {"download_data": 1}
+        assert requests(lambda: cm.setdefault("missing", -1)) == {"upload_data": 1}
+        assert requests(lambda: cm.setdefault("k1", -1)) == {"download_data": 1}
+        other.read_blindly = False
+        other["unknown"] = 1
+        assert requests(lambda: cm.setdefault("unknown", -1)) == {"upload_data": 1, "download_data": 1}
+        assert cm.setdefault("unknown", -1) == 1
+
+    def test_update_uploads_concurrently(self):
+        storage = SimulatedStorage(latency=0.05)
+        cm = storage.create_mapping(max_workers=16)
+
+        start = time.perf_counter()
+        cm.update({f"k{i}": i for i in range(32)})
+        assert time.perf_counter() - start < 0.05 * 8
+
+    def test_background_sync_reads_keys_in_one_request(self):
+        # Listing takes a request per key, so the initial sync is still running while the keys are read
+        storage = SimulatedStorage(name=f"background-{uuid4().hex}", latency=0.01, list_page_size=1)
+        provider = storage.storage_provider
+        storage.create_mapping(sync_initially=False).update({f"k{i}": i for i in range(100)})
+        provider.request_counts.clear()
+
+        start = time.perf_counter()
+        cm = storage.create_mapping(sync_in_background=True)
+        assert cm["k0"] == 0
+        assert "k1" in cm
+        assert "missing" not in cm
+        assert time.perf_counter() - start < 0.01 * 10
+        # The existence of the storage was checked by the first mapping
+        assert provider.request_counts["create_if_not_exists"] == 0
+        assert provider.request_counts["download_data_if_changed"] == 1
+        assert provider.request_counts["get_etag"] == 2
+
+        # Keys not yet listed are looked up before being written, so existing values aren't overwritten
+        cm["k2"] = -2
+        assert cm.setdefault("k3", -3) == 3
+        assert len(cm) == 100
+        assert cm.wait_for_sync(timeout=0)
+        assert cm["k2"] == -2
+        assert sorted(cm.values()) == [-2] + [i for i in range(100) if i != 2]
+
+    def test_transform_under_contention(self):
+        storage = SimulatedStorage(latency=0.001)
+        # A mapping per writer, as writers in different processes would be
+        mappings = [storage.create_mapping() for _ in range(8)]
+        storage.storage_provider.request_counts.clear()
+
+        def increment(cm) -> None:
+            for _ in range(10):
+                cm.transform("counter", lambda n: n + 1, max_retries=100, default=0)
+
+        threads = [threading.Thread(target=increment, args=(cm,)) for cm in mappings]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert mappings[0].get_fresh("counter") == 80
+        # Only the key transformed was read, no keys were listed
+        assert set(storage.storage_provider.request_counts) == {"download_data_if_changed", "upload_data"}
+
+    def test_transform_raises_after_max_retries(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        other = storage.create_mapping()
+        cm["key"] = 0
+
+        def conflicting(n: int) -> int:
+            other.transform("key", lambda m: m + 1)
+            return n + 1
+
+        with pytest.raises(KeySyncError):
+            cm.transform("key", conflicting, max_retries=2, backoff=0)
+        assert cm.get_fresh("key") == 3
+
+    def test_get_fresh_revalidates_recently_used_values(self, monkeypatch):
+        monkeypatch.setattr(_cloudmappinginternal, "_fresh_values_max_size", 2)
+        storage = SimulatedStorage()
+        cm = storage.create_mapping(serialisation=none())
+        cm.update({k: b"0" for k in "abc"})
+
+        for key in "abc":
+            cm.get_fresh(key)
+        # The least recently used value was evicted, and values are forgotten when written, deleted or cleared
+        assert sorted(cm._fresh_values) == ["b", "c"]
+        cm["b"] = b"1"
+        del cm["c"]
+        assert len(cm._fresh_values) == 0
+        assert cm.get_fresh("b") == b"1"
+        assert list(cm._fresh_values) == ["b"]
+        cm.clear()
+        assert len(cm._fresh_values) == 0
+
+    def test_recreated_mappings_make_no_requests(self):
+        # As in the worker processes of map_values, which make many mappings of a resource already created
+        storage = SimulatedStorage()
+        cm = storage.create_mapping(key_prefix="prefix/")
+        cm["key"] = 1
+        storage.storage_provider.request_counts.clear()
+
+        recreated = cm._recreate()
+        assert dict(storage.storage_provider.request_counts) == {}
+        assert recreated.get_fresh("key") == 1
+
+    def test_google_cloud_storage_appends_past_the_compose_limit(self):
+        # Against a fake bucket, as composite objects are limited to 1024 components
+        bucket = FakeGoogleBucket()
+        provider = object.__new__(GoogleCloudStorageProvider)
+        provider._bucket = bucket
+        provider._request_args = {}
+
+        etag = provider.append_data("log", None, b"0")
+        for i in range(1, 1100):
+            etag = provider.append_data("log", etag, str(i % 10).encode())
+
+        data, _, component_count = bucket.objects["log"]
+        assert data == b"".join(str(i % 10).encode() for i in range(1100))
+        assert component_count < 1024
+        assert list(bucket.objects) == ["log"]
+
+    def test_copies_are_made_within_the_cloud(self):
+        storage = SimulatedStorage(bandwidth=1000)
+        cm = storage.create_mapping()
+        cm.update({f"v1/{i}": b"0" * 1000 for i in range(10)})
+        storage.storage_provider.request_counts.clear()
+
+        cm.copy_prefix("v1/", "v2/")
+        cm.move("v2/0", "v3/0")
+        assert storage.storage_provider.request_counts == {"copy_data": 11, "delete_data": 1}
+
+        # Mappings of other storages are copied to through the client
+        other = SimulatedStorage(name="other").create_mapping()
+        cm.copy("v1/0", "v1/0", destination=other)
+        assert storage.storage_provider.request_counts["download_data"] == 1
+        assert other["v1/0"] == b"0" * 1000
+
+    def test_clear_deletes_in_batches_without_downloading(self):
+        storage = SimulatedStorage()
+        for i in range(2500):
+            storage.storage_provider.upload_data(f"clear/{i}", None, b"data")
+        cm = storage.create_mapping(sync_initially=False)
+        cm.sync_with_cloud()
+        storage.storage_provider.request_counts.clear()
+
+        cm.clear()
+        assert len(cm) == 0
+        assert storage.storage_provider.request_counts == {"delete_many": 3}
+
+    def test_clear_raises_for_keys_changed_in_cloud(self):
+        storage = SimulatedStorage()
+        cm = storage.create_mapping()
+        cm["a"] = b"a"
+        cm["b"] = b"b"
+        storage.storage_provider.upload_data("b", cm.etags["b"], b"changed")
+
+        with pytest.raises(KeySyncError):
+            cm.clear()
+        assert list(cm) == ["b"]
+        assert storage.storage_provider.list_keys_and_etags("") == {"b": storage.storage_provider.get_etag("b")}
+
+    def test_only_range_is_transferred(self):
+        fake_time = FakeTime()
+        provider = SimulatedStorageProvider(bandwidth=1000, sleep=fake_time.sleep)
+        etag = provider.upload_data("key", None, b"0" * 1000)
+
+        fake_time.sleeps.clear()
+        assert provider.download_range("key", etag, -100, None).data == b"0" * 100
+        assert fake_time.sleeps == [pytest.approx(0.1)]
+
+    def test_appends_transfer_only_appended_data(self):
+        fake_time = FakeTime()
+        storage = SimulatedStorage(bandwidth=1000, sleep=fake_time.sleep)
+        cm = storage.create_mapping(serialisation=none())
+        cm["log"] = b"0" * 1000
+        storage.storage_provider.request_counts.clear()
+
+        fake_time.sleeps.clear()
+        for _ in range(10):
+            cm.append("log", b"1" * 100)
+        assert storage.storage_provider.request_counts == {"append_data": 10}
+        assert fake_time.sleeps == [pytest.approx(0.1)] * 10
+        assert cm["log"] == b"0" * 1000 + b"1" * 1000
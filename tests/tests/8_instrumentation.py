@@ -0,0 +1,70 @@
+from typing import List
+
+import pytest
+
+from cloudmappings.cloudstorage import CloudStorage
+from cloudmappings.errors import KeySyncError
+from cloudmappings.instrumentation import Instrumentation, OperationRecord
+
+
+class InstrumentationTests:
+    def test_operations_are_recorded(self, cloud_storage: CloudStorage, test_prefix: str):
+        records: List[OperationRecord] = []
+        cm = cloud_storage.create_mapping(
+            sync_initially=False,
+            key_prefix=f"{test_prefix}/",
+            instrumentation=Instrumentation(callback=records.append),
+        )
+        assert [r.operation for r in records] == ["create_if_not_exists"]
+
+        records.clear()
+        cm["key"] = "value"
+        assert [r.operation for r in records] == ["dumps", "upload_data"]
+        assert records[0].bytes_out == records[1].bytes_out > 0
+        assert all(r.outcome == "success" for r in records)
+        assert all(r.provider == cloud_storage.storage_provider.logical_name() for r in records)
+
+        records.clear()
+        assert cm["key"] == "value"
+        assert [r.operation for r in records] == ["download_data", "loads"]
+        assert records[0].bytes_in == records[1].bytes_in > 0
+
+        records.clear()
+        cm.sync_with_cloud()
+        assert [r.operation for r in records] == ["list_keys_and_etags"]
+
+    def test_outcomes_are_recorded(self, cloud_storage: CloudStorage, test_prefix: str):
+        records: List[OperationRecord] = []
+        cm = cloud_storage.create_mapping(
+            sync_initially=False,
+            read_blindly=True,
+            key_prefix=f"{test_prefix}/",
+            instrumentation=Instrumentation(callback=records.append),
+        )
+
+        cm["missing"]
+        assert records[-1].operation == "download_data"
+        assert records[-1].outcome == "not_found"
+
+        cm["key"] = "value"
+        cloud_storage.storage_provider.upload_data(
+            cloud_storage.storage_provider.encode_key(f"{test_prefix}/key"), cm.etags["key"], b"changed"
+        )
+        with pytest.raises(KeySyncError):
+            cm["key"] = "value"
+        assert records[-1].operation == "upload_data"
+        assert records[-1].outcome == "key_sync_error"
+        assert isinstance(records[-1].error, KeySyncError)
+
+    def test_opentelemetry(self, cloud_storage: CloudStorage, test_prefix: str):
+        pytest.importorskip("opentelemetry")
+        records: List[OperationRecord] = []
+        cm = cloud_storage.create_mapping(
+            sync_initially=False,
+            key_prefix=f"{test_prefix}/",
+            instrumentation=Instrumentation(callback=records.append, opentelemetry=True),
+        )
+
+        cm["key"] = "value"
+        assert cm["key"] == "value"
+        assert len(records) == 5
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cloudmappings.cloudstorage import (
+    CloudStorage,
+    LocalFileSystemStorage,
+    SimulatedStorage,
+)
+
+thread_count = 32
+operations_per_thread = 50
+
+
+@pytest.fixture(scope="function", params=["simulated", "local_file_system"])
+def local_storage(request, tmp_path) -> CloudStorage:
+    if request.param == "simulated":
+        # Random latencies interleave the requests from each thread
+        return SimulatedStorage(latency=lambda r: r.uniform(0, 0.001), seed=0)
+    return LocalFileSystemStorage(directory=str(tmp_path))
+
+
+class CloudMappingThreadSafetyTests:
+    def test_threads_writing_same_keys(self, local_storage: CloudStorage):
+        cm = local_storage.create_mapping()
+        keys = [f"shared-{i}" for i in range(4)]
+
+        def write(thread: int) -> None:
+            for i in range(operations_per_thread):
+                key = keys[i % len(keys)]
+                cm[key] = (thread, i)
+                assert isinstance(cm[key], tuple)
+
+        # Writes from the same mapping never conflict with each other, so there are no KeySyncErrors
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            list(executor.map(write, range(thread_count)))
+
+        # And the etags left behind are those of the values in the cloud
+        fresh = local_storage.create_mapping()
+        assert fresh.etags == cm.etags
+
+    def test_threads_writing_and_deleting_distinct_keys(self, local_storage: CloudStorage):
+        cm = local_storage.create_mapping()
+
+        def write_and_delete(thread: int) -> None:
+            for i in range(operations_per_thread):
+                key = f"thread-{thread}/{i}"
+                cm[key] = i
+                assert cm[key] == i
+                if i % 2 == 0:
+                    del cm[key]
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            list(executor.map(write_and_delete, range(thread_count)))
+
+        assert len(cm) == thread_count * operations_per_thread // 2
+        assert local_storage.create_mapping().etags == cm.etags
+
+    def test_sync_does_not_overwrite_concurrent_writes(self, local_storage: CloudStorage):
+        cm = local_storage.create_mapping()
+
+        def write(thread: int) -> None:
+            for i in range(operations_per_thread):
+                cm[f"synced-{thread % 4}"] = i
+                if thread == 0:
+                    cm.sync_with_cloud()
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            list(executor.map(write, range(thread_count)))
+
+        assert local_storage.create_mapping().etags == cm.etags
+        for key in cm:
+            cm[key] = "final"